@@ -50,7 +50,7 @@
  *          .commit();
  */
 
-var kClientVersion = 166;  // keep in sync with config.py
+var kClientVersion = 167;  // keep in sync with config.py
 var versionRequired = kClientVersion;
 
 function doCheckPopup() {
@@ -185,6 +185,8 @@ KansasClient.prototype.callAsync = function(tag, data) {
     if (this._ws != null) {
         this._debugLog("callAsync " + tag + " future=" + uniq_tag, data);
         this._ws.send(tag, data, uniq_tag);
+        /* Kept in case the server asks for it to be sent again. */
+        fut.request = {tag: tag, data: data};
         this._futures[uniq_tag] = fut;
     }
     return fut;
@@ -380,6 +382,19 @@ KansasClient.prototype._eventHandlers = function(that) {
     return {
         _future_router: function(e) {
             that._debugLog("future response " + e.future_id, e.data);
+            var fut = that._futures[e.future_id];
+            if (fut && e.type == 'error' && e.code == 'retry_later') {
+                /* Turned away by the server's rate limits; tries again. */
+                that.ui.vlog(1, "retrying " + fut.request.tag
+                    + " in " + e.retry_after + "s");
+                setTimeout(function() {
+                    if (that._ws != null && that._futures[e.future_id] === fut) {
+                        that._ws.send(
+                            fut.request.tag, fut.request.data, e.future_id);
+                    }
+                }, e.retry_after * 1000);
+                return;
+            }
             if (that._futures[e.future_id]) {
                 that._futures[e.future_id].done(e.data);
                 delete that._futures[e.future_id];
@@ -415,6 +430,11 @@ KansasClient.prototype._eventHandlers = function(that) {
             that._state = 'connected';
             that._reset(e.data[0]);
         },
+        resync: function(e) {
+            // Sent in place of updates dropped while we were falling behind.
+            that._debugLog("resync", e.data);
+            that._reset(e.data[0]);
+        },
         bulk_remove: function(e) {
             for (i in e.data) {
                 var id = e.data[i];
@@ -438,10 +458,33 @@ KansasClient.prototype._eventHandlers = function(that) {
                 state.orientations[add.id] = add.orient;
                 state.urls[add.id] = add.url;
                 state.urls_small[add.id] = add.small_url;
+                if (state.urls_variants) {
+                    state.urls_variants[add.id] = add.variants;
+                }
                 that._game.index[add.id] = add.pos;
             }
             that._notify('added', {'cards': added, 'requestor': e.data.requestor});
         },
+        bulk_urls: function(e) {
+            that._debugLog("bulk_urls", e.data);
+            var state = that._game.state;
+            var stacksTouched = {};
+            for (i in e.data) {
+                var update = e.data[i];
+                state.urls[update.id] = update.url;
+                state.urls_small[update.id] = update.small_url;
+                if (state.urls_variants) {
+                    state.urls_variants[update.id] = update.variants;
+                }
+                var pos = that._game.index[update.id];
+                if (pos) {
+                    stacksTouched[JSON.stringify(pos)] = true;
+                }
+            }
+            for (skey in stacksTouched) {
+                that._notify('stackchanged', JSON.parse(skey));
+            }
+        },
         bulkupdate: function(e) {
             that._debugLog("bulkupdate", e.data);
             var stacksTouched = {};
@@ -474,8 +517,28 @@ KansasClient.prototype._eventHandlers = function(that) {
         },
         presence: function(e) {
             that._debugLog("presence", e.data);
+            that._presence = {};
+            for (i in e.data) {
+                that._presence[e.data[i].uuid] = e.data[i];
+            }
             that._notify('presence', e.data, true);
         },
+        presence_delta: function(e) {
+            that._debugLog("presence_delta", e.data);
+            var presence = that._presence || {};
+            for (i in e.data.left) {
+                delete presence[e.data.left[i]];
+            }
+            for (i in e.data.joined) {
+                presence[e.data.joined[i].uuid] = e.data.joined[i];
+            }
+            that._presence = presence;
+            var list = [];
+            for (uuid in presence) {
+                list.push(presence[uuid]);
+            }
+            that._notify('presence', list, true);
+        },
     };
 }
 
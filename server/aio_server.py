@@ -0,0 +1,133 @@
+# Serves Kansas websocket clients from an asyncio event loop.
+#
+# Idle connections cost a pair of tasks rather than an OS thread. Requests
+# still run through the same KansasHandler state machine, on thread pools
+# so that handlers blocking on locks, the database or upstream lookups do
+# not stall the loop.
+
+from server import config
+from server import kansas_wsh
+from server import outbound
+
+import asyncio
+import concurrent.futures
+import logging
+from types import SimpleNamespace
+
+from websockets.asyncio.server import serve
+from websockets.exceptions import ConnectionClosed
+
+# Requests cheap enough to serve on the event loop itself.
+INLINE_REQUESTS = frozenset(['ping', 'keepalive'])
+# Requests that may wait on searches, deck generation or image lookups. They
+# get their own pool so that they cannot hold up game moves.
+SLOW_REQUESTS = frozenset([
+    'query', 'bulkquery', 'samplecards', 'add', 'sleep',
+    'clone_scope', 'list_scope',
+])
+
+
+class AsyncStream(object):
+    """Adapts a client connection served on the event loop to the stream
+       interface used by kansas_wsh. Its methods may be called from any
+       thread. send and close are coroutine functions."""
+
+    def __init__(self, remote_addr, send, close, executor):
+        # Preserve historical access pattern used in kansas_wsh.py
+        self._request = SimpleNamespace(connection=SimpleNamespace(
+            remote_addr=(remote_addr[0], remote_addr[1])))
+        self._outbound = outbound.AsyncOutboundQueue(
+            send, close,
+            config.kOutboundQueueSize, config.kOutboundPolicy,
+            executor=executor)
+
+    def send_message(self, message, binary=False):
+        if binary:
+            message = message if isinstance(message, bytes) else message.encode("utf-8")
+        elif isinstance(message, bytes):
+            message = message.decode("utf-8", errors="ignore")
+        self._outbound.put(message)
+
+    def set_resync(self, fn, lock):
+        self._outbound.set_resync(fn, lock)
+
+    def close_connection(self, wait_response=False):
+        self._outbound.close()
+
+
+class KansasServer(object):
+    """Runs each connection's requests in order, off the event loop unless
+       they are in INLINE_REQUESTS. Read-only requests (see
+       kansas_wsh.is_read_only) run concurrently with the rest, on the
+       kansas_wsh.readers pool shared with the threaded server."""
+
+    def __init__(self, game_workers=None, slow_workers=None):
+        self.game_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=game_workers or config.kAsyncGameWorkers,
+            thread_name_prefix='kansas-game')
+        self.slow_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=slow_workers or config.kAsyncSlowWorkers,
+            thread_name_prefix='kansas-slow')
+
+    def executor_for(self, reqtype):
+        """Returns the pool serving reqtype, or None to serve it inline."""
+
+        if reqtype in INLINE_REQUESTS:
+            return None
+        if reqtype in SLOW_REQUESTS:
+            return self.slow_executor
+        return self.game_executor
+
+    async def handle(self, conn):
+        # Only /kansas websocket path is expected by the browser client.
+        if conn.request.path != "/kansas":
+            await conn.close(1008, "Unsupported websocket path")
+            return
+
+        stream = AsyncStream(
+            conn.remote_address, conn.send, conn.close, self.game_executor)
+        await self.serve_connection(stream, conn)
+
+    async def serve_connection(self, stream, frames):
+        """Serves the inbound frames of one client, an async iterable, with
+           replies going out through stream."""
+
+        loop = asyncio.get_running_loop()
+        handler = kansas_wsh.initHandler
+        reads = asyncio.Semaphore(config.kMaxConcurrentReads)
+        try:
+            async for line in frames:
+                req = kansas_wsh.decode_request(line)
+                if req is not None and kansas_wsh.is_read_only(req):
+                    await reads.acquire()
+                    future = loop.run_in_executor(
+                        kansas_wsh.readers, kansas_wsh.serve_message,
+                        handler, stream, req)
+                    future.add_done_callback(lambda _: reads.release())
+                    continue
+                executor = self.executor_for(req and req.get('type'))
+                if executor is None:
+                    handler = kansas_wsh.serve_message(handler, stream, req)
+                else:
+                    handler = await loop.run_in_executor(
+                        executor, kansas_wsh.serve_message,
+                        handler, stream, req)
+        except ConnectionClosed:
+            pass
+        finally:
+            logging.info("Socket closed")
+            stream.close_connection()
+            await loop.run_in_executor(
+                self.game_executor, handler.notify_closed, stream)
+
+    def serve(self, host, port):
+        """Returns the websocket server, to be used with async with."""
+
+        return serve(self.handle, host, port,
+                     compression=config.kWireCompression)
+
+
+async def run(port, host="0.0.0.0"):
+    async with KansasServer().serve(host, port) as server:
+        print(f"WebSocket server listening on ws://localhost:{port}/kansas")
+        await server.serve_forever()
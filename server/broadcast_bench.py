@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+# Measures KansasGameHandler.broadcast cost against the number of streams.
+#
+# Usage: python3 -m server.broadcast_bench
+
+from server import kansas_wsh
+
+import json
+import time
+import timeit
+
+
+class _NullStream(object):
+    def send_message(self, message, binary=False):
+        pass
+
+
+def _payload():
+    """Returns a bulkupdate payload like one from a multi-select drag."""
+
+    return [{
+        'dest_type': 'board',
+        'dest_key': 1000 + i,
+        'updates': [{
+            'move': {'card': c, 'dest_type': 'board',
+                     'dest_key': 1000 + i, 'dest_orient': 1},
+            'old_type': 'board',
+            'old_key': 42,
+        } for c in range(i * 10, i * 10 + 10)],
+        'z_stack': list(range(60)),
+    } for i in range(4)]
+
+
+def _per_stream_broadcast(streams, reqtype, data):
+    """The previous fan-out, which encoded the payload once per stream."""
+
+    for stream in streams:
+        stream.send_message(
+            json.dumps({
+                'type': reqtype,
+                'data': data,
+                'time': time.time(),
+            }),
+            binary=False)
+
+
+def main():
+    game = kansas_wsh.KansasGameHandler('bench', '__bench__', 'pokerdb')
+    data = _payload()
+    number = 2000
+    print("%8s %14s %14s %8s" % ('streams', 'per-stream us', 'encode-once us', 'speedup'))
+    for n in [1, 2, 4, 8, 16, 32]:
+        streams = [_NullStream() for _ in range(n)]
+        for s in streams:
+            game.streams[s] = {}
+        old = timeit.timeit(
+            lambda: _per_stream_broadcast(streams, 'bulkupdate', data),
+            number=number)
+        new = timeit.timeit(
+            lambda: game.broadcast(streams, 'bulkupdate', data),
+            number=number)
+        print("%8d %14.1f %14.1f %7.1fx" % (
+            n, 1e6 * old / number, 1e6 * new / number, old / new))
+        game.streams = {}
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,167 @@
+# Wire formats for websocket messages, switchable per connection.
+#
+# Every connection starts out speaking JSON text frames. A client may ask
+# for the compact format in set_scope; its messages are then MessagePack
+# binary frames, with short keys for the message envelope and for the move
+# payloads that dominate traffic. Card ids stay integers, including as map
+# keys, where JSON would turn them into strings.
+
+import json
+import re
+import weakref
+
+try:
+    import msgpack  # type: ignore
+except ImportError:
+    msgpack = None
+
+ENVELOPE_KEYS = {'type': 't', 'data': 'd', 'time': 'ts', 'future_id': 'f'}
+MOVE_KEYS = {
+    'card': 'c', 'dest_type': 'dt', 'dest_key': 'dk', 'dest_orient': 'do'}
+UPDATE_KEYS = {'move': 'm', 'old_type': 'ot', 'old_key': 'ok'}
+STACK_KEYS = {
+    'dest_type': 'dt', 'dest_key': 'dk', 'updates': 'u', 'z_stack': 'z'}
+
+_JSON_TYPE = re.compile(r'\{\s*"type"\s*:\s*"([A-Za-z_]*)"')
+
+
+def _rename(d, keys):
+    return {keys.get(k, k): v for k, v in d.items()}
+
+
+def _inverse(keys):
+    return {v: k for k, v in keys.items()}
+
+
+class JSONCodec(object):
+    name = 'json'
+    binary = False
+
+    def encode(self, msg):
+        return json.dumps(msg)
+
+    def decode(self, frame):
+        return json.loads(frame)
+
+    def peek_type(self, frame):
+        """Returns the 'type' of an encoded message, or None."""
+
+        if not isinstance(frame, str):
+            return None
+        # Messages are usually json.dumps of dicts whose first key is 'type'.
+        match = _JSON_TYPE.match(frame)
+        if match:
+            return match.group(1)
+        try:
+            return json.loads(frame).get('type')
+        except (ValueError, AttributeError):
+            return None
+
+
+class CompactCodec(object):
+    name = 'compact'
+    binary = True
+
+    def __init__(self):
+        self._expand_envelope = _inverse(ENVELOPE_KEYS)
+        self._expand_move = _inverse(MOVE_KEYS)
+        self._expand_update = _inverse(UPDATE_KEYS)
+        self._expand_stack = _inverse(STACK_KEYS)
+
+    def _moves(self, moves, keys):
+        return [_rename(m, keys) for m in moves]
+
+    def _stacks(self, stacks, stack_keys, update_keys, move_keys):
+        out = []
+        for stack in stacks:
+            stack = _rename(stack, stack_keys)
+            updates = stack_keys.get('updates', 'updates')
+            move = update_keys.get('move', 'move')
+            stack[updates] = [
+                dict(u, **{move: _rename(u[move], move_keys)})
+                for u in (_rename(u, update_keys) for u in stack[updates])]
+            out.append(stack)
+        return out
+
+    def encode(self, msg):
+        kind = msg.get('type')
+        data = msg.get('data')
+        if kind == 'bulkupdate':
+            data = self._stacks(data, STACK_KEYS, UPDATE_KEYS, MOVE_KEYS)
+        elif kind == 'bulkmove':
+            data = dict(data, moves=self._moves(data['moves'], MOVE_KEYS))
+        msg = _rename(msg, ENVELOPE_KEYS)
+        if 'd' in msg:
+            msg['d'] = data
+        return msgpack.packb(msg)
+
+    def decode(self, frame):
+        msg = _rename(
+            msgpack.unpackb(frame, strict_map_key=False),
+            self._expand_envelope)
+        kind = msg.get('type')
+        if kind == 'bulkupdate':
+            msg['data'] = self._stacks(
+                msg['data'], self._expand_stack, self._expand_update,
+                self._expand_move)
+        elif kind == 'bulkmove':
+            msg['data'] = dict(msg['data'], moves=self._moves(
+                msg['data']['moves'], self._expand_move))
+        return msg
+
+    def peek_type(self, frame):
+        """Returns the 'type' of an encoded message, or None."""
+
+        # A fixmap whose first key is 't' and whose value is a fixstr.
+        if (len(frame) > 4 and 0x80 <= frame[0] <= 0x8f
+                and frame[1:3] == b'\xa1t' and 0xa0 <= frame[3] <= 0xbf):
+            return frame[4:4 + frame[3] - 0xa0].decode('utf-8', 'ignore')
+        try:
+            return self.decode(frame).get('type')
+        except Exception:
+            return None
+
+
+JSON = JSONCodec()
+COMPACT = msgpack and CompactCodec()
+
+# Codecs a client may ask for, by name.
+CODECS = {JSON.name: JSON}
+if COMPACT:
+    CODECS[COMPACT.name] = COMPACT
+
+_stream_codecs = weakref.WeakKeyDictionary()
+
+
+def negotiate(name):
+    """Returns the codec to use for a client asking for name."""
+
+    return CODECS.get(name, JSON)
+
+
+def for_stream(stream):
+    return _stream_codecs.get(stream, JSON)
+
+
+def set_codec(stream, codec):
+    _stream_codecs[stream] = codec
+
+
+def for_frame(frame):
+    """Returns the codec that produced frame."""
+
+    if (COMPACT and isinstance(frame, (bytes, bytearray))
+            and frame.lstrip()[:1] != b'{'):
+        return COMPACT
+    return JSON
+
+
+def decode(frame):
+    return for_frame(frame).decode(frame)
+
+
+def send(stream, msg):
+    """Encodes msg for stream and sends it."""
+
+    codec = for_stream(stream)
+    stream.send_message(codec.encode(msg), binary=codec.binary)
@@ -1,11 +1,89 @@
 import os
 
 kSmallImageSize = (92, 131)
+# Resized copies made of every cached card image, by name.
+kThumbnailSizes = {
+    'small': kSmallImageSize,
+    'board': (146, 204),
+    'zoom': (488, 680),
+}
+# Whether to also write a WebP copy of each thumbnail.
+kThumbnailWebP = False
+kThumbnailWorkers = 2
 kServingPrefix = ''
 kLocalServingAddress = 'http://localhost:8000/'
 kCachePath = 'cache'
-kClientVersion = 166
+kClientVersion = 167
 kDBPath = 'db'
+# Where game snapshots and journals are stored. Each shard worker (see
+# shard.py) keeps its own under kDBPath.
+kGameDBPath = kDBPath
+# Whether this process evicts cached images. Of the shard workers only the
+# first does, for all of them.
+kCacheSweeper = True
+# Games kept in each scope; the least recently used idle ones are ended.
+# With shard workers, the supervisor enforces this across all of them.
+kMaxGamesPerScope = 5
+# Seconds that sqlite writes may wait so concurrent Puts share one commit.
+kDBGroupCommitWindow = 0.05
+# A game's op journal is compacted into a snapshot after this many ops or seconds.
+kJournalCompactOps = 200
+kJournalCompactSeconds = 60
+# Seconds over which a game merges bulkmoves into one bulkupdate broadcast,
+# e.g. 0.016-0.05. Moves are broadcast immediately when 0.
+kMoveCoalesceWindow = 0
+# Seconds without a keepalive after which a player's stream is closed.
+kKeepaliveTimeout = 60
+# Seconds over which joins and leaves are batched into one presence_delta.
+kPresenceWindow = 0.25
+# Dirty game snapshots are written at most once per this many seconds.
+kSnapshotFlushInterval = 1.0
+# Number of threads downloading and resizing card images.
+kImageFetchWorkers = 4
+# Seconds allowed for a whole image download, and for each socket operation.
+kImageFetchTimeout = 60
+kImageSocketTimeout = 15
+# Disk budget for the image cache; least recently used images are evicted.
+kCacheMaxBytes = 2 * 1024 ** 3
+kCacheMaxFiles = 100000
+kCacheSweepInterval = 300
+# Messages buffered for each client, and what happens once a client falls
+# that far behind: 'resync', 'coalesce' or 'disconnect' (see outbound.py).
+kOutboundQueueSize = 256
+kOutboundPolicy = 'resync'
+# Websocket compression extension offered to clients: 'deflate'
+# (permessage-deflate) or None.
+kWireCompression = 'deflate'
+# Threads serving read-only requests (searches, kvop Get/List) alongside
+# each client's ordered requests, and how many each client may have running.
+# Both the asyncio and --threaded servers use this one pool.
+kReadOnlyWorkers = 8
+kMaxConcurrentReads = 4
+# Token bucket limits, as (requests per second, burst), on requests that
+# may go upstream or generate decks. Each connection has its own budget,
+# and all connections in a scope share a larger one.
+kConnectionRateLimits = {
+    'query': (5, 20),
+    'bulkquery': (0.2, 3),
+    'add': (0.5, 5),
+    'samplecards': (1, 5),
+}
+kScopeRateLimits = {
+    'query': (50, 200),
+    'bulkquery': (2, 20),
+    'add': (5, 50),
+    'samplecards': (10, 50),
+}
+# Upstream card lookups in flight at once, across all clients, and how many
+# seconds a request waits for a slot before being told to retry later.
+kMaxUpstreamFetches = 8
+kUpstreamFetchWait = 2
+# Parsed local searches kept for reuse.
+kSearchPlanCacheSize = 1024
+# Threads serving the asyncio server's ordered requests: game requests, and
+# slow ones such as card adds and scope admin.
+kAsyncGameWorkers = 8
+kAsyncSlowWorkers = 8
 
 if not os.path.exists(kCachePath):
     os.makedirs(kCachePath)
@@ -42,12 +42,14 @@ def SampleDeck(source, term, num_decks):
     return _SOURCES[source].SampleDeck(term, num_decks)
 
 
-def _FindCards(source, name, exact, limit=None):
+def _FindCards(source, name, exact, limit=None, explain=False):
     """Same as FindCards but skips caches."""
 
     if source not in _SOURCES:
         raise Exception("Source '%s' not found." % str(source))
 
+    if explain:
+        return _SOURCES[source].Explain(name, exact, limit)
     return _SOURCES[source].Fetch(name, exact, limit)
 
 
@@ -58,7 +60,7 @@ def Complete(source, cards):
     return _SOURCES[source].Complete(cards)
 
 
-def Find(source, name, exact=False, limit=None):
+def Find(source, name, exact=False, limit=None, explain=False):
     """Returns (stream, meta), where
         stream is a list of
         {
@@ -66,12 +68,17 @@ def Find(source, name, exact=False, limit=None):
             'img_url': 'http://...',
             'info_url': 'http://...',
         }
-        and meta is a dictionary of extra attributes."""
+        and meta is a dictionary of extra attributes.
+
+       With explain, the search bypasses the cache and the source may add
+       a description of how it searched to meta."""
 
     key = str((str(source), str(name), bool(exact), str(limit)))
-    result = QueryCache.Get(key)
+    result = None if explain else QueryCache.Get(key)
 
-    if result is None:
+    if explain:
+        result = _FindCards(source, name, exact, limit, explain=True)
+    elif result is None:
         logging.info("Cache miss on '%s'", key)
         result = _FindCards(source, name, exact, limit)
         QueryCache.Put(key, result)
@@ -2,17 +2,267 @@
 
 from server import config
 from server import namespaces
+from server import thumbnails
 
+import collections
+import concurrent.futures
+import glob
+import hashlib
+import http.client
 import logging
 import os
+import tempfile
+import threading
+import time
 import urllib.request, urllib.error, urllib.parse
 
-# Stores map of url -> cached file, which can be used to invert _toHashName().
-CacheMap = namespaces.Namespace(config.kDBPath, 'CacheMap', version=1)
+# Stores map of url -> {'name': cached file, 'atime': last access, 'etag': ...,
+# 'last_modified': ...}, which can be used to invert _toHashName().
+CacheMap = namespaces.Namespace(config.kDBPath, 'CacheMap', version=2)
+
+# Version 1 names came from the builtin hash(), which changes every process.
+_LegacyCacheMap = namespaces.Namespace(
+    config.kDBPath, 'CacheMap', version=1, _register=False)
+
+# Stores map of old cache path -> new path for files moved by MigrateCache().
+Relocations = namespaces.Namespace(config.kDBPath, 'CacheRelocations', version=0)
 
 
 def _toHashName(url):
-    return hex(hash('$' + url))[2:] + '.jpg'
+    digest = hashlib.sha1(url.encode('utf-8')).hexdigest()
+    # Shards files into 256 subdirectories keyed on the digest prefix.
+    return os.path.join(digest[:2], digest + '.jpg')
+
+
+def VariantPath(path, suffix):
+    """Returns where a derived copy (e.g. a thumbnail) of path is stored."""
+
+    base = os.path.basename(path)[:-4] + suffix
+    if path.startswith(config.kCachePath):
+        return os.path.join(os.path.dirname(path), base)
+    return os.path.join(config.kCachePath, base)
+
+
+def Relocated(path):
+    """Returns the current location of a cache path saved before migration."""
+
+    if not path.startswith(config.kCachePath):
+        return path
+    return Relocations.Get(path) or path
+
+
+def MigrateCache():
+    """Moves files cached under legacy hash() names to their digest names.
+    Servers run it once at startup, before starting any worker processes.
+
+    Each move is recorded as soon as it is made, and each file's entries are
+    written before the next file is moved, so a failure partway through
+    loses nothing; running again picks up where it stopped."""
+
+    moved = 0
+    for url, old_name in _LegacyCacheMap:
+        old_path = os.path.join(config.kCachePath, old_name)
+        new_name = _toHashName(url)
+        new_path = os.path.join(config.kCachePath, new_name)
+        if os.path.exists(old_path):
+            os.makedirs(os.path.dirname(new_path), exist_ok=True)
+            os.replace(old_path, new_path)
+            Relocations.Put(old_path, new_path)
+        elif Relocations.Get(old_path) != new_path:
+            _LegacyCacheMap.Delete(url)
+            continue
+        # Carries resized copies along with the original.
+        for variant in glob.glob(glob.escape(old_path[:-4]) + '@*'):
+            new_variant = VariantPath(new_path, variant[len(old_path) - 4:])
+            os.replace(variant, new_variant)
+            Relocations.Put(variant, new_variant)
+        CacheMap.Put(url, {'name': new_name, 'atime': time.time()})
+        _LegacyCacheMap.Delete(url)
+        moved += 1
+    if moved:
+        logging.info("Migrated %d cached images to digest names.", moved)
+    return moved
+
+
+class Prefetcher(object):
+    """Runs image jobs on a bounded thread pool, at most one per key.
+
+    Callers submitting a key that is already in flight share its future."""
+
+    def __init__(self, max_workers):
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix='imagecache')
+        self._lock = threading.Lock()
+        self._pending = {}
+
+    def Submit(self, key, fn, *args):
+        with self._lock:
+            future = self._pending.get(key)
+            if future is not None:
+                return future
+            future = self._executor.submit(fn, *args)
+            self._pending[key] = future
+        future.add_done_callback(lambda _: self._Done(key))
+        return future
+
+    def _Done(self, key):
+        with self._lock:
+            self._pending.pop(key, None)
+
+
+fetcher = Prefetcher(config.kImageFetchWorkers)
+
+
+kUserAgent = 'kansas/1.0 (+https://github.com/)'
+kChunkSize = 64 * 1024
+
+
+class ConnectionPool(object):
+    """Keeps idle keep-alive HTTP(S) connections per host for reuse."""
+
+    def __init__(self, timeout, max_idle=4):
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self._lock = threading.Lock()
+        self._idle = collections.defaultdict(list)
+        self.num_connects = 0
+
+    def _Connect(self, host):
+        self.num_connects += 1
+        scheme, netloc = host
+        if scheme == 'https':
+            return http.client.HTTPSConnection(netloc, timeout=self.timeout)
+        return http.client.HTTPConnection(netloc, timeout=self.timeout)
+
+    def Open(self, url, headers, redirects=5):
+        """Sends a GET for url, following redirects. Returns (host, conn,
+           response); hand them to Release() once done with the response."""
+
+        parts = urllib.parse.urlsplit(url)
+        host = parts.scheme, parts.netloc
+        target = urllib.parse.urlunsplit(
+            ('', '', parts.path or '/', parts.query, ''))
+        with self._lock:
+            conn = self._idle[host] and self._idle[host].pop()
+        reused = bool(conn)
+        if not reused:
+            conn = self._Connect(host)
+        try:
+            conn.request('GET', target, headers=headers)
+            resp = conn.getresponse()
+        except (OSError, http.client.HTTPException):
+            conn.close()
+            if not reused:
+                raise
+            # The server may have dropped the idle connection; retry once.
+            conn = self._Connect(host)
+            conn.request('GET', target, headers=headers)
+            resp = conn.getresponse()
+        if resp.status in (301, 302, 303, 307, 308) and redirects > 0:
+            location = resp.getheader('Location')
+            resp.read()
+            self.Release(host, conn, resp)
+            return self.Open(
+                urllib.parse.urljoin(url, location), headers, redirects - 1)
+        return host, conn, resp
+
+    def Release(self, host, conn, resp):
+        if resp.will_close or not resp.isclosed():
+            conn.close()
+            return
+        with self._lock:
+            if len(self._idle[host]) < self.max_idle:
+                self._idle[host].append(conn)
+                return
+        conn.close()
+
+
+pool = ConnectionPool(config.kImageSocketTimeout)
+
+
+def _Stream(resp, path):
+    """Copies resp to path via a temp file, so path is never truncated."""
+
+    deadline = time.time() + config.kImageFetchTimeout
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            while True:
+                chunk = resp.read(kChunkSize)
+                if not chunk:
+                    break
+                if time.time() > deadline:
+                    raise TimeoutError("download exceeded %ds" % config.kImageFetchTimeout)
+                f.write(chunk)
+            os.fchmod(f.fileno(), thumbnails.kFileMode)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def _Fetch(url, path, entry=None):
+    """Downloads url to path. Returns the response's cache validators, or
+       None if the server found entry's validators still current (304)."""
+
+    headers = {'User-Agent': kUserAgent}
+    if entry and entry.get('etag'):
+        headers['If-None-Match'] = entry['etag']
+    if entry and entry.get('last_modified'):
+        headers['If-Modified-Since'] = entry['last_modified']
+    try:
+        host, conn, resp = pool.Open(url, headers)
+    except (OSError, http.client.HTTPException) as e:
+        # Direct connections fail where egress must use the system proxy.
+        logging.warning("Direct GET %s failed, retrying via urllib: %s", url, e)
+        req = urllib.request.Request(url, headers=headers)
+        try:
+            with urllib.request.urlopen(req, timeout=config.kImageSocketTimeout) as resp:
+                _Stream(resp, path)
+                return _Validators(resp)
+        except urllib.error.HTTPError as e:
+            if e.code == 304:
+                return None
+            raise
+    try:
+        if resp.status == 304:
+            resp.read()
+            return None
+        if resp.status != 200:
+            raise urllib.error.HTTPError(
+                url, resp.status, resp.reason, resp.headers, None)
+        _Stream(resp, path)
+        return _Validators(resp)
+    finally:
+        pool.Release(host, conn, resp)
+
+
+def _Validators(resp):
+    return {
+        'etag': resp.headers.get('ETag'),
+        'last_modified': resp.headers.get('Last-Modified'),
+    }
+
+
+def Refresh(url):
+    """Revalidates a cached image with a conditional GET, replacing it and
+       its resized copies if it changed. Returns True if it did."""
+
+    entry = CacheMap.Get(url)
+    if entry is None:
+        return Cached(url) is not None
+    path = os.path.join(config.kCachePath, entry['name'])
+    validators = _Fetch(url, path, entry)
+    if validators is None:
+        logging.debug("not modified: " + url)
+        return False
+    entry.update(validators)
+    CacheMap.Put(url, entry)
+    # Cards link to the resized copies, so each old one is served until its
+    # replacement is renamed over it.
+    thumbnails.service.Generate(path, replace=True).result()
+    return True
 
 
 def CachedIfPresent(url):
@@ -22,7 +272,8 @@ def CachedIfPresent(url):
 
 
 def CachePeek(url):
-    return CacheMap.Get(url)
+    entry = CacheMap.Get(url)
+    return entry and entry['name']
 
 
 def Cached(url, dont_fetch=False):
@@ -44,11 +295,126 @@ def Cached(url, dont_fetch=False):
             return None
 
         logging.info("GET " + url)
-        imgdata = urllib.request.urlopen(url).read()
+        entry = {'name': name, 'atime': time.time()}
+        entry.update(_Fetch(url, path))
+        CacheMap.Put(url, entry)
 
-        with open(path, 'wb') as f:
-            f.write(imgdata)
+    sweeper.Touch(url)
+    return path
 
-        CacheMap.Put(url, name)
 
-    return path
+def _Stem(path):
+    """Returns the path shared by an image and all of its resized copies."""
+
+    return os.path.splitext(path)[0].split('@', 1)[0]
+
+
+class CacheSweeper(threading.Thread):
+    """Evicts least recently used images once the cache exceeds its budget.
+
+    Access times are buffered in memory and written to CacheMap on each
+    sweep. Images reported by a pin source are never evicted."""
+
+    def __init__(self, interval):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._accessed = {}
+        self._pin_sources = []
+        self.num_evicted = 0
+
+    def Touch(self, url):
+        with self._lock:
+            self._accessed[url] = time.time()
+
+    def AddPinSource(self, fn):
+        """Registers fn, which returns the cache paths that are in use."""
+
+        self._pin_sources.append(fn)
+
+    def _FlushAccessTimes(self):
+        with self._lock:
+            accessed, self._accessed = self._accessed, {}
+        with CacheMap.Batch() as batch:
+            for url, atime in accessed.items():
+                entry = CacheMap.Get(url)
+                if entry is not None:
+                    entry['atime'] = atime
+                    batch.Put(url, entry)
+
+    def _Groups(self):
+        """Returns {stem: group} describing every image on disk."""
+
+        groups = {}
+        for root, _, files in os.walk(config.kCachePath):
+            for f in files:
+                if f.endswith('.tmp'):
+                    continue
+                path = os.path.join(root, f)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                group = groups.setdefault(_Stem(path), {
+                    'files': [], 'bytes': 0, 'atime': 0, 'url': None})
+                group['files'].append(path)
+                group['bytes'] += st.st_size
+                group['atime'] = max(group['atime'], st.st_mtime)
+        for url, entry in CacheMap:
+            group = groups.get(_Stem(os.path.join(config.kCachePath, entry['name'])))
+            if group is not None:
+                group['url'] = url
+                group['atime'] = entry['atime']
+        return groups
+
+    def Sweep(self, max_bytes=None, max_files=None):
+        """Evicts images until the cache fits its budget. Returns the number
+           of images evicted."""
+
+        if max_bytes is None:
+            max_bytes = config.kCacheMaxBytes
+        if max_files is None:
+            max_files = config.kCacheMaxFiles
+        self._FlushAccessTimes()
+        groups = self._Groups()
+        total_bytes = sum(g['bytes'] for g in groups.values())
+        total_files = sum(len(g['files']) for g in groups.values())
+        if total_bytes <= max_bytes and total_files <= max_files:
+            return 0
+        pinned = set()
+        for fn in self._pin_sources:
+            pinned.update(_Stem(p) for p in fn() if p.startswith(config.kCachePath))
+        victims = sorted(
+            (g['atime'], stem) for stem, g in groups.items() if stem not in pinned)
+        evicted = 0
+        with CacheMap.Batch() as batch:
+            for _, stem in victims:
+                if total_bytes <= max_bytes and total_files <= max_files:
+                    break
+                group = groups[stem]
+                for path in group['files']:
+                    try:
+                        os.unlink(path)
+                    except OSError as e:
+                        logging.warning("Failed to evict %s: %s", path, e)
+                if group['url'] is not None:
+                    batch.Delete(group['url'])
+                total_bytes -= group['bytes']
+                total_files -= len(group['files'])
+                evicted += 1
+        self.num_evicted += evicted
+        logging.info("Evicted %d images, cache now %d bytes in %d files.",
+                     evicted, total_bytes, total_files)
+        return evicted
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.Sweep()
+            except Exception as e:
+                logging.exception(e)
+
+
+sweeper = CacheSweeper(config.kCacheSweepInterval)
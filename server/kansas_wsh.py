@@ -1,13 +1,20 @@
 # Implementation of Kansas websocket handler.
 
+from server import codec
 from server import config
 from server import datasource
 from server import imagecache
 from server import namespaces
+from server import ratelimit
+from server import thumbnails
 
+import atexit
 import collections
+import concurrent.futures
 import copy
-import json
+import functools
+import heapq
+import itertools
 import logging
 import os
 import random
@@ -17,28 +24,26 @@ import html
 import urllib.parse
 import traceback
 
-try:
-    from PIL import Image
-    haveImaging = True
-except ImportError:
-    try:
-        import Image  # type: ignore
-        haveImaging = True
-    except ImportError:
-        logging.info("Failed to import imaging module.")
-        haveImaging = False
-
-
-Games = namespaces.Namespace(config.kDBPath, 'Games', version=2)
+Games = namespaces.Namespace(config.kGameDBPath, 'Games', version=2)
 ClientDB = namespaces.Namespace(config.kDBPath, 'ClientDB', version=2)
 GlobalDB = namespaces.Namespace(config.kDBPath, 'Global', version=0)
+GameJournal = namespaces.Namespace(config.kGameDBPath, 'GameJournal', version=0)
 DEBUG_VERBOSE = os.environ.get("KANSAS_DEBUG", "").lower() in ("1", "true", "yes", "on")
 
+# When several processes serve games (see shard.py), a function of
+# (scope, sourceid, gameid) telling whether this process owns the game.
+owns_game = None
+
 
 def SubspaceKey(scope, sourceid):
     return "%s::%s" % (scope, sourceid)
 
 
+def JournalKey(seqno):
+    # Zero-padded so that journal keys iterate in seqno order.
+    return "%016d" % seqno
+
+
 class KansasRedirect(Exception):
     def __init__(self, msg, url):
         Exception.__init__(self, msg)
@@ -53,6 +58,7 @@ BLANK_DECK = {
     'orientations': {},
     'urls_small': {},
     'urls': {},
+    'urls_variants': {},
     'back_urls': {},
     'titles': {}
 }
@@ -61,6 +67,10 @@ BLANK_DECK = {
 class CachingLoader(dict):
     def __init__(self, values):
         dict.__init__(self, copy.deepcopy(values))
+        self.setdefault('urls_variants', {})
+        for key in ['urls', 'urls_small']:
+            for card, path in self[key].items():
+                self[key][card] = imagecache.Relocated(path)
         if self['urls']:
             self.highest_id = max(self['urls'].keys())
         else:
@@ -69,40 +79,69 @@ class CachingLoader(dict):
         # The cached files are assumed served from this path by another server.
         self['resource_prefix'] = config.kServingPrefix
 
-    def new_card(self, front_url):
-        """Returns id of new card."""
+    def new_card(self, front_url, paths=None):
+        """Returns id of new card.
+
+        paths is the (url, small url, variants) triple from cached_paths().
+        Without it the card shows front_url until localize() is done."""
 
         self.highest_id += 1
         new_id = self.highest_id
-        large_path = self['urls'][new_id] = self.download(front_url)
-        small_path = os.path.join(
-            config.kCachePath,
-            os.path.basename(large_path)[:-4]
-                + ('@%dx%d.jpg' % config.kSmallImageSize))
-        if not os.path.exists(small_path):
-            small_path = self.resize(large_path, small_path)
-        self['urls_small'][new_id] = small_path
+        if paths is None:
+            url = urllib.parse.unquote(front_url)
+            paths = url, url, {}
+        self.set_paths(new_id, paths)
         self['orientations'][new_id] = -1
         return new_id
 
+    def set_paths(self, card, paths):
+        (self['urls'][card],
+         self['urls_small'][card],
+         self['urls_variants'][card]) = paths
+
+    def _paths(self, large_path, variants):
+        if not variants:
+            return large_path, large_path, {}
+        return (large_path,
+                variants.get('small', {}).get('jpg', large_path),
+                variants)
+
+    def cached_paths(self, front_url):
+        """Returns local paths as for new_card(), or None if not cached yet."""
+
+        large_path = imagecache.Cached(
+            urllib.parse.unquote(front_url), dont_fetch=True)
+        if large_path is None:
+            return None
+        if not thumbnails.haveImaging:
+            return self._paths(large_path, {})
+        variants = {}
+        for name, paths in thumbnails.VariantPaths(large_path).items():
+            if not os.path.exists(paths['jpg']):
+                return None
+            # Other formats may have failed to save; JPEG stands in for them.
+            variants[name] = {
+                fmt: p for fmt, p in paths.items() if os.path.exists(p)}
+        return self._paths(large_path, variants)
+
+    def localize(self, front_url):
+        """Downloads front_url and generates its thumbnails, returning local
+           paths as for new_card()."""
+
+        large_path = self.download(front_url)
+        variants = thumbnails.service.Generate(large_path).result()
+        return self._paths(large_path, variants)
+
     def download(self, suffix):
         url = urllib.parse.unquote(suffix)
         return imagecache.Cached(url)
 
-    def resize(self, large_path, small_path):
-        """Resizes image found at large_path and saves to small_path."""
-        if haveImaging:
-            logging.info("Resize %s -> %s" % (large_path, small_path))
-            Image.open(large_path)\
-                 .resize(config.kSmallImageSize, Image.ANTIALIAS)\
-                 .save(small_path)
-            return small_path
-        else:
-            return large_path
-
 
 class JSONOutput(object):
-    """JSONOutput is a convenience class for working with websocket streams."""
+    """JSONOutput is a convenience class for working with websocket streams.
+
+    Replies are encoded with the stream's codec, JSON unless the client
+    negotiated another in set_scope."""
 
     def __init__(self, stream, reqtype, future_id):
         self.stream = stream
@@ -112,13 +151,27 @@ class JSONOutput(object):
 
     def reply(self, datum):
         self.replied = True
-        self.stream.send_message(
-            json.dumps({
-                'type': self.reqtype + '_resp',
-                'data': datum,
-                'time': time.time(),
-                'future_id': self.future_id,
-            }), binary=False)
+        codec.send(self.stream, {
+            'type': self.reqtype + '_resp',
+            'data': datum,
+            'time': time.time(),
+            'future_id': self.future_id,
+        })
+
+
+def copy_game_data(data):
+    """Copies game data deeply enough to pickle it outside the game lock.
+
+    Card stacks are copied, since moves change them in place; urls and the
+    other leaf values are only ever replaced."""
+
+    copied = {}
+    for key, value in data.items():
+        if isinstance(value, dict):
+            value = {k: list(v) if isinstance(v, list) else v
+                     for k, v in value.items()}
+        copied[key] = value
+    return copied
 
 
 class KansasGameState(object):
@@ -133,7 +186,7 @@ class KansasGameState(object):
         self.gc()
 
     def gc(self):
-        for s in ['orientations', 'urls_small', 'urls']:
+        for s in ['orientations', 'urls_small', 'urls', 'urls_variants']:
             for card in list(self.data[s].keys()):
                 if not self.containsCard(card):
                     del self.data[s][card]
@@ -199,9 +252,9 @@ class KansasGameState(object):
         if len(self.data[loc_type][loc]) == 0:
             del self.data[loc_type][loc]
         
-    def add_card(self, card):
-        tohand = card.get('tohand')
-        loc = card['loc']
+    def find_url(self, card):
+        """Returns the image url for a card payload, or None if not found."""
+
         name = " ".join(str(card.get('name', '')).split())
         if not name:
             logging.warning("Skipping add of unnamed card payload: %s", card)
@@ -210,23 +263,40 @@ class KansasGameState(object):
         if not stream:
             stream, _ = datasource.Find(self.sourceid, name, exact=False, limit=1)
         if stream:
-            url = stream[0]['img_url']
-        else:
-            logging.warning("Cannot find card '%s' for source '%s'", name, self.sourceid)
-            return None
-        card_id = self.data.new_card(url)
+            return stream[0]['img_url']
+        logging.warning("Cannot find card '%s' for source '%s'", name, self.sourceid)
+        return None
+
+    def add_card(self, card, url, paths=None):
+        tohand = card.get('tohand')
+        loc = card['loc']
+        card_id = self.data.new_card(url, paths)
         if tohand:
             key = 'hands'
         else:
             key = 'board'
+        self.place_card(card_id, key, loc)
+        if tohand:
+            self.data['orientations'][card_id] = 1
+        return card_id
+
+    def place_card(self, card_id, key, loc):
         if loc in self.data[key]:
             self.data[key][loc].append(card_id)
         else:
             self.data[key][loc] = [card_id]
         self.index[card_id] = (key, loc)
-        if tohand:
-            self.data['orientations'][card_id] = 1
-        return card_id
+
+    def restore_card(self, entry):
+        """Re-creates a card from the bulk_add entry describing it."""
+
+        card_id = entry['id']
+        key, loc = entry['pos']
+        self.data.set_paths(card_id, (
+            entry['url'], entry['small_url'], entry.get('variants', {})))
+        self.data['orientations'][card_id] = entry['orient']
+        self.data.highest_id = max(self.data.highest_id, card_id)
+        self.place_card(card_id, key, loc)
     
 
 class KansasHandler(object):
@@ -235,6 +305,7 @@ class KansasHandler(object):
 
     def __init__(self):
         self._lock = threading.RLock()
+        self.scope = None
         self.handlers = {}
         self.handlers['ping'] = self.handle_ping
         self.handlers['keepalive'] = self.handle_keepalive
@@ -249,9 +320,10 @@ class KansasHandler(object):
         sourceid = request['sourceid']
         clientdb = ClientDB.Subspace(SubspaceKey(scope, sourceid))
         games = Games.Subspace(SubspaceKey(scope, sourceid))
+        limit = request.get('limit')
         output.reply({
-            'decks': clientdb.List(),
-            'games': games.List(),
+            'decks': list(clientdb.Keys(limit, request.get('start_after'))),
+            'games': list(games.Keys(limit, request.get('start_after'))),
         })
 
     def handle_clone_scope(self, request, output):
@@ -264,10 +336,11 @@ class KansasHandler(object):
             for sourcetype in datasource.AllSources():
                 src_space = db.Subspace(SubspaceKey(src, sourcetype))
                 dest_space = db.Subspace(SubspaceKey(dest, sourcetype))
-                for k, _ in dest_space:
-                    dest_space.Delete(k)
-                for k, v in src_space:
-                    dest_space.Put(k, v)
+                with dest_space.Batch() as batch:
+                    for k in dest_space.Keys():
+                        batch.Delete(k)
+                    for k, v in src_space:
+                        batch.Put(k, v)
 
     def handle_ping(self, request, output):
         logging.debug("served ping")
@@ -317,7 +390,7 @@ class KansasHandler(object):
             logging.info("Trying inexact match")
             stream, meta = datasource.Find(
                 request['datasource'], request['_RAW']['term'], exact=False,
-                limit=lim)
+                limit=lim, explain=bool(request.get('explain')))
         else:
             logging.info("Trying exact match")
             stream, meta = datasource.Find(
@@ -341,11 +414,20 @@ class KansasHandler(object):
         """Callback for when a stream has been closed."""
         pass
 
+    def admit(self, reqtype, stream):
+        """Raises ratelimit.RetryLater if stream or its scope has used up its
+           budget for reqtype."""
+
+        connection_limits.check(stream, reqtype)
+        if self.scope is not None:
+            scope_limits.check(self.scope, reqtype)
+
     def transition(self, reqtype, request, output):
         """Returns the handler instance that should serve future requests."""
 
         if reqtype in self.handlers:
             logging.debug("serving %s", reqtype)
+            self.admit(reqtype, output.stream)
             self.handlers[reqtype](request, output)
         else:
             logging.warning("%s: Unexpected request type '%s'" % (self, reqtype))
@@ -369,6 +451,19 @@ class KansasInitHandler(KansasHandler):
                 count += handler.presence_count()
         return count
 
+    def image_paths(self):
+        """Returns the image paths referenced by every live game."""
+
+        paths = set()
+        with self._lock:
+            spaces = list(self.spaces.values())
+        for space in spaces:
+            with space._lock:
+                games = list(space.games.values())
+            for game in games:
+                paths.update(game.image_paths())
+        return paths
+
     def presence_breakdown(self):
         stats = {}
         with self._lock:
@@ -389,9 +484,13 @@ class KansasInitHandler(KansasHandler):
             if (scope, sourceid) not in self.spaces:
                 self.spaces[scope, sourceid] = KansasSpaceHandler(scope, sourceid)
 
+        wire = codec.negotiate(request.get('wire'))
         output.reply({
-            'client_version_required': config.kClientVersion
+            'client_version_required': config.kClientVersion,
+            'wire': wire.name,
         })
+        # Messages after the reply use the negotiated format.
+        codec.set_codec(output.stream, wire)
 
     def transition(self, reqtype, request, output):
         if reqtype == 'set_scope':
@@ -406,7 +505,7 @@ class KansasInitHandler(KansasHandler):
 class KansasSpaceHandler(KansasHandler):
     """The request handler created for Kansas scope."""
 
-    MAX_GAMES = 5
+    MAX_GAMES = config.kMaxGamesPerScope
 
     def __init__(self, scope, sourceid):
         KansasHandler.__init__(self)
@@ -419,9 +518,12 @@ class KansasSpaceHandler(KansasHandler):
         self.games = {}
         self.ScopedGames = Games.Subspace(self.subspaceKey)
         for gameid, snapshot in self.ScopedGames:
+            if owns_game is not None and not owns_game(scope, sourceid, gameid):
+                continue
             logging.debug("Restoring %s as %s" % (gameid, str(snapshot)))
             game = self.new_game(gameid)
             game.restore(snapshot)
+            game.replay_journal()
             self.games[gameid] = game
             
 
@@ -458,6 +560,7 @@ class KansasSpaceHandler(KansasHandler):
                 resp.append({
                     'gameid': gameid,
                     'presence': handler.presence_count(),
+                    'last_used': handler.last_used,
                     'orients': list(orients)})
             output.reply(resp)
 
@@ -505,9 +608,9 @@ class KansasSpaceHandler(KansasHandler):
             else:
                 game = self.new_game(request['gameid'])
                 self.games[request['gameid']] = game
-                game.save()
+                game.write_snapshot()
             game.add_stream(output.stream, presence)
-            game.notify_presence()
+            game.notify_presence(output.stream)
 
         # Atomically registers the player with the game handler.
         with game._lock:
@@ -533,6 +636,7 @@ class KansasGameHandler(KansasHandler):
         self._seqno = 1000
         self._state = KansasGameState(sourceid=sourceid)
         self.gameid = gameid
+        self.scope = scope
         self.subspaceKey = SubspaceKey(scope, sourceid)
         self.handlers['broadcast'] = self.handle_broadcast
         self.handlers['bulkmove'] = self.handle_bulkmove
@@ -543,36 +647,203 @@ class KansasGameHandler(KansasHandler):
         self.handlers['samplecards'] = self.handle_samplecards
         self.ScopedClientDB = ClientDB.Subspace(self.subspaceKey)
         self.ScopedGames = Games.Subspace(self.subspaceKey)
+        self.ScopedJournal = GameJournal.Subspace(self.subspaceKey).Subspace(gameid)
+        self._journal_ops = 0
+        self._last_snapshot = time.time()
+        # Serializes snapshot writes with each other and with terminate().
+        self._snapshot_lock = threading.Lock()
+        self._saved_seqno = 0
+        self._loading = collections.defaultdict(set)
+        # Moves not yet broadcast, by card, and in the order applied.
+        self._moved = {}
+        self._moved_applied = []
+        self._flush_timer = None
+        self.coalesce_window = config.kMoveCoalesceWindow
+        # Presence changes not yet broadcast: joined players by uuid, and the
+        # uuids of players who left.
+        self._joined = {}
+        self._left = set()
+        self._presence_timer = None
+        self.presence_window = config.kPresenceWindow
         self.streams = {}
         self.sourceid = sourceid
         self.last_used = time.time()
         self.terminated = False
 
     def save(self):
-        logging.info("Saving snapshot of %s." % self.gameid)
-        self.ScopedGames.Put(self.gameid, self.snapshot())
+        """Schedules a snapshot write on the background persister."""
+
+        persister.mark_dirty(self)
+
+    def write_snapshot(self):
+        """Writes a full snapshot and drops the journal entries it covers.
+
+        Only copying the state holds the game lock; pickling and the write
+        happen after, so broadcasts need not wait on the disk."""
+
+        with self._lock:
+            if self.terminated:
+                return False
+            # Journals pending moves first, so none land after the snapshot.
+            self.flush_moves()
+            snapshot = copy_game_data(self._state.data), self._seqno
+            self._journal_ops = 0
+            self._last_snapshot = time.time()
+        with self._snapshot_lock:
+            # terminate() may have run since, and a newer snapshot may have
+            # been written by another thread.
+            if self.terminated or snapshot[1] < self._saved_seqno:
+                return False
+            logging.info("Saving snapshot of %s." % self.gameid)
+            self.ScopedGames.Put(self.gameid, snapshot)
+            self.truncate_journal(snapshot[1])
+            self._saved_seqno = snapshot[1]
+            return True
+
+    def journal(self, op, payload):
+        """Appends an op to the game's journal under the current seqno.
+
+        The journal is compacted into a snapshot every kJournalCompactOps ops
+        or kJournalCompactSeconds seconds, whichever comes first."""
+
+        with self._lock:
+            self.ScopedJournal.Put(JournalKey(self._seqno), (op, payload))
+            self._journal_ops += 1
+            if (self._journal_ops >= config.kJournalCompactOps
+                    or time.time() - self._last_snapshot
+                        > config.kJournalCompactSeconds):
+                self.save()
+
+    def truncate_journal(self, seqno=None):
+        """Deletes journal entries up to seqno, or all of them if None."""
+
+        with self.ScopedJournal.Batch() as batch:
+            for key in self.ScopedJournal.Keys():
+                if seqno is not None and int(key) > seqno:
+                    break
+                batch.Delete(key)
+
+    def replay_journal(self):
+        """Applies journaled ops newer than the restored snapshot."""
+
+        with self._lock:
+            for key, (op, payload) in self.ScopedJournal:
+                seqno = int(key)
+                if seqno <= self._seqno:
+                    continue
+                try:
+                    self.apply_op(op, payload)
+                except Exception as e:
+                    logging.exception(e)
+                    logging.warning("Ignoring bad journal entry %s: %s", key, op)
+                self._seqno = seqno
+                self._journal_ops += 1
+            if self._journal_ops:
+                logging.info("Replayed %d ops onto %s.",
+                             self._journal_ops, self.gameid)
+
+    def apply_op(self, op, payload):
+        if op == 'bulkmove':
+            for move in payload:
+                self.apply_move(move)
+        elif op == 'add':
+            for entry in payload:
+                self._state.restore_card(entry)
+            self._state.initializeStacks()
+        elif op == 'remove':
+            for card in payload:
+                if self._state.containsCard(card):
+                    self._state.remove_card(card)
+            self._state.gc()
+        elif op == 'urls':
+            for entry in payload:
+                if self._state.containsCard(entry['id']):
+                    self._state.data.set_paths(entry['id'], (
+                        entry['url'], entry['small_url'], entry['variants']))
+        else:
+            raise Exception("invalid journal op '%s'" % op)
 
     def add_stream(self, stream, presence_info):
         self.streams[stream] = presence_info
         self.streams[stream]['last_keepalive'] = time.time()
+        reaper.watch(self, stream)
+        # Streams with outbound queues replace dropped updates with this.
+        if hasattr(stream, 'set_resync'):
+            stream.set_resync(
+                functools.partial(self.resync_message, stream), self._lock)
+        uuid = presence_info.get('uuid')
+        self._left.discard(uuid)
+        self._joined[uuid] = presence_info
+        self.schedule_presence()
+
+    def remove_stream(self, stream):
+        """Forgets stream, returning False if it was already gone."""
+
+        with self._lock:
+            info = self.streams.pop(stream, None)
+            if info is None:
+                return False
+            uuid = info.get('uuid')
+            # Players may be connected from several streams at once.
+            if not any(p.get('uuid') == uuid for p in self.streams.values()):
+                self._joined.pop(uuid, None)
+                self._left.add(uuid)
+                self.schedule_presence()
+            return True
+
+    def resync_message(self, stream):
+        """Returns an encoded snapshot for a client that missed updates."""
+
+        with self._lock:
+            return codec.for_stream(stream).encode({
+                'type': 'resync',
+                'data': self.snapshot(),
+                'time': time.time(),
+            })
 
     def handle_bulkmove(self, req, output):
         with self._lock:
             logging.info("Starting bulk move.")
-            updatebuffer = collections.defaultdict(list)
             for move in req['moves']:
                 try:
-                    dest_t = move['dest_type']
-                    dest_k = move['dest_key']
+                    card = move['card']
                     src_type, src_key, seqno = self.apply_move(move)
-                    updatebuffer[dest_t, dest_k].append({
+                    self._moved_applied.append(move)
+                    # Clients only need each card's final move, relative to
+                    # where they last saw the card.
+                    pending = self._moved.pop(card, None)
+                    if pending is not None:
+                        src_type, src_key = pending['old_type'], pending['old_key']
+                    self._moved[card] = {
                         'move': move,
                         'old_type': src_type,
                         'old_key': src_key,
-                    })
+                    }
                 except Exception as e:
                     logging.exception(e);
                     logging.warning("Ignoring bad move: " + str(move));
+            if self.coalesce_window <= 0:
+                self.flush_moves()
+            elif self._moved and self._flush_timer is None:
+                self._flush_timer = threading.Timer(
+                    self.coalesce_window, self.flush_moves)
+                self._flush_timer.daemon = True
+                self._flush_timer.start()
+
+    def flush_moves(self):
+        """Broadcasts and journals the moves made since the last flush, as
+           one bulkupdate carrying the final z_stack of each destination."""
+
+        with self._lock:
+            if self._flush_timer is not None:
+                self._flush_timer.cancel()
+                self._flush_timer = None
+            if not self._moved_applied:
+                return
+            updatebuffer = collections.defaultdict(list)
+            for update in self._moved.values():
+                move = update['move']
+                updatebuffer[move['dest_type'], move['dest_key']].append(update)
             msg = []
             for (dest_t, dest_k), updates in updatebuffer.items():
                 msg.append({
@@ -581,8 +852,13 @@ class KansasGameHandler(KansasHandler):
                     'updates': updates,
                     'z_stack': self._state.data[dest_t][dest_k],
                 })
+            applied = self._moved_applied
+            self._moved = {}
+            self._moved_applied = []
+            if self.terminated:
+                return
             self.broadcast(set(self.streams.keys()), 'bulkupdate', msg)
-            self.save()
+            self.journal('bulkmove', applied)
 
     def handle_broadcast(self, req, output):
         with self._lock:
@@ -598,6 +874,7 @@ class KansasGameHandler(KansasHandler):
 
     def handle_remove(self, req, output):
         with self._lock:
+            self.flush_moves()
             removed = set()
             for card in req:
                 if self._state.containsCard(card):
@@ -607,23 +884,35 @@ class KansasGameHandler(KansasHandler):
             self.broadcast(
                 set(self.streams.keys()),
                 'bulk_remove', list(removed))
-        self.save()
+            if removed:
+                self.nextseqno()
+                self.journal('remove', list(removed))
         output.reply("done")
 
     def handle_add(self, req, output):
+        requested = len(req.get('cards', []))
+        requestor = req['requestor']
+        # Card lookups may go upstream, so they happen without the lock held.
+        found = []
+        for card in req['cards']:
+            url = self._state.find_url(card)
+            if url is not None:
+                found.append((card, url, self._state.data.cached_paths(url)))
         with self._lock:
+            self.flush_moves()
             added = []
-            requested = len(req.get('cards', []))
-            requestor = req['requestor']
-            for card in req['cards']:
-                new_id = self._state.add_card(card)
-                if new_id is None:
-                    continue
+            fetches = set()
+            for card, url, paths in found:
+                new_id = self._state.add_card(card, url, paths)
+                if paths is None:
+                    self._loading[url].add(new_id)
+                    fetches.add(url)
                 added.append({
                     'id': new_id,
                     'orient': self._state.data['orientations'][new_id],
                     'url': self._state.data['urls'][new_id],
                     'small_url': self._state.data['urls_small'][new_id],
+                    'variants': self._state.data['urls_variants'][new_id],
                     'pos': self._state.index[new_id],
                 })
             self._state.initializeStacks()
@@ -633,12 +922,47 @@ class KansasGameHandler(KansasHandler):
                     'cards': added,
                     'requestor': requestor,
                 })
-            self.save()
+            if added:
+                self.nextseqno()
+                self.journal('add', added)
+        for url in fetches:
+            future = imagecache.fetcher.Submit(
+                url, self._state.data.localize, url)
+            future.add_done_callback(functools.partial(self.on_localized, url))
         output.reply({
             'added': len(added),
             'requested': requested,
         })
 
+    def on_localized(self, url, future):
+        """Points cards waiting on url at their local copies once fetched."""
+
+        try:
+            paths = future.result()
+        except Exception as e:
+            logging.exception(e)
+            logging.warning("Keeping remote image for %s", url)
+            with self._lock:
+                self._loading.pop(url, None)
+            return
+        with self._lock:
+            updates = []
+            for card in self._loading.pop(url, ()):
+                if not self._state.containsCard(card):
+                    continue
+                self._state.data.set_paths(card, paths)
+                updates.append({
+                    'id': card,
+                    'url': paths[0],
+                    'small_url': paths[1],
+                    'variants': paths[2],
+                })
+            if not updates or self.terminated:
+                return
+            self.broadcast(set(self.streams.keys()), 'bulk_urls', updates)
+            self.nextseqno()
+            self.journal('urls', updates)
+
     def handle_samplecards(self, req, output):
         output.reply(datasource.Sample(self.sourceid))
     
@@ -653,9 +977,7 @@ class KansasGameHandler(KansasHandler):
         elif op == 'Get':
             resp = ns.Get(req['key'])
         elif op == 'List':
-            resp = []
-            for k, _ in ns:
-                resp.append(k)
+            resp = list(ns.Keys(req.get('limit'), req.get('start_after')))
         else:
             raise Exception("invalid kvop")
         output.reply({'req': req, 'resp': resp})
@@ -676,17 +998,24 @@ class KansasGameHandler(KansasHandler):
         logging.info("Terminating game.")
         with self._lock:
             self.terminated = True
-            self.ScopedGames.Delete(self.gameid)
-            msg = "This game has been ended."
+            self.flush_moves()
+            self.flush_presence()
+            persister.discard(self)
+            with self._snapshot_lock:
+                self.ScopedGames.Delete(self.gameid)
+                self.truncate_journal()
+            message = {
+                'type': 'redirect',
+                'msg': "This game has been ended.",
+                'url': "/",
+            }
+            encoded = {}
             for s in self.streams:
                 try:
-                    s.send_message(
-                       json.dumps({
-                            'type': 'redirect',
-                            'msg': msg,
-                            'url': "/",
-                       }),
-                       binary=False)
+                    wire = codec.for_stream(s)
+                    if wire not in encoded:
+                        encoded[wire] = wire.encode(message)
+                    s.send_message(encoded[wire], binary=wire.binary)
                     s.close_connection(wait_response=False)
                 except Exception as e:
                     logging.exception(e)
@@ -701,60 +1030,100 @@ class KansasGameHandler(KansasHandler):
         logging.info("Broadcasting %s", reqtype)
         start = time.time()
         self.last_used = start
-        presence_changed = False
+        # Recipients using the same codec get the same encoded payload.
+        message = {
+            'type': reqtype,
+            'data': data,
+            'time': start,
+        }
+        encoded = {}
         for stream in streamSet:
             try:
-                stream.send_message(
-                    json.dumps({
-                        'type': reqtype,
-                        'data': data,
-                        'time': time.time(),
-                    }),
-                    binary=False)
+                wire = codec.for_stream(stream)
+                if wire not in encoded:
+                    encoded[wire] = wire.encode(message)
+                stream.send_message(encoded[wire], binary=wire.binary)
             except Exception as e:
                 logging.exception(e)
                 logging.warning("Removing broken stream %s", stream)
-                presence_changed = True
-                del self.streams[stream]
+                self.remove_stream(stream)
         logging.info("Broadcast took %.2fms" % (1000*(time.time() - start)))
-        if presence_changed:
-            self.notify_presence()
 
-    def gc_streams(self):
+    def expire_stream(self, stream, now, timeout):
+        """Closes stream if its last keepalive is over timeout seconds old.
+           Returns when it next expires, or None once it is gone."""
+
         with self._lock:
-            for stream in list(self.streams.keys()):
-                last = self.streams[stream]['last_keepalive']
-                if time.time() - last > 60:
-                    try:
-                        del self.streams[stream]
-                        stream.close_connection(wait_response=False)
-                    except Exception as e:
-                        logging.exception(e)
+            info = self.streams.get(stream)
+            if info is None:
+                return None
+            deadline = info['last_keepalive'] + timeout
+            if deadline > now:
+                return deadline
+            logging.info("Keepalive expired for %s", stream)
+            self.remove_stream(stream)
+        try:
+            stream.close_connection(wait_response=False)
+        except Exception as e:
+            logging.exception(e)
+        return None
 
     def presence_count(self):
-        with self._lock:
-            self.gc_streams()
-            return len(self.streams)
+        return len(self.streams)
 
     def presence_breakdown(self):
         with self._lock:
-            self.gc_streams()
             return list(self.streams.values())
 
-    def notify_presence(self):
+    def image_paths(self):
         with self._lock:
-            self.broadcast(
-                set(self.streams.keys()),
-                'presence',
-                list(self.streams.values()))
+            data = self._state.data
+            paths = set(data['urls'].values())
+            paths.update(data['urls_small'].values())
+            for variants in data['urls_variants'].values():
+                for by_format in variants.values():
+                    paths.update(by_format.values())
+            return paths
+
+    def notify_presence(self, stream):
+        """Sends the full presence list to a newly connected stream."""
 
-    def notify_closed(self, stream):
         with self._lock:
-            if stream in self.streams:
-                del self.streams[stream]
-                self.notify_presence()
-            else:
-                logging.warning("Stream already closed.")
+            self.broadcast({stream}, 'presence', list(self.streams.values()))
+
+    def schedule_presence(self):
+        with self._lock:
+            if self.presence_window <= 0:
+                self.flush_presence()
+            elif self._presence_timer is None:
+                self._presence_timer = threading.Timer(
+                    self.presence_window, self.flush_presence)
+                self._presence_timer.daemon = True
+                self._presence_timer.start()
+
+    def flush_presence(self):
+        """Broadcasts the joins and leaves since the last flush as one
+           presence_delta, keyed by uuid."""
+
+        with self._lock:
+            if self._presence_timer is not None:
+                self._presence_timer.cancel()
+                self._presence_timer = None
+            if not self._joined and not self._left:
+                return
+            delta = {
+                'joined': list(self._joined.values()),
+                'left': list(self._left),
+            }
+            self._joined = {}
+            self._left = set()
+            if self.terminated:
+                return
+            self.broadcast(set(self.streams.keys()), 'presence_delta', delta)
+
+    def notify_closed(self, stream):
+        if not self.remove_stream(stream):
+            logging.warning("Stream already closed.")
 
     def apply_move(self, move):
         """Applies move and increments seqno, returning True on success."""
@@ -785,81 +1154,428 @@ class BackgroundStats(threading.Thread):
                 old_count = count
                 self.logger.info("%d online users", count)
                 self.logger.info("presence: %s", self.target.presence_breakdown())
+                self.logger.info("snapshots: %s", persister.stats())
+
+
+class BackgroundPersister(threading.Thread):
+    """Writes snapshots of dirty games off the request path. Repeated saves
+       of a game within one flush interval coalesce into a single write."""
+
+    def __init__(self, interval):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._dirty = {}
+        self.num_marked = 0
+        self.num_coalesced = 0
+        self.num_written = 0
+
+    def mark_dirty(self, game):
+        with self._lock:
+            self.num_marked += 1
+            if game in self._dirty:
+                self.num_coalesced += 1
+            else:
+                self._dirty[game] = True
+
+    def discard(self, game):
+        with self._lock:
+            self._dirty.pop(game, None)
+
+    def flush(self):
+        """Writes every dirty game now."""
+
+        with self._lock:
+            dirty, self._dirty = self._dirty, {}
+        for game in dirty:
+            try:
+                if game.write_snapshot():
+                    with self._lock:
+                        self.num_written += 1
+            except Exception as e:
+                logging.exception(e)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'marked': self.num_marked,
+                'coalesced': self.num_coalesced,
+                'written': self.num_written,
+                'pending': len(self._dirty),
+            }
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            self.flush()
 
 
+class KeepaliveReaper(threading.Thread):
+    """Closes streams whose keepalives have stopped, for every game, from
+       one heap of deadlines. Each stream has a single entry; when it comes
+       due the stream is either closed or, if it has sent a keepalive since,
+       pushed back under its new deadline."""
+
+    def __init__(self, timeout):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.timeout = timeout
+        self._cond = threading.Condition()
+        self._heap = []
+        self._order = itertools.count()
+
+    def watch(self, game, stream, deadline=None):
+        if deadline is None:
+            deadline = time.time() + self.timeout
+        with self._cond:
+            heapq.heappush(
+                self._heap, (deadline, next(self._order), game, stream))
+            self._cond.notify()
+
+    def reap(self, now=None):
+        """Handles every entry due by now."""
+
+        if now is None:
+            now = time.time()
+        due = []
+        with self._cond:
+            while self._heap and self._heap[0][0] <= now:
+                due.append(heapq.heappop(self._heap))
+        for _, _, game, stream in due:
+            try:
+                deadline = game.expire_stream(stream, now, self.timeout)
+            except Exception as e:
+                logging.exception(e)
+                continue
+            if deadline is not None:
+                self.watch(game, stream, deadline)
+
+    def run(self):
+        while True:
+            with self._cond:
+                if not self._heap:
+                    self._cond.wait()
+                elif self._heap[0][0] > time.time():
+                    self._cond.wait(self._heap[0][0] - time.time())
+            self.reap()
+
+
+persister = BackgroundPersister(config.kSnapshotFlushInterval)
+persister.start()
+atexit.register(persister.flush)
+reaper = KeepaliveReaper(config.kKeepaliveTimeout)
+reaper.start()
+
+# Request budgets of each connection and of each scope.
+connection_limits = ratelimit.RateLimiter(
+    config.kConnectionRateLimits, weak=True)
+scope_limits = ratelimit.RateLimiter(config.kScopeRateLimits)
+
 initHandler = KansasInitHandler()
 stats = BackgroundStats(initHandler)
 stats.start()
+imagecache.sweeper.AddPinSource(initHandler.image_paths)
+if config.kCacheSweeper:
+    imagecache.sweeper.start()
+
+
+def stored_image_paths(games=None):
+    """Returns the image paths referenced by every game snapshot stored in
+       games, by default this process's Games."""
 
+    if games is None:
+        games = Games
+    paths = set()
+    for _, (data, _) in games:
+        paths.update(data.get('urls', {}).values())
+        paths.update(data.get('urls_small', {}).values())
+        for variants in data.get('urls_variants', {}).values():
+            for by_format in variants.values():
+                paths.update(by_format.values())
+    return paths
 
-def recursiveEscape(obj):
-    if isinstance(obj, str):
-        return html.escape(obj).replace('"', "'")
-    elif type(obj) is dict:
-        out = {}
-        for k, v in list(obj.items()):
-            out[html.escape(k)] = recursiveEscape(v)
+
+class BadRequest(Exception):
+    """Raised for a request that does not match the schema of its type."""
+
+
+def escape_text(s):
+    return html.escape(s).replace('"', "'")
+
+
+# Request schemas. A schema is a function that checks a decoded value,
+# raising BadRequest if it is malformed, and returns it with its strings
+# escaped. Values with nothing to escape are returned as they are, so most
+# requests are not copied at all.
+
+def Any(value):
+    """Escapes the strings in value, which may be of any shape."""
+
+    if isinstance(value, str):
+        return Text(value)
+    elif type(value) is dict:
+        return Fields()(value)
+    elif type(value) is list:
+        return ListOf(Any)(value)
+    return value
+
+
+def Raw(value):
+    """Passes value through unescaped, for fields handlers read from _RAW."""
+
+    return value
+
+
+def Text(value):
+    if value is None:
+        return None
+    if not isinstance(value, str):
+        raise BadRequest("expected a string, got %r" % (value,))
+    escaped = escape_text(value)
+    return value if escaped == value else escaped
+
+
+def Int(value):
+    # bool is a subclass of int, but true is not card 1.
+    if value is not None and (
+            not isinstance(value, int) or type(value) is bool):
+        raise BadRequest("expected an integer, got %r" % (value,))
+    return value
+
+
+def Bool(value):
+    if value is not None and not isinstance(value, bool):
+        raise BadRequest("expected a boolean, got %r" % (value,))
+    return value
+
+
+def IntOrText(value):
+    if isinstance(value, int):
+        return Int(value)
+    return Text(value)
+
+
+def OneOf(*choices):
+    def check(value):
+        if value not in choices:
+            raise BadRequest("expected one of %s, got %r" % (choices, value))
+        return value
+    return check
+
+
+def ListOf(item):
+    def check(value):
+        if value is None:
+            return None
+        if type(value) is not list:
+            raise BadRequest("expected a list, got %r" % (value,))
+        out = None
+        for i, v in enumerate(value):
+            ev = item(v)
+            if ev is not v and out is None:
+                out = list(value)
+            if out is not None:
+                out[i] = ev
+        return value if out is None else out
+    return check
+
+
+def Tuple(*items):
+    def check(value):
+        if type(value) is not list or len(value) != len(items):
+            raise BadRequest(
+                "expected a list of %d items, got %r" % (len(items), value))
+        out = [item(v) for item, v in zip(items, value)]
+        if all(e is v for e, v in zip(out, value)):
+            return value
         return out
-    elif type(obj) is list:
-        return [recursiveEscape(x) for x in obj]
-    else:
-        return obj
+    return check
+
+
+def Fields(required=(), **fields):
+    """A dict with the given fields. Keys not listed are escaped as Any."""
+
+    def check(value):
+        if type(value) is not dict:
+            raise BadRequest("expected an object, got %r" % (value,))
+        for k in required:
+            if k not in value:
+                raise BadRequest("missing field '%s'" % k)
+        out = None
+        for k, v in value.items():
+            schema = fields.get(k)
+            if schema is None:
+                ek, ev = html.escape(k), Any(v)
+            else:
+                ek, ev = k, schema(v)
+            if out is None and (ek != k or ev is not v):
+                out = {}
+                for k2, v2 in value.items():
+                    if k2 == k:
+                        break
+                    out[k2] = v2
+            if out is not None:
+                out[ek] = ev
+        return value if out is None else out
+    return check
+
+
+MOVE = Fields(
+    required=('card', 'dest_type', 'dest_key', 'dest_orient'),
+    card=Int, dest_type=OneOf('board', 'hands'), dest_key=IntOrText,
+    dest_orient=Int)
+
+# The schema of each request's data. Other requests are escaped as Any.
+REQUEST_SCHEMAS = {
+    'set_scope': Fields(
+        required=('scope', 'datasource'),
+        scope=Text, datasource=Text, wire=Text),
+    'connect': Fields(
+        required=('gameid', 'uuid', 'user', 'orient'),
+        gameid=Text, uuid=Text, user=Text, orient=IntOrText, profile=Any),
+    'end_game': Text,
+    'query': Fields(
+        required=('term',),
+        term=Text, datasource=Text, limit=Int, allow_inexact=Bool,
+        explain=Bool),
+    'bulkquery': Fields(
+        required=('terms',), terms=ListOf(Tuple(Int, Text))),
+    'bulkmove': Fields(required=('moves',), moves=ListOf(MOVE)),
+    'remove': ListOf(Int),
+    'add': Fields(
+        required=('cards', 'requestor'),
+        cards=ListOf(Fields(required=('loc',), name=Text, loc=IntOrText)),
+        requestor=Text),
+    'kvop': Fields(
+        required=('op', 'namespace'),
+        op=OneOf('Put', 'Delete', 'Get', 'List'), namespace=Text, key=Text,
+        value=Raw, limit=Int, start_after=Text),
+    'list_scope': Fields(
+        required=('scope', 'sourceid'),
+        scope=Text, sourceid=Text, limit=Int, start_after=Text),
+    'clone_scope': Fields(required=('src', 'dest'), src=Text, dest=Text),
+}
+# Requests whose handlers also read the data as sent, from its _RAW key.
+RAW_REQUESTS = frozenset(['query', 'kvop'])
+
+
+def escape_request(reqtype, data):
+    """Returns the request data checked against its schema and escaped."""
+
+    escaped = REQUEST_SCHEMAS.get(reqtype, Any)(data)
+    if reqtype in RAW_REQUESTS and type(escaped) is dict:
+        escaped = dict(escaped, _RAW=data)
+    return escaped
 
 
 def web_socket_do_extra_handshake(request):
     pass
 
 
+# Requests that only read state. A connection's read-only requests run
+# concurrently with its other requests, which are served in order.
+READ_ONLY_REQUESTS = frozenset(['query', 'bulkquery', 'samplecards'])
+READ_ONLY_KVOPS = frozenset(['Get', 'List'])
+
+readers = concurrent.futures.ThreadPoolExecutor(
+    max_workers=config.kReadOnlyWorkers, thread_name_prefix='kansas-read')
+
+
+def is_read_only(req):
+    reqtype = req.get('type')
+    if reqtype == 'kvop':
+        data = req.get('data')
+        return isinstance(data, dict) and data.get('op') in READ_ONLY_KVOPS
+    return reqtype in READ_ONLY_REQUESTS
+
+
+def decode_request(line):
+    """Returns the request in line, or None if it is malformed."""
+
+    try:
+        req = codec.decode(line)
+    except Exception:
+        return None
+    return isinstance(req, dict) and req or None
+
+
 def web_socket_transfer_data(request):
     """Drives the state machine for each connected client."""
 
     currentHandler = initHandler
+    # Bounds the read-only requests each client may have in flight.
+    reads = threading.BoundedSemaphore(config.kMaxConcurrentReads)
     while True:
         line = request.ws_stream.receive_message()
         if not line:
             logging.info("Socket closed")
             currentHandler.notify_closed(request.ws_stream)
             return
+        req = decode_request(line)
+        if req is not None and is_read_only(req):
+            reads.acquire()
+            future = readers.submit(
+                serve_message, currentHandler, request.ws_stream, req)
+            future.add_done_callback(lambda _: reads.release())
+        else:
+            currentHandler = serve_message(
+                currentHandler, request.ws_stream, req)
+
+
+def serve_message(currentHandler, stream, req):
+    """Serves one inbound message, returning the handler for the next. req
+       is the message as returned by decode_request()."""
+
+    try:
+        if req is None:
+            raise BadRequest("malformed request")
+        if DEBUG_VERBOSE:
+            logging.info("ws recv: %s", req)
+        logging.debug("Parsed json %s", req)
+        logging.debug("Handler %s", type(currentHandler))
+        logging.debug("Request type %s", req['type'])
+        output = JSONOutput(
+            stream,
+            req['type'],
+            req.get('future_id'))
+        data = escape_request(req['type'], req.get('data'))
+        currentHandler = currentHandler.transition(
+            req['type'],
+            data,
+            output)
+        if DEBUG_VERBOSE:
+            logging.info("ws handled type=%s", req['type'])
+    except ratelimit.RetryLater as e:
+        logging.info("Turning away %s: %s", req['type'], e)
+        codec.send(stream, {
+            'type': 'error',
+            'code': 'retry_later',
+            'msg': str(e),
+            'retry_after': e.retry_after,
+            'future_id': req.get('future_id'),
+        })
+    except KansasRedirect as e:
+        logging.info("redirecting to: " + e.url)
+        codec.send(stream, {
+            'type': 'redirect',
+            'msg': str(e),
+            'url': e.url,
+        })
+    except Exception as e:
+        tb = traceback.format_exc()
+        logging.exception(e)
         try:
-            req = json.loads(line)
-            if DEBUG_VERBOSE:
-                logging.info("ws recv: %s", req)
-            logging.debug("Parsed json %s", req)
-            logging.debug("Handler %s", type(currentHandler))
-            logging.debug("Request type %s", req['type'])
-            output = JSONOutput(
-                request.ws_stream,
-                req['type'],
-                req.get('future_id'))
-            data = recursiveEscape(req.get('data'))
-            if type(data) is dict:
-                data['_RAW'] = req.get('data')
-            currentHandler = currentHandler.transition(
-                req['type'],
-                data,
-                output)
-            if DEBUG_VERBOSE:
-                logging.info("ws handled type=%s", req['type'])
-        except KansasRedirect as e:
-            logging.info("redirecting to: " + e.url)
-            request.ws_stream.send_message(
-               json.dumps({
-                    'type': 'redirect',
-                    'msg': str(e),
-                    'url': e.url,
-               }),
-               binary=False)
+            codec.send(stream, {
+                'type': 'error',
+                'msg': str(e),
+                'details': tb,
+                'future_id': req.get('future_id') if isinstance(req, dict) else None,
+            })
         except Exception as e:
-            tb = traceback.format_exc()
-            logging.exception(e)
-            request.ws_stream.send_message(
-               json.dumps({
-                   'type': 'error',
-                   'msg': str(e),
-                   'details': tb,
-                   'future_id': req.get('future_id') if 'req' in locals() and isinstance(req, dict) else None,
-               }),
-               binary=False)
+            # The client may be gone, e.g. before a concurrent read finished.
+            logging.warning("Cannot report error: %s", e)
+    return currentHandler
 
 
 # vim: ts=4 sw=4 et
@@ -1,9 +1,300 @@
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
 from . import kansas_wsh
+from . import namespaces
 
 # TODO unit tests
 class TestJSONResponder: pass
 class TestKansasGameState: pass
 class TestKansasHandler: pass
 class TestKansasInitHandler: pass
-class TestKansasGameHandler: pass
-class TestSocketTransfer: pass
+
+
+class TestSocketTransfer(unittest.TestCase):
+    def test_is_read_only(self):
+        self.assertTrue(kansas_wsh.is_read_only({'type': 'query'}))
+        self.assertTrue(kansas_wsh.is_read_only(
+            {'type': 'kvop', 'data': {'op': 'Get'}}))
+        self.assertFalse(kansas_wsh.is_read_only(
+            {'type': 'kvop', 'data': {'op': 'Put'}}))
+        self.assertFalse(kansas_wsh.is_read_only({'type': 'bulkmove'}))
+
+    def test_decode_request_rejects_malformed_lines(self):
+        self.assertEqual(kansas_wsh.decode_request('{"type": "ping"}'),
+                         {'type': 'ping'})
+        self.assertIsNone(kansas_wsh.decode_request('not json'))
+        self.assertIsNone(kansas_wsh.decode_request('[1]'))
+
+    def test_malformed_request_gets_error(self):
+        stream = mock.Mock()
+        with mock.patch('logging.exception'):
+            handler = kansas_wsh.serve_message(
+                kansas_wsh.initHandler, stream,
+                kansas_wsh.decode_request('not json'))
+        self.assertIs(handler, kansas_wsh.initHandler)
+        reply = kansas_wsh.codec.decode(stream.send_message.call_args[0][0])
+        self.assertEqual((reply['type'], reply['msg']),
+                         ('error', 'malformed request'))
+
+    def test_over_budget_requests_are_told_to_retry(self):
+        limits = kansas_wsh.ratelimit.RateLimiter({'ping': (0.01, 1)}, weak=True)
+        stream = mock.Mock()
+        with mock.patch.object(kansas_wsh, 'connection_limits', limits):
+            for i in range(2):
+                kansas_wsh.serve_message(
+                    kansas_wsh.initHandler, stream,
+                    {'type': 'ping', 'future_id': i})
+        replies = [kansas_wsh.codec.decode(c[0][0])
+                   for c in stream.send_message.call_args_list]
+        self.assertEqual(replies[0]['data'], 'pong')
+        self.assertEqual(replies[1]['code'], 'retry_later')
+        self.assertEqual(replies[1]['future_id'], 1)
+        self.assertGreater(replies[1]['retry_after'], 0)
+
+    def test_bulkmove_is_checked_without_copying(self):
+        moves = [{'card': i, 'dest_type': 'board', 'dest_key': i * 7,
+                  'dest_orient': 1} for i in range(500)]
+        data = {'moves': moves}
+        self.assertIs(kansas_wsh.escape_request('bulkmove', data), data)
+
+    def test_escapes_only_what_needs_it(self):
+        data = {'gameid': 'g1', 'uuid': 'u', 'user': '<b>"Bob"</b>',
+                'orient': 'player1', 'profile': {'url': 'x?a=1&b=2'}}
+        escaped = kansas_wsh.escape_request('connect', data)
+        self.assertEqual(escaped['user'], "&lt;b&gt;&quot;Bob&quot;&lt;/b&gt;")
+        self.assertEqual(escaped['profile'], {'url': 'x?a=1&amp;b=2'})
+        self.assertEqual(data['user'], '<b>"Bob"</b>')
+        self.assertEqual(
+            kansas_wsh.escape_request('broadcast', {'<k>': ['<v>']}),
+            {'&lt;k&gt;': ['&lt;v&gt;']})
+
+    def test_raw_data_kept_for_queries(self):
+        escaped = kansas_wsh.escape_request('query', {'term': 'a&b'})
+        self.assertEqual(escaped['term'], 'a&amp;b')
+        self.assertEqual(escaped['_RAW'], {'term': 'a&b'})
+
+    def test_rejects_malformed_requests(self):
+        for reqtype, data in [
+                ('bulkmove', {'moves': [{'card': '1', 'dest_type': 'board',
+                                         'dest_key': 0, 'dest_orient': 1}]}),
+                ('bulkmove', {'moves': [{'card': 1, 'dest_type': 'sky',
+                                         'dest_key': 0, 'dest_orient': 1}]}),
+                ('bulkmove', {'moves': [{'card': True, 'dest_type': 'board',
+                                         'dest_key': 0, 'dest_orient': False}]}),
+                ('bulkmove', {'moves': [{'card': 1, 'dest_type': 'hands',
+                                         'dest_key': True, 'dest_orient': 1}]}),
+                ('bulkmove', {}),
+                ('remove', 'all'),
+                ('remove', [True]),
+                ('set_scope', {'scope': ['a'], 'datasource': 'pokerdb'})]:
+            with self.assertRaises(kansas_wsh.BadRequest):
+                kansas_wsh.escape_request(reqtype, data)
+
+
+class TestKansasGameHandler(unittest.TestCase):
+    SCOPE = '__test_kansas_wsh__'
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp(prefix='kansas-wsh-')
+        self.patches = [
+            mock.patch.object(kansas_wsh, name, namespaces.Namespace(
+                self.path, ns.name, version=ns.version))
+            for name, ns in [('Games', kansas_wsh.Games),
+                             ('ClientDB', kansas_wsh.ClientDB),
+                             ('GameJournal', kansas_wsh.GameJournal)]]
+        for patch in self.patches:
+            patch.start()
+        self.game = self.new_handler()
+        self.game._state = kansas_wsh.KansasGameState('pokerdb', data=dict(
+            kansas_wsh.BLANK_DECK,
+            board={0: [1, 2, 3]},
+            urls={1: 'a.jpg', 2: 'b.jpg', 3: 'c.jpg'},
+            urls_small={1: 'a.jpg', 2: 'b.jpg', 3: 'c.jpg'}))
+        self.game.write_snapshot()
+
+    def tearDown(self):
+        self.game.terminate()
+        for patch in self.patches:
+            patch.stop()
+        db = namespaces._databases.pop(self.path, None)
+        if db is not None:
+            db.Flush()
+            db.conn.close()
+        namespaces._meta.pop(self.path, None)
+        shutil.rmtree(self.path)
+
+    def new_handler(self):
+        return kansas_wsh.KansasGameHandler('game', self.SCOPE, 'pokerdb')
+
+    def test_journal_replays_onto_snapshot(self):
+        output = mock.Mock()
+        self.game.handle_bulkmove({'moves': [
+            {'card': 1, 'dest_type': 'board', 'dest_key': 5, 'dest_orient': 1},
+            {'card': 3, 'dest_type': 'hands', 'dest_key': 'bob', 'dest_orient': 2},
+        ]}, output)
+        self.game.handle_remove([2], output)
+        entry = {'id': 4, 'orient': -1, 'url': 'd.jpg', 'small_url': 'd.jpg',
+                 'pos': ('board', 5)}
+        with self.game._lock:
+            self.game._state.restore_card(entry)
+            self.game.nextseqno()
+            self.game.journal('add', [entry])
+        self.assertEqual(len(list(self.game.ScopedJournal.Keys())), 3)
+
+        recovered = self.new_handler()
+        recovered.restore(self.game.ScopedGames.Get('game'))
+        recovered.replay_journal()
+        self.assertEqual(recovered._seqno, self.game._seqno)
+        self.assertEqual(recovered._state.index, self.game._state.index)
+        self.assertEqual(recovered._state.data['orientations'],
+                         self.game._state.data['orientations'])
+        self.assertEqual(recovered._state.data['urls'][4], 'd.jpg')
+
+    def test_coalesced_moves_send_final_positions(self):
+        self.game.coalesce_window = 60
+        with mock.patch.object(self.game, 'broadcast') as broadcast:
+            for dest in [5, 6, 5]:
+                self.game.handle_bulkmove({'moves': [
+                    {'card': 1, 'dest_type': 'board', 'dest_key': dest,
+                     'dest_orient': 1},
+                ]}, mock.Mock())
+            self.game.handle_bulkmove({'moves': [
+                {'card': 2, 'dest_type': 'board', 'dest_key': 5,
+                 'dest_orient': 1},
+            ]}, mock.Mock())
+            self.assertFalse(broadcast.called)
+            self.game.flush_moves()
+
+        (_, reqtype, msg), = [c[0] for c in broadcast.call_args_list]
+        self.assertEqual(reqtype, 'bulkupdate')
+        self.assertEqual(msg, [{
+            'dest_type': 'board',
+            'dest_key': 5,
+            'updates': [
+                {'move': {'card': 1, 'dest_type': 'board', 'dest_key': 5,
+                          'dest_orient': 1},
+                 'old_type': 'board', 'old_key': 0},
+                {'move': {'card': 2, 'dest_type': 'board', 'dest_key': 5,
+                          'dest_orient': 1},
+                 'old_type': 'board', 'old_key': 0},
+            ],
+            'z_stack': [1, 2],
+        }])
+        (_, (op, moves)), = list(self.game.ScopedJournal)
+        self.assertEqual((op, len(moves)), ('bulkmove', 4))
+
+    def test_presence_changes_are_batched_deltas(self):
+        self.game.presence_window = 60
+        alice, bob, bob2 = mock.Mock(), mock.Mock(), mock.Mock()
+        with mock.patch.object(self.game, 'broadcast') as broadcast:
+            self.game.add_stream(alice, {'uuid': 'a'})
+            self.game.add_stream(bob, {'uuid': 'b'})
+            self.game.add_stream(bob2, {'uuid': 'b'})
+            self.game.flush_presence()
+            self.game.notify_presence(bob2)
+            self.game.notify_closed(bob)
+            self.game.notify_closed(alice)
+            self.game.flush_presence()
+            self.game.flush_presence()
+
+        sent = [c[0] for c in broadcast.call_args_list]
+        self.assertEqual(len(sent), 3)
+        streams, reqtype, data = sent[0]
+        self.assertEqual(reqtype, 'presence_delta')
+        self.assertEqual([p['uuid'] for p in data['joined']], ['a', 'b'])
+        self.assertEqual(data['left'], [])
+        streams, reqtype, data = sent[1]
+        self.assertEqual((streams, reqtype), ({bob2}, 'presence'))
+        self.assertEqual([p['uuid'] for p in data], ['a', 'b', 'b'])
+        self.assertEqual(
+            sent[2][1:], ('presence_delta', {'joined': [], 'left': ['a']}))
+
+    def test_reaper_closes_streams_without_keepalives(self):
+        reaper = kansas_wsh.KeepaliveReaper(60)
+        quiet, chatty = mock.Mock(), mock.Mock()
+        with mock.patch.object(kansas_wsh, 'reaper', reaper):
+            self.game.add_stream(quiet, {'uuid': 'q'})
+            self.game.add_stream(chatty, {'uuid': 'c'})
+        start = self.game.streams[quiet]['last_keepalive']
+        self.game.streams[chatty]['last_keepalive'] = start + 30
+
+        reaper.reap(start + 59)
+        self.assertEqual(self.game.presence_count(), 2)
+        reaper.reap(start + 61)
+        self.assertEqual(self.game.presence_count(), 1)
+        quiet.close_connection.assert_called_once_with(wait_response=False)
+        self.assertEqual(len(reaper._heap), 1)
+        reaper.reap(start + 91)
+        self.assertEqual(self.game.presence_count(), 0)
+        self.assertEqual(reaper._heap, [])
+
+    def test_save_compacts_journal(self):
+        self.game.handle_bulkmove({'moves': [
+            {'card': 1, 'dest_type': 'board', 'dest_key': 5, 'dest_orient': 1},
+        ]}, mock.Mock())
+        self.game.save()
+        kansas_wsh.persister.flush()
+        self.assertEqual(list(self.game.ScopedJournal.Keys()), [])
+        self.assertEqual(self.game.ScopedGames.Get('game')[1], self.game._seqno)
+
+    def test_snapshot_written_outside_game_lock(self):
+        free = []
+
+        def put(gameid, snapshot):
+            probe = threading.Thread(target=lambda: free.append(
+                self.game._lock.acquire(timeout=1) and
+                self.game._lock.release() is None))
+            probe.start()
+            probe.join()
+            snapshot[0]['board'][0].append(99)
+
+        stack = list(self.game._state.data['board'][0])
+        with mock.patch.object(self.game.ScopedGames, 'Put', side_effect=put):
+            self.assertTrue(self.game.write_snapshot())
+        self.assertEqual(free, [True])
+        self.assertEqual(self.game._state.data['board'][0], stack)
+
+    def test_snapshot_skipped_once_terminated(self):
+        self.game.terminate()
+        self.assertFalse(self.game.write_snapshot())
+        self.assertIsNone(self.game.ScopedGames.Get('game'))
+
+    def test_saves_coalesce_until_flush(self):
+        persister = kansas_wsh.BackgroundPersister(60)
+        with mock.patch.object(kansas_wsh, 'persister', persister):
+            for _ in range(5):
+                self.game.save()
+            persister.flush()
+        self.assertEqual(persister.stats(), {
+            'marked': 5, 'coalesced': 4, 'written': 1, 'pending': 0})
+
+    def test_add_swaps_in_local_images_when_ready(self):
+        data = self.game._state.data
+        fetcher = kansas_wsh.imagecache.Prefetcher(1)
+        with mock.patch.object(kansas_wsh.imagecache, 'fetcher', fetcher), \
+                mock.patch.object(self.game._state, 'find_url',
+                                  return_value='http://img/x.jpg'), \
+                mock.patch.object(data, 'cached_paths', return_value=None), \
+                mock.patch.object(data, 'localize',
+                                  return_value=('cache/x.jpg', 'cache/x@s.jpg', {})) as localize, \
+                mock.patch.object(self.game, 'broadcast') as broadcast:
+            self.game.handle_add({
+                'cards': [{'name': 'x', 'loc': 0}, {'name': 'x', 'loc': 0}],
+                'requestor': 'bob',
+            }, mock.Mock())
+            fetcher._executor.shutdown(wait=True)
+
+        (_, added_type, added), (_, urls_type, updates) = [
+            c[0] for c in broadcast.call_args_list]
+        self.assertEqual(added_type, 'bulk_add')
+        self.assertEqual(
+            [c['url'] for c in added['cards']], ['http://img/x.jpg'] * 2)
+        self.assertEqual(urls_type, 'bulk_urls')
+        self.assertEqual(sorted(u['id'] for u in updates), [4, 5])
+        self.assertEqual(data['urls'][4], 'cache/x.jpg')
+        self.assertEqual(data['urls_small'][5], 'cache/x@s.jpg')
+        localize.assert_called_once_with('http://img/x.jpg')
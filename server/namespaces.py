@@ -1,7 +1,12 @@
 # Implements simple persistence of namespaces via leveldb.
 
+from server import config
+
+import atexit
+import itertools
 import pickle
 import sqlite3
+import threading
 
 try:
     import leveldb  # type: ignore
@@ -9,45 +14,128 @@ except ImportError:
     leveldb = None
 
 
+class WriteBatch(object):
+    """Mirrors leveldb.WriteBatch for the sqlite fallback."""
+
+    def __init__(self):
+        self.ops = []
+
+    def Put(self, key, value):
+        self.ops.append((key, value))
+
+    def Delete(self, key):
+        self.ops.append((key, None))
+
+
 class _SQLiteCompatDB:
-    """Minimal LevelDB-compatible wrapper used when python-leveldb is absent."""
+    """Minimal LevelDB-compatible wrapper used when python-leveldb is absent.
+
+    Writes are group-committed: a Put or Delete joins the open transaction,
+    which is committed once commit_window seconds after its first write."""
 
-    def __init__(self, db_path):
+    kRangePageSize = 256
+
+    def __init__(self, db_path, commit_window=None):
         # Namespace passes a directory-like path. Store sqlite DB within it.
         import os
 
         os.makedirs(db_path, exist_ok=True)
         sqlite_path = os.path.join(db_path, 'kansas.sqlite3')
-        self.conn = sqlite3.connect(sqlite_path)
+        if commit_window is None:
+            commit_window = config.kDBGroupCommitWindow
+        self.commit_window = commit_window
+        self._lock = threading.RLock()
+        self._commit_timer = None
+        self.num_writes = 0
+        self.num_commits = 0
+        self.conn = sqlite3.connect(sqlite_path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
         self.conn.execute(
             'CREATE TABLE IF NOT EXISTS kv (k TEXT PRIMARY KEY, v BLOB NOT NULL)'
         )
         self.conn.commit()
 
-    def Put(self, key, value):
-        self.conn.execute('INSERT OR REPLACE INTO kv (k, v) VALUES (?, ?)', (key, value))
-        self.conn.commit()
-
-    def Delete(self, key):
-        self.conn.execute('DELETE FROM kv WHERE k = ?', (key,))
-        self.conn.commit()
+    def _apply(self, key, value):
+        if value is None:
+            self.conn.execute('DELETE FROM kv WHERE k = ?', (key,))
+        else:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO kv (k, v) VALUES (?, ?)', (key, value))
+        self.num_writes += 1
+
+    def _schedule_commit(self, sync=False):
+        if sync or self.commit_window <= 0:
+            self.Flush()
+        elif self._commit_timer is None:
+            self._commit_timer = threading.Timer(self.commit_window, self.Flush)
+            self._commit_timer.daemon = True
+            self._commit_timer.start()
+
+    def Flush(self):
+        """Commits any writes still waiting on the group-commit window."""
+
+        with self._lock:
+            if self._commit_timer is not None:
+                self._commit_timer.cancel()
+                self._commit_timer = None
+            if self.conn.in_transaction:
+                self.conn.commit()
+                self.num_commits += 1
+
+    def Put(self, key, value, sync=False):
+        with self._lock:
+            self._apply(key, value)
+            self._schedule_commit(sync)
+
+    def Delete(self, key, sync=False):
+        with self._lock:
+            self._apply(key, None)
+            self._schedule_commit(sync)
+
+    def Write(self, batch, sync=False):
+        with self._lock:
+            for key, value in batch.ops:
+                self._apply(key, value)
+            self._schedule_commit(sync)
 
     def Get(self, key):
-        row = self.conn.execute('SELECT v FROM kv WHERE k = ?', (key,)).fetchone()
+        with self._lock:
+            row = self.conn.execute(
+                'SELECT v FROM kv WHERE k = ?', (key,)).fetchone()
         if row is None:
             raise KeyError(key)
         return row[0]
 
-    def RangeIter(self, start, end):
-        rows = self.conn.execute(
-            'SELECT k, v FROM kv WHERE k >= ? AND k < ? ORDER BY k ASC', (start, end)
-        ).fetchall()
-        for k, v in rows:
-            yield k, v
+    def RangeIter(self, start, end, include_value=True):
+        """Streams rows in [start, end) a page at a time.
+
+        Each page is a keyset query resuming after the last key seen, so the
+        lock is never held while the caller consumes rows. Like leveldb, only
+        keys are yielded when include_value is False."""
+
+        columns = include_value and 'k, v' or 'k'
+        op = '>='
+        while True:
+            with self._lock:
+                rows = self.conn.execute(
+                    'SELECT %s FROM kv WHERE k %s ? AND k < ? ORDER BY k ASC LIMIT ?'
+                    % (columns, op), (start, end, self.kRangePageSize)
+                ).fetchall()
+            for row in rows:
+                if include_value:
+                    yield row
+                else:
+                    yield row[0]
+            if len(rows) < self.kRangePageSize:
+                return
+            start = rows[-1][0]
+            op = '>'
 
     def GetStats(self):
-        count = self.conn.execute('SELECT COUNT(*) FROM kv').fetchone()[0]
-        return f'storage=sqlite3 entries={count}'
+        with self._lock:
+            count = self.conn.execute('SELECT COUNT(*) FROM kv').fetchone()[0]
+        return f'storage=sqlite3 entries={count} writes={self.num_writes} commits={self.num_commits}'
 
 
 _databases = {}
@@ -62,6 +150,27 @@ def _GetDB(dbPath):
     return _databases[dbPath]
 
 
+def SetCommitWindow(dbPath, seconds):
+    """Sets how long writes to the sqlite DB at dbPath wait to share a
+       commit, e.g. 0 for a DB shared by several processes."""
+
+    db = _GetDB(dbPath)
+    if isinstance(db, _SQLiteCompatDB):
+        with db._lock:
+            db.commit_window = seconds
+
+
+def FlushAll():
+    """Commits pending group-commit writes on every open sqlite DB."""
+
+    for db in list(_databases.values()):
+        if isinstance(db, _SQLiteCompatDB):
+            db.Flush()
+
+
+atexit.register(FlushAll)
+
+
 _meta = {}
 def _GetMeta(dbPath):
     """Returns the meta table, which is a list of all other tables."""
@@ -81,7 +190,8 @@ def ListNamespaces(dbPath):
 class Namespace(object):
     """Returns a named, versioned subpartition of a LevelDB instance."""
 
-    def __init__(self, dbpath, name, version=0, serializer=pickle, _prefix=''):
+    def __init__(self, dbpath, name, version=0, serializer=pickle, _prefix='',
+                 _register=True):
         if ':' in name:
             raise ValueError("name must not contain ':'")
         self.dbpath = dbpath
@@ -90,7 +200,9 @@ class Namespace(object):
         self.version = version
         self.serializer = serializer
         self.prefix = str(_prefix)
-        if name != '__META__' and not _prefix:
+        # Without _register, an old version can be read without it replacing
+        # the current one in the meta table.
+        if _register and name != '__META__' and not _prefix:
             meta = _GetMeta(dbpath)
             meta.Put(name, (name, version, str(serializer)))
 
@@ -120,21 +232,75 @@ class Namespace(object):
     def Delete(self, key):
         self.db.Delete(self._key(key))
 
+    def Batch(self, sync=False):
+        """Returns a NamespaceBatch that writes its Puts/Deletes atomically."""
+        return NamespaceBatch(self, sync)
+
     def Get(self, key):
         try:
             return self.serializer.loads(self.db.Get(self._key(key)))
         except KeyError:
             return None
 
-    def List(self):
-        return list(self)
+    def _range(self, include_value, limit, start_after):
+        if start_after is None:
+            start = self._key('\x00')
+        else:
+            # The smallest internal key sorting strictly after start_after.
+            start = self._key(start_after) + '\x00'
+        it = self.db.RangeIter(
+            start, self._key('\xff'), include_value=include_value)
+        return itertools.islice(it, limit)
+
+    def Keys(self, limit=None, start_after=None):
+        """Yields keys in order without deserializing any values."""
+        for k in self._range(False, limit, start_after):
+            yield self._invkey(k)
+
+    def Items(self, limit=None, start_after=None):
+        """Yields (key, value) pairs in key order."""
+        for k, v in self._range(True, limit, start_after):
+            yield self._invkey(k), self.serializer.loads(v)
+
+    def List(self, limit=None, start_after=None):
+        return list(self.Items(limit, start_after))
 
     def __contains__(self, key):
         return self.Get(key) is not None
 
     def __iter__(self):
-        for k, v in self.db.RangeIter(self._key('\x00'), self._key('\xff')):
-            yield self._invkey(k), self.serializer.loads(v)
+        return self.Items()
+
+
+class NamespaceBatch(object):
+    """Collects writes to a Namespace and applies them in one transaction.
+
+    Use as a context manager; the batch is written if the block succeeds."""
+
+    def __init__(self, namespace, sync=False):
+        self.namespace = namespace
+        self.sync = sync
+        if leveldb is not None:
+            self.batch = leveldb.WriteBatch()
+        else:
+            self.batch = WriteBatch()
+
+    def Put(self, key, value):
+        self.batch.Put(
+            self.namespace._key(key), self.namespace.serializer.dumps(value))
+
+    def Delete(self, key):
+        self.batch.Delete(self.namespace._key(key))
+
+    def Write(self):
+        self.namespace.db.Write(self.batch, sync=self.sync)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.Write()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,286 @@
+# Per-connection outbound message queues.
+
+from server import codec
+
+import abc
+import asyncio
+import collections
+import logging
+import threading
+
+# What a queue does once a client falls kOutboundQueueSize messages behind.
+DROP_AND_RESYNC = 'resync'
+COALESCE = 'coalesce'
+DISCONNECT = 'disconnect'
+POLICIES = (DROP_AND_RESYNC, COALESCE, DISCONNECT)
+
+# Broadcasts whose effect is fully captured by a resync snapshot.
+SUPERSEDED_BY_RESYNC = ('bulkupdate', 'bulk_add', 'bulk_remove', 'bulk_urls')
+# Message types where only the newest one matters.
+LATEST_ONLY = ('presence',)
+# Message types whose data lists may be concatenated without changing what
+# the client ends up with, since it applies their entries in order.
+MERGEABLE = ('bulkupdate', 'bulk_remove', 'bulk_urls')
+
+_RESYNC = object()
+_CLOSE = object()
+
+
+class QueueClosed(Exception):
+    pass
+
+
+def message_type(message):
+    """Returns the 'type' of an encoded message, or None."""
+
+    return codec.for_frame(message).peek_type(message)
+
+
+class OutboundBuffer(abc.ABC):
+    """Holds the messages waiting to be sent to one client. Subclasses send
+       them from a writer of their own, so that put() never waits on the
+       client's link.
+
+    About maxsize messages are held. When a put would exceed that, the
+    policy decides what happens:
+
+      DROP_AND_RESYNC: queued game updates are dropped, and the writer sends
+        the resync message (e.g. a full game snapshot) in their place.
+        Replies and other messages are kept.
+      COALESCE: the message is folded into the backlog where its type allows
+        it, falling back to DROP_AND_RESYNC.
+      DISCONNECT: the client is closed and put() raises QueueClosed.
+
+    Without a resync function, or if the backlog is still full after a
+    resync, the client is disconnected."""
+
+    def __init__(self, maxsize, policy=DROP_AND_RESYNC):
+        assert policy in POLICIES, policy
+        self.maxsize = maxsize
+        self.policy = policy
+        self._resync = None
+        self._resync_lock = None
+        self._lock = threading.Lock()
+        self._queue = collections.deque()
+        self._closed = False
+        self.num_sent = 0
+        self.num_dropped = 0
+        self.num_coalesced = 0
+        self.num_resyncs = 0
+
+    @abc.abstractmethod
+    def _wake(self):
+        """Tells the writer there is work. Called holding self._lock."""
+
+    def set_resync(self, fn, lock):
+        """Sets fn, which returns the message that replaces dropped updates.
+
+        The writer calls fn holding lock, which must be the lock held by
+        whoever puts those updates, so fn's message covers every update
+        dropped."""
+
+        with self._lock:
+            self._resync = fn
+            self._resync_lock = lock
+
+    def put(self, message):
+        with self._lock:
+            if self._closed:
+                raise QueueClosed("outbound queue closed")
+            if len(self._queue) < self.maxsize:
+                self._queue.append(message)
+            elif self.policy == COALESCE and self._coalesce(message):
+                self.num_coalesced += 1
+            elif (self.policy == DISCONNECT or self._resync is None
+                    or not self._drop_and_resync(message)):
+                self._abort()
+                self._wake()
+                raise QueueClosed(
+                    "client fell %d messages behind" % self.maxsize)
+            self._wake()
+
+    def close(self):
+        """Closes the connection once the messages already queued are sent."""
+
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._queue.append(_CLOSE)
+            self._wake()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'queued': len(self._queue),
+                'sent': self.num_sent,
+                'dropped': self.num_dropped,
+                'coalesced': self.num_coalesced,
+                'resyncs': self.num_resyncs,
+            }
+
+    def _coalesce(self, message):
+        """Folds message into the backlog, returning False if it cannot."""
+
+        kind = message_type(message)
+        if kind in LATEST_ONLY:
+            kept = collections.deque(
+                m for m in self._queue if message_type(m) != kind)
+            if len(kept) == len(self._queue):
+                return False
+            self.num_dropped += len(self._queue) - len(kept)
+            kept.append(message)
+            self._queue = kept
+            return True
+        last = self._queue[-1]
+        wire = codec.for_frame(message)
+        if (kind in MERGEABLE and message_type(last) == kind
+                and codec.for_frame(last) is wire):
+            merged = wire.decode(last)
+            newer = wire.decode(message)
+            merged['data'].extend(newer['data'])
+            merged['time'] = newer['time']
+            self._queue[-1] = wire.encode(merged)
+            return True
+        return False
+
+    def _prune(self, queue):
+        """Returns queue without updates superseded by a resync, keeping only
+           the newest message of each LATEST_ONLY type."""
+
+        kept = collections.deque()
+        latest = set()
+        for message in reversed(queue):
+            kind = message_type(message)
+            if message is _RESYNC or kind in SUPERSEDED_BY_RESYNC:
+                continue
+            if kind in LATEST_ONLY:
+                if kind in latest:
+                    continue
+                latest.add(kind)
+            kept.appendleft(message)
+        self.num_dropped += len(queue) - len(kept)
+        return kept
+
+    def _drop_and_resync(self, message):
+        """Prunes the backlog and schedules a resync. Returns False if that
+           did not make room for message."""
+
+        self._queue.append(message)
+        self._queue = self._prune(self._queue)
+        if len(self._queue) >= self.maxsize:
+            return False
+        logging.warning("Client fell %d messages behind, resyncing.",
+                        self.maxsize)
+        self.num_resyncs += 1
+        self._queue.appendleft(_RESYNC)
+        return True
+
+    def _abort(self):
+        logging.warning("Client fell %d messages behind, disconnecting.",
+                        self.maxsize)
+        self.num_dropped += len(self._queue) + 1
+        self._queue.clear()
+        self._closed = True
+        self._queue.append(_CLOSE)
+
+    def _next_resync(self):
+        # Updates queued since the resync was scheduled are also covered.
+        with self._resync_lock:
+            with self._lock:
+                self._queue = self._prune(self._queue)
+            return self._resync()
+
+    def _pop(self):
+        """Returns the next message to send, or None if there is none."""
+
+        with self._lock:
+            if not self._queue:
+                return None
+            return self._queue.popleft()
+
+    def _failed(self, e):
+        logging.info("Dropping outbound queue: %s", e)
+        with self._lock:
+            self._closed = True
+            self._queue.clear()
+
+
+class OutboundQueue(OutboundBuffer):
+    """Sends a client's messages from a thread of its own."""
+
+    def __init__(self, send, close, maxsize, policy=DROP_AND_RESYNC):
+        OutboundBuffer.__init__(self, maxsize, policy)
+        self._send = send
+        self._close = close
+        self._cond = threading.Condition(self._lock)
+        self._writer = threading.Thread(target=self._run, daemon=True)
+        self._writer.start()
+
+    def _wake(self):
+        self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._queue:
+                    self._cond.wait()
+                message = self._queue.popleft()
+            if message is _CLOSE:
+                break
+            try:
+                if message is _RESYNC:
+                    message = self._next_resync()
+                self._send(message)
+                self.num_sent += 1
+            except Exception as e:
+                self._failed(e)
+                break
+        try:
+            self._close()
+        except Exception as e:
+            logging.exception(e)
+
+
+class AsyncOutboundQueue(OutboundBuffer):
+    """Sends a client's messages from a task on an event loop.
+
+    send and close are coroutine functions; put() may be called from any
+    thread."""
+
+    def __init__(self, send, close, maxsize, policy=DROP_AND_RESYNC,
+                 loop=None, executor=None):
+        OutboundBuffer.__init__(self, maxsize, policy)
+        self._send = send
+        self._close = close
+        self._loop = loop or asyncio.get_running_loop()
+        self._executor = executor
+        self._ready = asyncio.Event()
+        self._writer = self._loop.create_task(self._run())
+
+    def _wake(self):
+        self._loop.call_soon_threadsafe(self._ready.set)
+
+    async def _run(self):
+        while True:
+            self._ready.clear()
+            message = self._pop()
+            if message is None:
+                await self._ready.wait()
+                continue
+            if message is _CLOSE:
+                break
+            try:
+                if message is _RESYNC:
+                    # Waits on the game lock, so it must not block the loop.
+                    message = await self._loop.run_in_executor(
+                        self._executor, self._next_resync)
+                await self._send(message)
+                self.num_sent += 1
+            except Exception as e:
+                self._failed(e)
+                break
+        try:
+            await self._close()
+        except Exception as e:
+            logging.exception(e)
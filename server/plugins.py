@@ -1,10 +1,16 @@
 # Plugins for various board games compatible with Kansas.
 
+from server import config
+from server import ratelimit
+
 import collections
 import csv
+import functools
 import glob
+import heapq
 import json
 import logging
+import operator
 import os
 import random
 import re
@@ -12,6 +18,11 @@ import shlex
 import time
 import urllib.request, urllib.error, urllib.parse
 
+try:
+    import numpy  # type: ignore
+except ImportError:
+    numpy = None
+
 
 _SERVER_DIR = os.path.dirname(os.path.abspath(__file__))
 
@@ -34,6 +45,10 @@ class DefaultPlugin(object):
     def Fetch(self, name, exact, limit=None):
         return []
 
+    def Explain(self, name, exact, limit=None):
+        """Same as Fetch, with plugins free to describe the search in meta."""
+        return self.Fetch(name, exact, limit)
+
     def Sample(self):
         return []
 
@@ -164,6 +179,270 @@ class MagicCard(object):
         return str((self.name, self.type, self.mana, self.cost))
 
 
+class SubstringIndex(object):
+    """Finds the words containing a substring, from the n-grams of each word
+       up to trigrams."""
+
+    N = 3
+
+    def __init__(self, words):
+        self.words = set(words)
+        self.grams = collections.defaultdict(set)
+        for word in self.words:
+            for n in range(1, self.N + 1):
+                for i in range(len(word) - n + 1):
+                    self.grams[word[i:i + n]].add(word)
+
+    def containing(self, s):
+        if not s:
+            return set(self.words)
+        if len(s) <= self.N:
+            return set(self.grams.get(s, ()))
+        grams = sorted(
+            (self.grams.get(s[i:i + self.N], set())
+             for i in range(len(s) - self.N + 1)),
+            key=len)
+        found = set(grams[0])
+        for gram in grams[1:]:
+            if not found:
+                break
+            found &= gram
+        # Having every trigram of s does not mean having s.
+        return {word for word in found if s in word}
+
+
+kColorBits = {'W': 1, 'U': 2, 'B': 4, 'R': 8, 'G': 16}
+# Stands for no cost in the cost column.
+kNoCost = -1
+
+
+def colorBits(colors):
+    bits = 0
+    for color in colors:
+        bits |= kColorBits[color]
+    return bits
+
+
+class CardColumns(object):
+    """NumPy arrays over a list of cards, one per attribute, so that cards
+       can be filtered with vectorized masks instead of one by one.
+
+    Rows are positions in cards. slugs, if given, maps slugs to the cards
+    that searches find under them."""
+
+    def __init__(self, cards, slugs=None):
+        self.cards = cards
+        self.types = {}
+        for card in cards:
+            self.types.setdefault(card.type, len(self.types))
+        self.cost = numpy.array(
+            [kNoCost if c.cost is None else c.cost for c in cards],
+            dtype=numpy.int16)
+        self.colors = numpy.array(
+            [colorBits(c.colors()) for c in cards], dtype=numpy.uint8)
+        self.type = numpy.array(
+            [self.types[c.type] for c in cards], dtype=numpy.int32)
+        self.good = numpy.array(
+            [bool(c.goodQuality) for c in cards], dtype=bool)
+        self.slugs = [c.name.lower() for c in cards]
+        # Whether each row is the card found under its slug.
+        self.searched = numpy.array(
+            [slugs is not None and slugs.get(slug) is c
+             for slug, c in zip(self.slugs, cards)], dtype=bool)
+
+    def costMask(self, predicates, rows=None):
+        cost = self.cost if rows is None else self.cost[rows]
+        mask = cost != kNoCost
+        for op, val in predicates:
+            mask &= kCostOps[op](cost, val)
+        return mask
+
+    def costing(self, predicates):
+        """Returns the slugs of cards whose cost satisfies predicates."""
+
+        mask = self.costMask(predicates) & self.searched
+        return {self.slugs[row] for row in numpy.flatnonzero(mask)}
+
+    def spellMask(self, rows, colors, minCost, maxCost):
+        """Returns which cards in rows may go in a generated deck."""
+
+        mask = self.good[rows] & self.costMask(
+            [('>=', minCost), ('<=', maxCost)], rows)
+        if 'land' in self.types:
+            mask &= self.type[rows] != self.types['land']
+        mask &= (self.colors[rows] & ~numpy.uint8(colorBits(colors))) == 0
+        return mask
+
+
+class SearchIndex(object):
+    """Posting lists over the search text of cards, keyed by card slug.
+       With columns, cost predicates are answered from those."""
+
+    def __init__(self, cards, columns=None):
+        self.columns = columns
+        self.slugs = set(cards)
+        self.postings = collections.defaultdict(set)
+        # Posting lists over the words of each card's name and type only.
+        self.headings = collections.defaultdict(set)
+        self.byCost = collections.defaultdict(set)
+        for slug, card in cards.items():
+            for token in card.searchtokens:
+                self.postings[token].add(slug)
+            for word in (slug + ' ' + card.searchtype).split():
+                self.headings[word].add(slug)
+            self.byCost[card.cost].add(slug)
+        self.vocabulary = SubstringIndex(self.postings)
+        self.headingVocabulary = SubstringIndex(self.headings)
+
+    def containing(self, term):
+        """Returns the slugs of cards whose search text may contain term.
+
+        A term without whitespace can only occur inside one token of the
+        search text, so it is looked up in the token vocabulary rather than
+        in every card. The result may include cards where the pieces of a
+        term with spaces are not adjacent."""
+
+        return self._lookup(term, self.vocabulary, self.postings)
+
+    def headed(self, term):
+        """Returns the slugs of cards whose name or type may contain term,
+           in the same way as containing."""
+
+        return self._lookup(term, self.headingVocabulary, self.headings)
+
+    def _lookup(self, term, vocabulary, postings):
+        found = None
+        for piece in term.split():
+            slugs = set()
+            for token in vocabulary.containing(piece):
+                slugs |= postings[token]
+            found = slugs if found is None else found & slugs
+        return set(self.slugs) if found is None else found
+
+    def costing(self, predicates):
+        """Returns the slugs of cards whose cost satisfies predicates."""
+
+        if self.columns is not None:
+            return self.columns.costing(predicates)
+        found = set()
+        for cost, posting in self.byCost.items():
+            if costMatches(cost, predicates):
+                found |= posting
+        return found
+
+
+# Comparisons allowed in cost predicates, as (op, value) pairs.
+kCostOps = {
+    '==': operator.eq,
+    '>': operator.gt,
+    '>=': operator.ge,
+    '<': operator.lt,
+    '<=': operator.le,
+}
+
+
+def costMatches(cost, predicates):
+    if cost is None:
+        return False
+    return all(kCostOps[op](cost, val) for op, val in predicates)
+
+
+def rankit(p, title, card, has):
+    """Scores how well term p matches card, decrementing has[0] if card's
+       search text lacks it."""
+
+    rank = 0
+    if p in title or p in card.searchtype:
+        rank += 1
+    if p in card.searchtokens:
+        rank += 1
+    if p in card.searchtext:
+        if ' ' in p:
+            rank += len(p.split())
+        else:
+            rank += 1
+    else:
+        has[0] -= 1
+    return rank
+
+
+kRangeExpr = re.compile(r"(\d+)\s*(to|-)\s*(\d+)\s*(mana|cost|cmc)")
+kCostExpr = re.compile(r"(mana|cost|cmc)\s*(>|<|>=|<=|=|==|)\s*(\d+)")
+kCostExpr2 = re.compile(r"(\d+)\s*(mana|cost|cmc)")
+kManaWords = {'red', 'blue', 'white', 'black', 'green'}
+kOtherManaWords = {'dual', 'mono', 'multi', 'colored', 'colorless', 'single', 'two', 'three', 'tri', 'quad', 'four', 'five', 'all', 'rainbow'}
+kColorCounts = {1: 'mono', 2: 'dual', 3: 'tri', 4: 'quad', 5: 'all'}
+
+
+class QueryPlan(object):
+    """A parsed local search: cost predicates as (op, value) pairs, query
+       words, and the mana= facets that mana words expand to. needle is the
+       query left once cost expressions are taken out."""
+
+    def __init__(self, needle, predicates, parts, expanded):
+        self.needle = needle
+        self.predicates = tuple(predicates)
+        self.parts = tuple(parts)
+        self.expanded = tuple(expanded)
+
+    def describe(self):
+        return {
+            'needle': self.needle,
+            'predicates': [list(p) for p in self.predicates],
+            'terms': list(self.parts),
+            'facets': list(self.expanded),
+        }
+
+
+@functools.lru_cache(maxsize=config.kSearchPlanCacheSize)
+def parseQuery(needle):
+    """Returns the QueryPlan for a lowercased search. Plans are cached, so
+       repeated searches, e.g. while typing, skip parsing."""
+
+    predicates = []
+    for match in kRangeExpr.finditer(needle):
+        lo, hi = int(match.group(1)), int(match.group(3))
+        if lo > hi:
+            lo, hi = hi, lo
+        logging.info("Using predicate: cost in [%d, %d]" % (lo, hi))
+        predicates.append(('>=', lo))
+        predicates.append(('<=', hi))
+    needle = kRangeExpr.sub('', needle)
+    for match in kCostExpr.finditer(needle):
+        op, val = match.group(2), int(match.group(3))
+        if op == '=' or op == '':
+            op = '=='
+        logging.info("Using predicate: cost %s %d" % (op, val))
+        predicates.append((op, val))
+    needle = kCostExpr.sub('', needle)
+    for match in kCostExpr2.finditer(needle):
+        op, val = '==', int(match.group(1))
+        logging.info("Using predicate: cost %s %d" % (op, val))
+        predicates.append((op, val))
+    needle = kCostExpr2.sub('', needle)
+    try:
+        words = shlex.split(needle)
+    except ValueError:
+        words = needle.split()
+    parts = []
+    expanded = []
+    num_mana = 0
+    num_other_mana = 0
+    for p in words:
+        if p in kManaWords:
+            num_mana += 1
+        if p in kOtherManaWords:
+            num_other_mana += 1
+        if p in kManaWords or p in kOtherManaWords or p == 'x':
+            expanded.append('mana=' + p)
+        else:
+            parts.append(p)
+    if num_other_mana == 0 and num_mana in kColorCounts:
+        expanded.append('mana=' + kColorCounts[num_mana])
+    logging.info("Expanded query: " + str(parts) + " " + str(expanded))
+    return QueryPlan(needle, predicates, parts, expanded)
+
+
 class CardCatalog(object):
     def __init__(self, catalogFile, classifyFile, dbPath):
         logging.info("Building card catalog.")
@@ -177,6 +456,8 @@ class CardCatalog(object):
         self.byColor = collections.defaultdict(list)
         self.byCost = collections.defaultdict(list)
         self.byTokens = collections.defaultdict(list)
+        # Every card registered, with its position in card.row.
+        self.cards = []
         try:
             if os.path.exists(classifyFile):
                 self.newCards = set([sanitize(x[2:-1]) for x in
@@ -210,6 +491,17 @@ class CardCatalog(object):
                 print("WARNING: card missing metadata: " + name)
                 card = MagicCard([name, '', '', '', '', '', '', ''])
                 self._register(card)
+        self.columns = None
+        if numpy is not None:
+            self.columns = CardColumns(self.cards, self.bySlug)
+            # The rows of each color and theme pool chooseSpell picks from.
+            self.colorRows = self._rowsOf(self.byColor)
+            self.tokenRows = self._rowsOf(self.byTokens)
+            # The rows of those pools passing each of chooseSpell's filters.
+            # Decks are built from few filters, so this stays small.
+            self.spellRows = {}
+        self.index = SearchIndex(self.bySlug, self.columns)
+        self.themeIndex = SubstringIndex(self.byTokens)
         logging.info("Done building card catalog.")
         self.topTokens = []
         for k, v in self.byTokens.items():
@@ -242,6 +534,9 @@ class CardCatalog(object):
         ]
 
     def chooseSpell(self, color, colors, minCost, maxCost, taken, theme=None):
+        if self.columns is not None:
+            return self._chooseSpellFromColumns(
+                color, colors, minCost, maxCost, taken, theme)
 
         def valid(cand):
             if cand is None: return False
@@ -274,6 +569,40 @@ class CardCatalog(object):
         taken.add(cand.name)
         return cand.name
 
+    def _chooseSpellFromColumns(
+            self, color, colors, minCost, maxCost, taken, theme=None):
+        """Same as chooseSpell, but picks among the cards that pass its
+           checks rather than retrying random ones."""
+
+        pools = []
+        if theme:
+            token = random.choice(theme)
+            pools.append((Catalog.byTokens[token], 'token', token))
+        if random.random() < 0.1:
+            color = 'colorless'
+        pools.append((self.byColor[color], 'color', color))
+        colors = frozenset(colors)
+        for _, kind, key in pools:
+            filtered = (kind, key, colors, minCost, maxCost)
+            rows = self.spellRows.get(filtered)
+            if rows is None:
+                poolRows = Catalog.tokenRows if kind == 'token' else self.colorRows
+                rows = poolRows.get(key, numpy.zeros(0, dtype=numpy.int64))
+                rows = rows[self.columns.spellMask(
+                    rows, colors, minCost, maxCost)]
+                self.spellRows[filtered] = rows
+            while len(rows):
+                i = random.randrange(len(rows))
+                cand = self.cards[rows[i]]
+                if cand.name not in taken:
+                    taken.add(cand.name)
+                    return cand.name
+                rows = numpy.delete(rows, i)
+        # Like chooseSpell once out of tries.
+        cand = random.choice(pools[-1][0])
+        taken.add(cand.name)
+        return cand.name
+
     def chooseLand(self, colors):
         for _ in range(20):
             cand = random.choice(self.byType['Land'])
@@ -367,13 +696,7 @@ class CardCatalog(object):
                 avail = list(set(parts))
                 if avail:
                     word = random.choice(avail)
-                if word not in Catalog.byTokens:
-                    tokens = list(Catalog.byTokens)
-                    random.shuffle(tokens)
-                    for key in tokens:
-                        if word in key:
-                            word = key
-                            break
+                word = self.expandToken(word)
                 if word not in Catalog.byTokens:
                     word = Catalog.randomTheme()
                 theme = [word]
@@ -387,13 +710,7 @@ class CardCatalog(object):
                 else:
                     theme = []
                     for word in parts:
-                        if word not in Catalog.byTokens:
-                            tokens = list(Catalog.byTokens)
-                            random.shuffle(tokens)
-                            for key in tokens:
-                                if word in key:
-                                    word = key
-                                    break
+                        word = self.expandToken(word)
                         if word in Catalog.byTokens:
                             theme.append(word)
                     if len(theme) < 2:
@@ -407,6 +724,17 @@ class CardCatalog(object):
         logging.info("Deck gen took %.2fms", 1000*(time.time() - start))
         return output
 
+    def expandToken(self, word):
+        """Returns word if it is a theme token, or else a random theme token
+           containing it, if any."""
+
+        if word in self.byTokens:
+            return word
+        matches = self.themeIndex.containing(word)
+        if matches:
+            return random.choice(sorted(matches))
+        return word
+
     def randomTheme(self):
         return random.choice(self.topTokens)
 
@@ -443,7 +771,13 @@ class CardCatalog(object):
         cards.extend(self.complement(land2, [land1, land2], taken, theme))
         return base + sorted(cards, reverse=True)
 
+    def _rowsOf(self, pools):
+        return {key: numpy.array([card.row for card in pool], dtype=numpy.int64)
+                for key, pool in pools.items()}
+
     def _register(self, card):
+        card.row = len(self.cards)
+        self.cards.append(card)
         self.byName[card.name] = card
         self.bySlug[card.name.lower()] = card
         self.byType[card.type].append(card)
@@ -474,6 +808,8 @@ class LocalDBPlugin(DefaultPlugin):
         self.catalog = {}
         self.index = {}
         self.fullnames = {}
+        # Position of each title in the catalog, which breaks ranking ties.
+        self.order = {}
         if not os.path.isdir(self.DB_PATH):
             return
         for f in os.listdir(self.DB_PATH):
@@ -482,6 +818,7 @@ class LocalDBPlugin(DefaultPlugin):
             self.catalog[key] = urllib.parse.quote(os.path.join(self.DB_PATH, f))
             self.fullnames[key] = sanitize(name)
             self.index[key] = name
+            self.order.setdefault(key, len(self.order))
 
     def Complete(self, cards):
         return Catalog.complete(cards)
@@ -495,7 +832,106 @@ class LocalDBPlugin(DefaultPlugin):
     def GetBackUrl(self):
         return '/third_party/images/mtg_detail.jpg'
 
-    def Fetch(self, name, exact, limit=None):
+    def _bounds(self, plan):
+        """Returns the titles that may rank for a search, each with an upper
+           bound on its rank, from the catalog's index rather than a scan of
+           every title.
+
+        Cards failing cost predicates never rank, and all others rank when
+        there are predicates. Otherwise a card must contain some term."""
+
+        index = Catalog.index
+        needle, predicates = plan.needle, plan.predicates
+        bounds = collections.defaultdict(float)
+        # Most rankit gives a term, plus the bonus for query words found.
+        # Only cards holding the term as a token get the point for that, and
+        # only those with it in their name or type the point for this.
+        for terms, bonus in ((plan.parts, 3), (plan.expanded, 0)):
+            for p in terms:
+                most = (len(p.split()) if ' ' in p else 1) + bonus
+                for slug in index.containing(p):
+                    bounds[slug] += most
+                for slug in index.postings.get(p, ()):
+                    bounds[slug] += 1
+                for slug in index.headed(p):
+                    bounds[slug] += 1
+        if predicates:
+            bounds = {slug: bounds.get(slug, 0) + 1
+                      for slug in index.costing(predicates)}
+        titles = {slug: bound for slug, bound in bounds.items()
+                  if slug in self.catalog}
+        # Titles without card metadata can still match by name.
+        if needle in self.catalog:
+            titles[needle] = titles.get(needle, 0) + 20
+        # Cards of good quality get half a point more.
+        for title in titles:
+            card = Catalog.bySlug.get(title)
+            if card and card.goodQuality:
+                titles[title] += 0.5
+        return titles
+
+    def _rank(self, title, plan):
+        needle, predicates = plan.needle, plan.predicates
+        parts, expanded = plan.parts, plan.expanded
+        card = Catalog.bySlug.get(title)
+        rank = 0.0
+        if card and predicates:
+            if costMatches(card.cost, predicates):
+                rank += 1
+            else:
+                return 0
+        if needle == title:
+            rank += 20
+        if card:
+            if card.goodQuality:
+                rank += 0.5
+            has_bonus = [len(parts)]
+            for p in parts:
+                rank += rankit(p, title, card, has_bonus)
+            rank += 3 * has_bonus[0]
+            for p in expanded:
+                rank += rankit(p, title, card, has_bonus)
+        return rank
+
+    def _top(self, bounds, rank, limit):
+        """Returns the titles ranking at least 1, best first, and only the
+           best limit of them unless limit is None or 0.
+
+        Titles are ranked in order of their bounds, stopping once none left
+        can beat the worst of the best found so far."""
+
+        order = self.order
+        if not limit:
+            ranked = []
+            for title in bounds:
+                r = rank(title)
+                if r >= 1:
+                    ranked.append((-r, order[title], title))
+            ranked.sort()
+            return [title for _, _, title in ranked]
+        pending = [(-bound, order[title], title)
+                   for title, bound in bounds.items()]
+        heapq.heapify(pending)
+        # The best so far, worst first, by rank then catalog order.
+        best = []
+        while pending:
+            bound, _, title = heapq.heappop(pending)
+            if len(best) == limit and -bound < best[0][0]:
+                break
+            r = rank(title)
+            if r < 1:
+                continue
+            entry = (r, -order[title], title)
+            if len(best) < limit:
+                heapq.heappush(best, entry)
+            elif entry > best[0]:
+                heapq.heapreplace(best, entry)
+        return [title for _, _, title in sorted(best, reverse=True)]
+
+    def Fetch(self, name, exact, limit=None, explain=False):
+        """Searches the local catalog. With explain, meta also describes the
+           query plan and how long each stage took."""
+
         start = time.time()
         stream, meta = [], {}
         if name == '':
@@ -514,135 +950,51 @@ class LocalDBPlugin(DefaultPlugin):
                     'type': card_type,
                 })
         else:
-            range_expr = r"(\d+)\s*(to|-)\s*(\d+)\s*(mana|cost|cmc)"
-            mana_expr = r"(mana|cost|cmc)\s*(>|<|>=|<=|=|==|)\s*(\d+)"
-            mana_expr2 = r"(\d+)\s*(mana|cost|cmc)"
-            predicates = []
-            def add_pred(op, val):
-                if op == '==':
-                    predicates.append(lambda c: c.cost == val)
-                elif op == '>':
-                    predicates.append(lambda c: c.cost > val)
-                elif op == '>=':
-                    predicates.append(lambda c: c.cost >= val)
-                elif op == '<':
-                    predicates.append(lambda c: c.cost < val)
-                elif op == '<=':
-                    predicates.append(lambda c: c.cost <= val)
-                else:
-                    assert False, op
-            for match in re.finditer(range_expr, needle):
-                needle = re.sub(range_expr, '', needle)
-                lo, hi = int(match.group(1)), int(match.group(3))
-                if lo > hi:
-                    lo, hi = hi, lo
-                logging.info("Using predicate: cost in [%d, %d]" % (lo, hi))
-                add_pred(">=", lo)
-                add_pred("<=", hi)
-            for match in re.finditer(mana_expr, needle):
-                needle = re.sub(mana_expr, '', needle)
-                op, val = match.group(2), int(match.group(3))
-                if op == '=' or op == '':
-                    op = '=='
-                logging.info("Using predicate: cost %s %d" % (op, val))
-                add_pred(op, val)
-            for match in re.finditer(mana_expr2, needle):
-                needle = re.sub(mana_expr2, '', needle)
-                op, val = '==', int(match.group(1))
-                logging.info("Using predicate: cost %s %d" % (op, val))
-                add_pred(op, val)
-            mana = {'red', 'blue', 'white', 'black', 'green'}
-            other_mana = {'dual', 'mono', 'multi', 'colored', 'colorless', 'single', 'two', 'three', 'tri', 'quad', 'four', 'five', 'all', 'rainbow'}
-            def expand(parts):
-                core = []
-                out = []
-                num_mana = 0
-                num_other_mana = 0
-                for p in parts:
-                    if p in mana:
-                        num_mana += 1
-                    if p in other_mana:
-                        num_other_mana += 1
-                    if p in mana or p in other_mana or p == 'x':
-                        out.append('mana=' + p)
-                    else:
-                        core.append(p)
-                if num_other_mana == 0:
-                    if num_mana == 1:
-                        out.append('mana=mono')
-                    elif num_mana == 2:
-                        out.append('mana=dual')
-                    elif num_mana == 3:
-                        out.append('mana=tri')
-                    elif num_mana == 4:
-                        out.append('mana=quad')
-                    elif num_mana == 5:
-                        out.append('mana=all')
-                return core, out
-            ct = 0
-            ranked = collections.defaultdict(list)
-            try:
-                parts = shlex.split(needle)
-            except ValueError:
-                parts = needle.split()
-            parts, expanded = expand(parts)
-            logging.info("Expanded query: " + str(parts) + " " + str(expanded))
-            for title, url in self.catalog.items():
-                card = Catalog.bySlug.get(title)
-                rank = 0.0
-                if card and predicates:
-                    if all([ok(card) for ok in predicates]):
-                        rank += 1
-                    else:
-                        continue
-                if needle == title:
-                    rank += 20
-                def rankit(p, has):
-                    rank = 0
-                    if p in title or p in card.searchtype:
-                        rank += 1
-                    if p in card.searchtokens:
-                        rank += 1
-                    if p in card.searchtext:
-                        if ' ' in p:
-                            rank += len(p.split())
-                        else:
-                            rank += 1
-                    else:
-                        has[0] -= 1
-                    return rank
-                if card:
-                    if card.goodQuality:
-                        rank += 0.5
-                    has_bonus = [len(parts)]
-                    for p in parts:
-                        rank += rankit(p, has_bonus)
-                    rank += 3 * has_bonus[0]
-                    for p in expanded:
-                        rank += rankit(p, has_bonus)
-                if rank >= 1:
-                    ranked[rank].append(title)
-            ranks = sorted(list(ranked.keys()), reverse=True)
-            for r in ranks:
-                for title in ranked[r]:
-                    stream.append({
-                        'name': self.fullnames[title],
-                        'img_url': self.catalog[title],
-                        'info_url': self.catalog[title],
-                    })
-                    ct += 1
-                    if ct >= limit:
-                        break
-                if ct >= limit:
-                    break
+            timings = {}
+            mark = time.time()
+            plan = parseQuery(needle)
+            needle = plan.needle
+            timings['parse'], mark = time.time() - mark, time.time()
+            bounds = self._bounds(plan)
+            timings['candidates'], mark = time.time() - mark, time.time()
+            num_ranked = [0]
+            def rank(title):
+                num_ranked[0] += 1
+                return self._rank(title, plan)
+            titles = self._top(bounds, rank, limit)
+            timings['rank'] = time.time() - mark
+            for title in titles:
+                stream.append({
+                    'name': self.fullnames[title],
+                    'img_url': self.catalog[title],
+                    'info_url': self.catalog[title],
+                })
         meta = {
             'has_more': False,
             'more_url': "",
         }
+        if explain and not exact:
+            timings['total'] = time.time() - start
+            meta['explain'] = {
+                'plan': plan.describe(),
+                'candidates': len(bounds),
+                'ranked': num_ranked[0],
+                'timings_ms': {
+                    stage: round(1000 * t, 3) for stage, t in timings.items()},
+                'plan_cache': parseQuery.cache_info()._asdict(),
+            }
         logging.info("search for '%s' took %.2f ms", needle,
                      1000*(time.time() - start))
         return stream, meta
 
+    def Explain(self, name, exact, limit=None):
+        return self.Fetch(name, exact, limit, explain=True)
+
+
+# Bounds the upstream lookups in flight across every client.
+upstream = ratelimit.ConcurrencyLimit(
+    config.kMaxUpstreamFetches, config.kUpstreamFetchWait, 'upstream lookups')
+
 
 class ScryfallPlugin(DefaultPlugin):
 
@@ -673,19 +1025,20 @@ class ScryfallPlugin(DefaultPlugin):
         data = None
         errors = []
 
-        try:
-            with self._direct_opener.open(req, timeout=10) as resp:
-                data = resp.read().decode('utf-8', errors='ignore')
-        except (urllib.error.HTTPError, urllib.error.URLError, TimeoutError) as e:
-            errors.append(('direct', e))
-            logging.warning("Scryfall direct request failed, retrying with system proxy config: %s", e)
-
-        if data is None:
+        with upstream:
             try:
-                with urllib.request.urlopen(req, timeout=10) as resp:
+                with self._direct_opener.open(req, timeout=10) as resp:
                     data = resp.read().decode('utf-8', errors='ignore')
             except (urllib.error.HTTPError, urllib.error.URLError, TimeoutError) as e:
-                errors.append(('default', e))
+                errors.append(('direct', e))
+                logging.warning("Scryfall direct request failed, retrying with system proxy config: %s", e)
+
+            if data is None:
+                try:
+                    with urllib.request.urlopen(req, timeout=10) as resp:
+                        data = resp.read().decode('utf-8', errors='ignore')
+                except (urllib.error.HTTPError, urllib.error.URLError, TimeoutError) as e:
+                    errors.append(('default', e))
 
         if data is None:
             details = '; '.join(["%s=%s" % (kind, err) for kind, err in errors])
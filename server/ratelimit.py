@@ -0,0 +1,92 @@
+# Admission control for requests that are expensive to serve.
+
+import threading
+import time
+import weakref
+
+
+class RetryLater(Exception):
+    """Raised for a request turned away for now. The client may send it
+       again after retry_after seconds."""
+
+    def __init__(self, msg, retry_after):
+        Exception.__init__(self, msg)
+        self.retry_after = retry_after
+
+
+class TokenBucket(object):
+    """Admits rate requests per second on average, and up to burst at once."""
+
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self._tokens = self.burst
+        self._last = time.time()
+        self._lock = threading.Lock()
+
+    def take(self, now=None):
+        """Takes a token, returning 0, or if there is none, the seconds until
+           there will be one."""
+
+        with self._lock:
+            now = time.time() if now is None else now
+            elapsed = max(0, now - self._last)
+            self._tokens = min(self.burst, self._tokens + elapsed * self.rate)
+            self._last = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0
+            return (1 - self._tokens) / self.rate
+
+
+class RateLimiter(object):
+    """Keeps a token bucket for each key and request type.
+
+    limits maps request types to (rate, burst); other request types are not
+    limited. With weak set, buckets go away with their keys, which must then
+    be weakly referenceable."""
+
+    def __init__(self, limits, weak=False):
+        self.limits = limits
+        self._lock = threading.Lock()
+        self._buckets = weakref.WeakKeyDictionary() if weak else {}
+        self.num_rejected = 0
+
+    def check(self, key, reqtype, now=None):
+        """Raises RetryLater if key may not make a reqtype request now."""
+
+        limit = self.limits.get(reqtype)
+        if limit is None:
+            return
+        with self._lock:
+            buckets = self._buckets.get(key)
+            if buckets is None:
+                buckets = self._buckets[key] = {}
+            bucket = buckets.get(reqtype)
+            if bucket is None:
+                bucket = buckets[reqtype] = TokenBucket(*limit)
+        wait = bucket.take(now)
+        if wait:
+            with self._lock:
+                self.num_rejected += 1
+            raise RetryLater(
+                "too many '%s' requests" % reqtype, round(wait, 3))
+
+
+class ConcurrencyLimit(object):
+    """Caps how many callers may be inside it at once. Callers wait up to
+       timeout seconds for a slot, then get RetryLater."""
+
+    def __init__(self, limit, timeout, what):
+        self.timeout = timeout
+        self.what = what
+        self._slots = threading.BoundedSemaphore(limit)
+
+    def __enter__(self):
+        if not self._slots.acquire(timeout=self.timeout):
+            raise RetryLater("too many %s in progress" % self.what,
+                             self.timeout)
+        return self
+
+    def __exit__(self, *exc_info):
+        self._slots.release()
@@ -0,0 +1,483 @@
+# Serves games from several worker processes behind one websocket port.
+#
+# The supervisor accepts websocket clients and relays each one's frames to
+# a worker over a Unix socket. Workers are plain Kansas servers (see
+# aio_server.py) that only restore and host the games they own. Each
+# (scope, sourceid, gameid) is owned by a fixed worker, chosen by consistent
+# hashing, so a client is moved to the owning worker when it connects to a
+# game. list_games and end_game are sent to every worker or the owning one;
+# the supervisor caps the games listed in a scope, ending the rest.
+#
+# Workers share the database, which must be the sqlite store, since leveldb
+# allows one process only. Shared tables commit each write at once, so no
+# worker holds the write lock for a group-commit window. Game snapshots and
+# journals, which take most writes, are kept in a DB of each worker's own;
+# before the workers start, the supervisor moves stored games into their
+# owners' DBs, and migrates the image cache. list_scope and clone_scope
+# only see the games of the worker serving them.
+
+from server import codec
+from server import config
+
+import asyncio
+import bisect
+import glob
+import hashlib
+import html
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import struct
+import tempfile
+import time
+
+from websockets.asyncio.server import serve
+from websockets.exceptions import ConnectionClosed
+
+_HEADER = struct.Struct('!IB')
+_TEXT = 0
+_BINARY = 1
+
+
+def _escaped(s):
+    # Workers see request strings escaped as by kansas_wsh.escape_text, so
+    # keys are hashed in that form.
+    return html.escape(str(s)).replace('"', "'")
+
+
+def _texts(data, *keys):
+    """Whether data is an object with strings at all of keys."""
+
+    return isinstance(data, dict) and all(
+        isinstance(data.get(k), str) for k in keys)
+
+
+def _future_id(frame):
+    try:
+        return codec.decode(frame).get('future_id')
+    except Exception:
+        return None
+
+
+def _hash(key):
+    return int.from_bytes(hashlib.sha1(key.encode('utf-8')).digest()[:8], 'big')
+
+
+class ShardRing(object):
+    """Maps keys to workers by consistent hashing."""
+
+    def __init__(self, num_workers, replicas=64):
+        self.num_workers = num_workers
+        points = sorted(
+            (_hash('%d:%d' % (worker, i)), worker)
+            for worker in range(num_workers) for i in range(replicas))
+        self._hashes = [h for h, _ in points]
+        self._workers = [w for _, w in points]
+
+    def owner(self, *key):
+        i = bisect.bisect(self._hashes, _hash('\0'.join(map(str, key))))
+        return self._workers[i % len(self._workers)]
+
+
+def write_frame(writer, frame):
+    if isinstance(frame, str):
+        frame, kind = frame.encode('utf-8'), _TEXT
+    else:
+        kind = _BINARY
+    writer.write(_HEADER.pack(len(frame), kind) + frame)
+
+
+async def read_frame(reader):
+    """Returns the next frame, or None at end of stream."""
+
+    try:
+        size, kind = _HEADER.unpack(await reader.readexactly(_HEADER.size))
+        frame = await reader.readexactly(size)
+    except (asyncio.IncompleteReadError, ConnectionError):
+        return None
+    if kind == _TEXT:
+        return frame.decode('utf-8')
+    return frame
+
+
+async def _frames(reader):
+    while True:
+        frame = await read_frame(reader)
+        if frame is None:
+            return
+        yield frame
+
+
+def socket_path(socket_dir, worker):
+    return os.path.join(socket_dir, 'worker-%d.sock' % worker)
+
+
+class _Upstream(object):
+    """A relayed client connection to one worker."""
+
+    def __init__(self, worker, reader, writer):
+        self.worker = worker
+        self.reader = reader
+        self.writer = writer
+        # The future_ids of requests relayed here that are not answered yet,
+        # kept until the client connects to a game.
+        self.pending = set()
+
+    @classmethod
+    async def open(cls, socket_dir, worker, remote_addr):
+        reader, writer = await asyncio.open_unix_connection(
+            socket_path(socket_dir, worker))
+        # The first frame tells the worker who the client is.
+        write_frame(writer, json.dumps({'remote_addr': list(remote_addr[:2])}))
+        return cls(worker, reader, writer)
+
+    async def send(self, frame):
+        write_frame(self.writer, frame)
+        await self.writer.drain()
+
+    async def recv(self):
+        return await read_frame(self.reader)
+
+    def close(self):
+        self.writer.close()
+
+
+class ShardProxy(object):
+    """Relays one websocket client to the worker owning its game.
+
+    Until the client connects to a game, its requests are decoded to route
+    them; afterwards frames are passed through untouched."""
+
+    def __init__(self, supervisor, conn):
+        self.supervisor = supervisor
+        self.ring = supervisor.ring
+        self.conn = conn
+        self.remote_addr = conn.remote_address
+        self.scope = None
+        self.set_scope = None
+        self.upstream = None
+        self.connected = False
+        self._pumps = []
+
+    async def _attach(self, worker, replay=True):
+        """Relays the client to worker, replaying its set_scope there. The
+           previous worker is still relayed until it has answered the
+           requests sent to it."""
+
+        upstream = await self._open(worker, replay)
+        previous, self.upstream = self.upstream, upstream
+        if previous is not None and not previous.pending:
+            previous.close()
+        self._pumps = [pump for pump in self._pumps if not pump.done()]
+        self._pumps.append(asyncio.ensure_future(self._relay(upstream)))
+
+    async def _open(self, worker, replay):
+        upstream = await _Upstream.open(
+            self.supervisor.socket_dir, worker, self.remote_addr)
+        if replay and self.set_scope is not None:
+            await upstream.send(self.set_scope)
+            # The client already has its set_scope reply.
+            await upstream.recv()
+        return upstream
+
+    async def _relay(self, upstream):
+        try:
+            while upstream is self.upstream or upstream.pending:
+                frame = await upstream.recv()
+                if frame is None:
+                    break
+                if not self.connected or upstream is not self.upstream:
+                    upstream.pending.discard(_future_id(frame))
+                await self.conn.send(frame)
+            if upstream is self.upstream:
+                await self.conn.close()
+        finally:
+            upstream.close()
+
+    async def _call(self, worker, frame, reply=True):
+        """Sends frame to worker on a connection of its own, returning the
+           reply if one is expected."""
+
+        upstream = await self._open(worker, True)
+        try:
+            await upstream.send(frame)
+            if reply:
+                return await upstream.recv()
+        finally:
+            upstream.close()
+
+    async def _list_games(self, frame):
+        replies = await asyncio.gather(*[
+            self._call(worker, frame)
+            for worker in range(self.ring.num_workers)])
+        replies = [codec.decode(r) for r in replies if r is not None]
+        replies = [r for r in replies if r.get('type') == 'list_games_resp']
+        if not replies:
+            return
+        merged = replies[0]
+        ranked = sorted(
+            [game for r in replies for game in r['data']],
+            key=lambda game: (not game['presence'], -game['last_used']))
+        # Each worker caps only the games it owns, so the scope's cap is
+        # enforced here, ending the least recently used games past it.
+        merged['data'] = ranked[:config.kMaxGamesPerScope]
+        wire = codec.for_frame(frame)
+        await asyncio.gather(*[
+            self._end_game(wire, html.unescape(game['gameid']))
+            for game in ranked[config.kMaxGamesPerScope:]])
+        await self.conn.send(wire.encode(merged))
+
+    async def _end_game(self, wire, gameid):
+        await self._call(
+            self.ring.owner(*(self.scope + (_escaped(gameid),))),
+            wire.encode({'type': 'end_game', 'data': gameid}), reply=False)
+
+    async def run(self):
+        await self._attach(self.ring.owner(*self.remote_addr[:2]), False)
+        try:
+            async for frame in self.conn:
+                if self.connected:
+                    await self.upstream.send(frame)
+                else:
+                    await self._route(frame)
+        except (ConnectionClosed, ConnectionError):
+            pass
+        finally:
+            for pump in self._pumps:
+                pump.cancel()
+            self.upstream.close()
+
+    async def _route(self, frame):
+        """Sends frame where it belongs. Requests missing what they are
+           routed by go to the current worker, which replies with the error
+           as a lone server would."""
+
+        try:
+            req = codec.decode(frame)
+            reqtype, data = req['type'], req.get('data')
+        except Exception:
+            reqtype = data = None
+        if reqtype == 'set_scope' and _texts(data, 'scope', 'datasource'):
+            self.scope = (_escaped(data['scope']),
+                          _escaped(data['datasource']))
+            self.set_scope = frame
+            await self._attach(self.ring.owner(*self.scope), False)
+        elif (reqtype == 'connect' and self.scope is not None
+                and _texts(data, 'gameid', 'uuid', 'user')
+                and 'orient' in data):
+            owner = self.ring.owner(
+                *(self.scope + (_escaped(data['gameid']),)))
+            if owner != self.upstream.worker:
+                await self._attach(owner)
+            self.connected = True
+        elif reqtype == 'list_games' and self.scope is not None:
+            await self._list_games(frame)
+            return
+        elif (reqtype == 'end_game' and self.scope is not None
+                and isinstance(data, str)):
+            await self._call(
+                self.ring.owner(*(self.scope + (_escaped(data),))), frame,
+                reply=False)
+            return
+        future_id = req.get('future_id') if reqtype else None
+        if isinstance(future_id, (int, str)):
+            self.upstream.pending.add(future_id)
+        await self.upstream.send(frame)
+
+
+def game_db_path(db_path, worker, num_workers):
+    """Returns where a worker stores its games. A lone server stores them
+       in the main DB."""
+
+    if num_workers == 1:
+        return db_path
+    return os.path.join(db_path, 'shard-%d' % worker)
+
+
+def place_games(db_path, num_workers):
+    """Moves stored games and their journals into the game DB of the worker
+       owning them, e.g. after the number of workers changed. Returns the
+       number of games moved."""
+
+    from server import namespaces
+
+    sources = sorted(glob.glob(os.path.join(db_path, 'shard-*')))
+    if num_workers > 1:
+        sources.insert(0, db_path)
+    ring = ShardRing(num_workers)
+    tables = {}
+
+    def open_tables(path):
+        if path not in tables:
+            tables[path] = (
+                namespaces.Namespace(path, 'Games', version=2),
+                namespaces.Namespace(path, 'GameJournal', version=0))
+        return tables[path]
+
+    moved = 0
+    for source in sources:
+        games, journal = open_tables(source)
+        for key, snapshot in games.List():
+            _, subspace, gameid = key.split('\0')
+            scope, sourceid = subspace.split('::', 1)
+            target = game_db_path(
+                db_path, ring.owner(scope, sourceid, gameid), num_workers)
+            if target == source:
+                continue
+            old_journal = journal.Subspace(subspace).Subspace(gameid)
+            new_games, new_journal = open_tables(target)
+            with new_journal.Subspace(subspace).Subspace(gameid).Batch() as batch:
+                for seqno, entry in old_journal:
+                    batch.Put(seqno, entry)
+            new_games.Subspace(subspace).Put(gameid, snapshot)
+            namespaces.FlushAll()
+            with old_journal.Batch() as batch:
+                for seqno in old_journal.Keys():
+                    batch.Delete(seqno)
+            games.Subspace(subspace).Delete(gameid)
+            moved += 1
+    namespaces.FlushAll()
+    if moved:
+        logging.info("Moved %d games to the workers owning them.", moved)
+    return moved
+
+
+def prepare_storage(db_path, num_workers):
+    """Readies the DB and image cache for num_workers servers. Runs once,
+       before any of them start."""
+
+    from server import imagecache
+    from server import namespaces
+
+    place_games(db_path, num_workers)
+    imagecache.MigrateCache()
+    namespaces.FlushAll()
+
+
+class Supervisor(object):
+    """Starts the workers and relays websocket clients to them."""
+
+    def __init__(self, num_workers, debug=False, db_path=None):
+        self.ring = ShardRing(num_workers)
+        self.socket_dir = tempfile.mkdtemp(prefix='kansas-shards-')
+        self.debug = debug
+        self.db_path = db_path or config.kDBPath
+        self.workers = []
+
+    def start_workers(self, timeout=60):
+        prepare_storage(self.db_path, self.ring.num_workers)
+        ctx = multiprocessing.get_context('spawn')
+        for worker in range(self.ring.num_workers):
+            process = ctx.Process(
+                target=run_worker, name='kansas-worker-%d' % worker,
+                args=(worker, self.ring.num_workers, self.socket_dir,
+                      self.db_path, self.debug))
+            process.daemon = True
+            process.start()
+            self.workers.append(process)
+        deadline = time.time() + timeout
+        for worker in range(self.ring.num_workers):
+            while not os.path.exists(socket_path(self.socket_dir, worker)):
+                if time.time() > deadline or not self.workers[worker].is_alive():
+                    raise RuntimeError("worker %d failed to start" % worker)
+                time.sleep(0.05)
+
+    def stop_workers(self):
+        for process in self.workers:
+            process.terminate()
+        for process in self.workers:
+            process.join()
+        shutil.rmtree(self.socket_dir, ignore_errors=True)
+
+    async def handle(self, conn):
+        # Only /kansas websocket path is expected by the browser client.
+        if conn.request.path != "/kansas":
+            await conn.close(1008, "Unsupported websocket path")
+            return
+        await ShardProxy(self, conn).run()
+
+    def serve(self, host, port):
+        return serve(self.handle, host, port,
+                     compression=config.kWireCompression)
+
+
+async def run(port, num_workers, debug=False, host="0.0.0.0"):
+    supervisor = Supervisor(num_workers, debug)
+    supervisor.start_workers()
+    try:
+        async with supervisor.serve(host, port) as server:
+            print(f"WebSocket server listening on ws://localhost:{port}/kansas"
+                  f" with {num_workers} workers")
+            await server.serve_forever()
+    finally:
+        supervisor.stop_workers()
+
+
+def run_worker(worker, num_workers, socket_dir, db_path, debug=False):
+    """Entry point of a worker process."""
+
+    logging.basicConfig(
+        level=debug and logging.DEBUG or logging.INFO,
+        format="%(asctime)s %(levelname)s [worker-" + str(worker) + "] %(message)s")
+    from server import namespaces
+
+    if namespaces.leveldb is not None:
+        raise SystemExit("sharded mode needs the sqlite store, not leveldb")
+    # Set before the modules below open their tables.
+    config.kDBPath = db_path
+    config.kGameDBPath = game_db_path(db_path, worker, num_workers)
+    config.kCacheSweeper = worker == 0
+    namespaces.SetCommitWindow(db_path, 0)
+
+    from server import aio_server
+    from server import imagecache
+    from server import kansas_wsh
+
+    ring = ShardRing(num_workers)
+    kansas_wsh.owns_game = (
+        lambda scope, sourceid, gameid:
+            ring.owner(scope, sourceid, gameid) == worker)
+    if config.kCacheSweeper:
+        # Games served by other workers must not have their images evicted.
+        # Their snapshots are written within kSnapshotFlushInterval, and new
+        # images are the last to be evicted anyway.
+        stores = [
+            namespaces.Namespace(
+                game_db_path(db_path, w, num_workers), 'Games', version=2)
+            for w in range(num_workers)]
+        imagecache.sweeper.AddPinSource(lambda: set().union(
+            *[kansas_wsh.stored_image_paths(games) for games in stores]))
+    server = aio_server.KansasServer()
+
+    async def handle(reader, writer):
+        header = await read_frame(reader)
+        if header is None:
+            writer.close()
+            return
+        header = json.loads(header)
+        stream = aio_server.AsyncStream(
+            header['remote_addr'],
+            lambda frame: _send(writer, frame),
+            lambda: _close(writer),
+            server.game_executor)
+        await server.serve_connection(stream, _frames(reader))
+
+    async def main():
+        path = socket_path(socket_dir, worker)
+        async with await asyncio.start_unix_server(handle, path + '.tmp'):
+            # Appears once the worker is ready for connections.
+            os.rename(path + '.tmp', path)
+            await asyncio.Event().wait()
+
+    asyncio.run(main())
+
+
+async def _send(writer, frame):
+    write_frame(writer, frame)
+    await writer.drain()
+
+
+async def _close(writer):
+    writer.close()
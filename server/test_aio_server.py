@@ -0,0 +1,106 @@
+import asyncio
+import json
+import threading
+import unittest
+from unittest import mock
+
+try:
+    from websockets.asyncio.client import connect
+    from server import aio_server
+    from server import codec
+    from server import kansas_wsh
+except ImportError:
+    aio_server = None
+
+
+@unittest.skipIf(aio_server is None, "websockets is not installed")
+class KansasServerTest(unittest.TestCase):
+    SCOPE = '__test_aio_server__'
+
+    def run_with_server(self, client):
+        async def main():
+            server = aio_server.KansasServer(game_workers=2, slow_workers=2)
+            async with server.serve('127.0.0.1', 0) as ws_server:
+                port = ws_server.sockets[0].getsockname()[1]
+                return await client('ws://127.0.0.1:%d/kansas' % port)
+        return asyncio.run(main())
+
+    async def call(self, ws, reqtype, data, future_id):
+        await ws.send(json.dumps(
+            {'type': reqtype, 'data': data, 'future_id': future_id}))
+        while True:
+            msg = json.loads(await ws.recv())
+            if msg.get('future_id') == future_id:
+                return msg
+
+    def test_serves_requests(self):
+        async def client(url):
+            async with connect(url, proxy=None) as ws:
+                scope = await self.call(ws, 'set_scope', {
+                    'scope': self.SCOPE, 'datasource': 'pokerdb'}, 1)
+                ping = await self.call(ws, 'ping', {}, 2)
+                games = await self.call(ws, 'list_games', None, 3)
+                bad = await self.call(ws, 'list_scope', {}, 4)
+                return scope, ping, games, bad
+
+        scope, ping, games, bad = self.run_with_server(client)
+        self.assertEqual(scope['type'], 'set_scope_resp')
+        self.assertEqual(ping['data'], 'pong')
+        self.assertEqual(games['type'], 'list_games_resp')
+        self.assertEqual(bad['type'], 'error')
+
+    @unittest.skipIf(codec.COMPACT is None, "msgpack is not installed")
+    def test_negotiates_compact_wire_format(self):
+        async def client(url):
+            async with connect(url, proxy=None) as ws:
+                scope = await self.call(ws, 'set_scope', {
+                    'scope': self.SCOPE, 'datasource': 'pokerdb',
+                    'wire': 'compact'}, 1)
+                await ws.send(codec.COMPACT.encode(
+                    {'type': 'ping', 'data': {}, 'future_id': 2}))
+                return scope, await ws.recv()
+
+        scope, pong = self.run_with_server(client)
+        self.assertEqual(scope['data']['wire'], 'compact')
+        self.assertIsInstance(pong, bytes)
+        self.assertEqual(codec.decode(pong)['data'], 'pong')
+
+    def test_idle_connections_do_not_take_threads(self):
+        async def client(url):
+            before = threading.active_count()
+            conns = [await connect(url, proxy=None) for _ in range(50)]
+            for i, ws in enumerate(conns):
+                await self.call(ws, 'ping', {}, i)
+            during = threading.active_count()
+            for ws in conns:
+                await ws.close()
+            return during - before
+
+        self.assertLess(self.run_with_server(client), 10)
+
+    def test_reads_do_not_hold_up_later_requests(self):
+        release = threading.Event()
+        threads = []
+
+        def slow_query(request, output):
+            threads.append(threading.current_thread().name)
+            release.wait(5)
+            output.reply([])
+
+        async def client(url):
+            async with connect(url, proxy=None) as ws:
+                await ws.send(json.dumps({
+                    'type': 'query', 'future_id': 1, 'data': {'term': 'x'}}))
+                await ws.send(json.dumps(
+                    {'type': 'ping', 'data': {}, 'future_id': 2}))
+                pong = json.loads(await asyncio.wait_for(ws.recv(), 2))
+                release.set()
+                return pong, json.loads(await ws.recv())
+
+        with mock.patch.dict(kansas_wsh.initHandler.handlers,
+                             query=slow_query):
+            pong, results = self.run_with_server(client)
+        self.assertEqual(pong['future_id'], 2)
+        self.assertEqual(results['future_id'], 1)
+        # Reads share the pool sized by kReadOnlyWorkers with --threaded.
+        self.assertTrue(threads[0].startswith('kansas-read'), threads)
@@ -0,0 +1,52 @@
+import unittest
+from unittest import mock
+
+from server import codec
+
+
+class JSONCodecTest(unittest.TestCase):
+    def test_peek_type(self):
+        self.assertEqual(
+            codec.JSON.peek_type(codec.JSON.encode({'type': 'bulk_add'})),
+            'bulk_add')
+        self.assertEqual(
+            codec.JSON.peek_type('{"data": 1, "type": "presence"}'), 'presence')
+        self.assertIsNone(codec.JSON.peek_type('not json'))
+
+    def test_unknown_codec_falls_back_to_json(self):
+        self.assertIs(codec.negotiate('carrier-pigeon'), codec.JSON)
+        self.assertIs(codec.for_stream(mock.Mock()), codec.JSON)
+
+
+@unittest.skipIf(codec.COMPACT is None, "msgpack is not installed")
+class CompactCodecTest(unittest.TestCase):
+    BULKUPDATE = {
+        'type': 'bulkupdate',
+        'data': [{
+            'dest_type': 'board',
+            'dest_key': 5,
+            'updates': [{
+                'move': {'card': 1, 'dest_type': 'board', 'dest_key': 5,
+                         'dest_orient': 1},
+                'old_type': 'hands',
+                'old_key': 'bob',
+            }],
+            'z_stack': [3, 1],
+        }],
+        'time': 1.5,
+    }
+
+    def test_round_trip(self):
+        frame = codec.COMPACT.encode(self.BULKUPDATE)
+        self.assertIsInstance(frame, bytes)
+        self.assertNotIn(b'dest_type', frame)
+        self.assertLess(len(frame), len(codec.JSON.encode(self.BULKUPDATE)))
+        self.assertEqual(codec.decode(frame), self.BULKUPDATE)
+        self.assertEqual(codec.COMPACT.peek_type(frame), 'bulkupdate')
+
+    def test_card_ids_stay_integers(self):
+        msg = {'type': 'connect_resp', 'data': [{'urls': {1: 'a.jpg'}}, 1000]}
+        self.assertEqual(codec.decode(codec.COMPACT.encode(msg)), msg)
+
+    def test_binary_json_is_still_json(self):
+        self.assertIs(codec.for_frame(b'{"type": "ping"}'), codec.JSON)
@@ -0,0 +1,212 @@
+import http.server
+import os
+import shutil
+import stat
+import subprocess
+import sys
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from server import config
+from server import imagecache
+
+
+class HashNameTest(unittest.TestCase):
+    def test_name_is_stable_across_processes(self):
+        url = 'https://cards.example/lotus.jpg'
+        out = subprocess.check_output([
+            sys.executable, '-c',
+            'from server import imagecache; '
+            'print(imagecache._toHashName(%r))' % url])
+        self.assertEqual(out.decode().strip(), imagecache._toHashName(url))
+
+    def test_name_is_sharded(self):
+        name = imagecache._toHashName('https://cards.example/lotus.jpg')
+        shard, base = os.path.split(name)
+        self.assertEqual(shard, base[:2])
+
+
+class MigrateCacheTest(unittest.TestCase):
+    URL = 'https://cards.example/__test_migrate__.jpg'
+
+    def setUp(self):
+        self.cache = tempfile.mkdtemp()
+        patcher = mock.patch.object(config, 'kCachePath', self.cache)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        imagecache.CacheMap.Delete(self.URL)
+        for key in list(imagecache.Relocations.Keys()):
+            if key.startswith(self.cache):
+                imagecache.Relocations.Delete(key)
+        shutil.rmtree(self.cache)
+
+    def test_moves_legacy_files_and_variants(self):
+        old_path = os.path.join(self.cache, '1f2e3d.jpg')
+        for path in [old_path, old_path[:-4] + '@92x131.jpg']:
+            with open(path, 'wb') as f:
+                f.write(b'jpeg')
+        imagecache._LegacyCacheMap.Put(self.URL, '1f2e3d.jpg')
+
+        self.assertEqual(imagecache.MigrateCache(), 1)
+
+        new_path = imagecache.Cached(self.URL, dont_fetch=True)
+        self.assertTrue(os.path.exists(new_path))
+        self.assertFalse(os.path.exists(old_path))
+        self.assertEqual(imagecache.Relocated(old_path), new_path)
+        self.assertTrue(os.path.exists(
+            imagecache.VariantPath(new_path, '@92x131.jpg')))
+        self.assertEqual(imagecache.CachePeek(self.URL),
+                         imagecache._toHashName(self.URL))
+        self.assertIsNone(imagecache._LegacyCacheMap.Get(self.URL))
+        self.assertEqual(imagecache.MigrateCache(), 0)
+
+    def test_resumes_after_failed_move(self):
+        old_path = os.path.join(self.cache, '1f2e3d.jpg')
+        variant = old_path[:-4] + '@92x131.jpg'
+        for path in [old_path, variant]:
+            with open(path, 'wb') as f:
+                f.write(b'jpeg')
+        imagecache._LegacyCacheMap.Put(self.URL, '1f2e3d.jpg')
+
+        replace = os.replace
+        def fail_on_variant(src, dst):
+            if src == variant:
+                raise OSError("disk full")
+            replace(src, dst)
+        with mock.patch.object(imagecache.os, 'replace', fail_on_variant):
+            with self.assertRaises(OSError):
+                imagecache.MigrateCache()
+        new_path = os.path.join(self.cache, imagecache._toHashName(self.URL))
+        self.assertEqual(imagecache.Relocated(old_path), new_path)
+
+        self.assertEqual(imagecache.MigrateCache(), 1)
+        self.assertEqual(imagecache.Cached(self.URL, dont_fetch=True), new_path)
+        self.assertTrue(os.path.exists(
+            imagecache.VariantPath(new_path, '@92x131.jpg')))
+        self.assertIsNone(imagecache._LegacyCacheMap.Get(self.URL))
+
+
+class CacheSweeperTest(unittest.TestCase):
+    URLS = ['https://cards.example/__test_sweep_%d__.jpg' % i for i in range(3)]
+
+    def setUp(self):
+        self.cache = tempfile.mkdtemp()
+        patcher = mock.patch.object(config, 'kCachePath', self.cache)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.paths = []
+        for i, url in enumerate(self.URLS):
+            name = imagecache._toHashName(url)
+            path = os.path.join(self.cache, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            for p in [path, imagecache.VariantPath(path, '@92x131.jpg')]:
+                with open(p, 'wb') as f:
+                    f.write(b'x' * 10)
+            imagecache.CacheMap.Put(url, {'name': name, 'atime': 100 + i})
+            self.paths.append(path)
+        self.sweeper = imagecache.CacheSweeper(60)
+
+    def tearDown(self):
+        for url in self.URLS:
+            imagecache.CacheMap.Delete(url)
+        shutil.rmtree(self.cache)
+
+    def test_evicts_least_recently_used_unpinned(self):
+        self.sweeper.AddPinSource(lambda: [
+            imagecache.VariantPath(self.paths[0], '@92x131.jpg')])
+        self.sweeper.Touch(self.URLS[1])
+        self.assertEqual(self.sweeper.Sweep(max_bytes=1000, max_files=4), 1)
+        self.assertEqual(
+            [os.path.exists(p) for p in self.paths], [True, True, False])
+        self.assertIsNone(imagecache.CacheMap.Get(self.URLS[2]))
+        self.assertIsNotNone(imagecache.CacheMap.Get(self.URLS[1]))
+
+    def test_within_budget_is_noop(self):
+        self.assertEqual(self.sweeper.Sweep(max_bytes=60, max_files=6), 0)
+        self.assertTrue(all(os.path.exists(p) for p in self.paths))
+
+
+class _ImageHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    body = b'\xff\xd8jpeg' * 50000
+
+    def do_GET(self):
+        if self.headers.get('If-None-Match') == '"v1"':
+            self.send_response(304)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('ETag', '"v1"')
+        self.send_header('Content-Length', str(len(self.body)))
+        self.end_headers()
+        self.wfile.write(self.body)
+
+    def log_message(self, *args):
+        pass
+
+
+class DownloadTest(unittest.TestCase):
+    def setUp(self):
+        self.cache = tempfile.mkdtemp()
+        patcher = mock.patch.object(config, 'kCachePath', self.cache)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.server = http.server.ThreadingHTTPServer(
+            ('127.0.0.1', 0), _ImageHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = 'http://127.0.0.1:%d/card.jpg' % self.server.server_port
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        imagecache.CacheMap.Delete(self.url)
+        shutil.rmtree(self.cache)
+
+    def test_streams_and_revalidates_over_one_connection(self):
+        connects = imagecache.pool.num_connects
+        path = imagecache.Cached(self.url)
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), _ImageHandler.body)
+        self.assertEqual(imagecache.CacheMap.Get(self.url)['etag'], '"v1"')
+        self.assertEqual(os.listdir(os.path.dirname(path)),
+                         [os.path.basename(path)])
+
+        self.assertFalse(imagecache.Refresh(self.url))
+        self.assertEqual(imagecache.pool.num_connects - connects, 1)
+
+    def test_download_is_world_readable(self):
+        path = imagecache.Cached(self.url)
+        self.assertEqual(stat.S_IMODE(os.stat(path).st_mode),
+                         imagecache.thumbnails.kFileMode)
+
+    def test_changed_image_replaces_variants_in_place(self):
+        path = imagecache.Cached(self.url)
+        variant = imagecache.VariantPath(path, '@92x131.jpg')
+        with open(variant, 'wb') as f:
+            f.write(b'old')
+        entry = imagecache.CacheMap.Get(self.url)
+        entry['etag'] = '"v0"'
+        imagecache.CacheMap.Put(self.url, entry)
+        with mock.patch.object(imagecache.thumbnails.service,
+                               'Generate') as generate:
+            self.assertTrue(imagecache.Refresh(self.url))
+        generate.assert_called_once_with(path, replace=True)
+        self.assertTrue(os.path.exists(variant))
+        self.assertEqual(imagecache.CacheMap.Get(self.url)['etag'], '"v1"')
+
+    def test_failed_download_leaves_no_file(self):
+        with mock.patch.object(config, 'kImageFetchTimeout', -1):
+            with self.assertRaises(TimeoutError):
+                imagecache.Cached(self.url)
+        self.assertIsNone(imagecache.Cached(self.url, dont_fetch=True))
+        self.assertEqual(
+            os.listdir(os.path.join(self.cache, imagecache._toHashName(self.url)[:2])), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from server import namespaces
+
+
+class _TempDBTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        db = namespaces._databases.pop(self.path, None)
+        if db is not None:
+            db.Flush()
+            db.conn.close()
+        namespaces._meta.pop(self.path, None)
+        shutil.rmtree(self.path)
+
+
+class NamespaceBatchTest(_TempDBTest):
+    def _committed_rows(self):
+        conn = sqlite3.connect(os.path.join(self.path, 'kansas.sqlite3'))
+        try:
+            return conn.execute('SELECT COUNT(*) FROM kv').fetchone()[0]
+        finally:
+            conn.close()
+
+    def test_batch_applies_puts_and_deletes(self):
+        ns = namespaces.Namespace(self.path, 'Test')
+        ns.Put('stale', 1)
+        with ns.Batch() as batch:
+            batch.Delete('stale')
+            batch.Put('a', {'x': 1})
+            batch.Put('b', [2])
+        self.assertEqual(ns.List(), [('a', {'x': 1}), ('b', [2])])
+
+    def test_unregistered_version_leaves_meta_alone(self):
+        ns = namespaces.Namespace(self.path, 'Test', version=2)
+        old = namespaces.Namespace(self.path, 'Test', version=1,
+                                   _register=False)
+        old.Put('a', 1)
+        self.assertEqual(ns.Get('a'), None)
+        self.assertEqual(dict(namespaces.ListNamespaces(self.path))['Test'][1], 2)
+
+    def test_batch_discarded_on_error(self):
+        ns = namespaces.Namespace(self.path, 'Test')
+        with self.assertRaises(RuntimeError):
+            with ns.Batch() as batch:
+                batch.Put('a', 1)
+                raise RuntimeError()
+        self.assertIsNone(ns.Get('a'))
+
+    def test_group_commit_waits_for_flush(self):
+        db = namespaces._SQLiteCompatDB(self.path, commit_window=60)
+        namespaces._databases[self.path] = db
+        ns = namespaces.Namespace(self.path, 'Test')
+        for i in range(10):
+            ns.Put(i, i)
+        self.assertEqual(ns.Get(3), 3)
+        self.assertEqual(self._committed_rows(), 0)
+        db.Flush()
+        self.assertEqual(self._committed_rows(), 11)
+        self.assertEqual(db.num_commits, 1)
+
+
+class NamespaceIterTest(_TempDBTest):
+    def setUp(self):
+        _TempDBTest.setUp(self)
+        self.ns = namespaces.Namespace(self.path, 'Test')
+        with self.ns.Batch() as batch:
+            for i in range(20):
+                batch.Put('k%02d' % i, i)
+
+    def test_keys_skips_values(self):
+        self.ns.serializer = None
+        self.assertEqual(
+            list(self.ns.Keys()), ['k%02d' % i for i in range(20)])
+
+    def test_limit_and_start_after(self):
+        self.assertEqual(list(self.ns.Keys(limit=3)), ['k00', 'k01', 'k02'])
+        self.assertEqual(
+            self.ns.List(limit=2, start_after='k05'), [('k06', 6), ('k07', 7)])
+        self.assertEqual(list(self.ns.Keys(start_after='k19')), [])
+
+    def test_streams_across_pages(self):
+        db = namespaces._databases[self.path]
+        db.kRangePageSize = 3
+        self.assertEqual([v for _, v in self.ns], list(range(20)))
+        self.assertEqual(len(list(self.ns.Subspace('other').Keys())), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+import json
+import threading
+import time
+import unittest
+
+from server import outbound
+
+
+def _msg(reqtype, data):
+    return json.dumps({'type': reqtype, 'data': data, 'time': time.time()})
+
+
+class StalledClient(object):
+    """A client whose link is stuck until release() is called."""
+
+    def __init__(self):
+        self.sent = []
+        self.closed = threading.Event()
+        self._unblocked = threading.Event()
+
+    def send(self, message):
+        self._unblocked.wait()
+        self.sent.append(json.loads(message))
+
+    def close(self):
+        self.closed.set()
+
+    def release(self):
+        self._unblocked.set()
+
+
+class OutboundQueueTest(unittest.TestCase):
+    def new_queue(self, policy, maxsize=4):
+        self.client = StalledClient()
+        queue = outbound.OutboundQueue(
+            self.client.send, self.client.close, maxsize, policy)
+        # Parks the writer on a first message so later puts back up.
+        queue.put(_msg('bulkupdate', ['first']))
+        while queue.stats()['queued']:
+            time.sleep(0.001)
+        return queue
+
+    def drain(self, queue):
+        self.client.release()
+        queue.close()
+        self.assertTrue(self.client.closed.wait(5))
+        return self.client.sent[1:]
+
+    def test_put_does_not_wait_for_client(self):
+        queue = self.new_queue(outbound.DROP_AND_RESYNC, maxsize=1000)
+        start = time.time()
+        for i in range(500):
+            queue.put(_msg('bulkupdate', [i]))
+        self.assertLess(time.time() - start, 1)
+        self.assertEqual(len(self.drain(queue)), 500)
+
+    def test_drop_and_resync_keeps_replies(self):
+        queue = self.new_queue(outbound.DROP_AND_RESYNC)
+        lock = threading.RLock()
+        queue.set_resync(lambda: _msg('resync', 'snapshot'), lock)
+        with lock:
+            queue.put(_msg('bulkupdate', [1]))
+            queue.put(_msg('kvop_resp', 'reply'))
+            queue.put(_msg('presence', ['a']))
+            queue.put(_msg('bulkupdate', [2]))
+            queue.put(_msg('presence', ['a', 'b']))
+            queue.put(_msg('bulk_add', [3]))
+        self.assertEqual(
+            [(m['type'], m['data']) for m in self.drain(queue)],
+            [('resync', 'snapshot'), ('kvop_resp', 'reply'),
+             ('presence', ['a', 'b'])])
+        self.assertEqual(queue.stats()['resyncs'], 1)
+
+    def test_coalesce_merges_updates(self):
+        queue = self.new_queue(outbound.COALESCE, maxsize=2)
+        queue.put(_msg('presence', ['a']))
+        queue.put(_msg('bulkupdate', [1]))
+        queue.put(_msg('bulkupdate', [2]))
+        queue.put(_msg('presence', ['a', 'b']))
+        self.assertEqual(
+            [(m['type'], m['data']) for m in self.drain(queue)],
+            [('bulkupdate', [1, 2]), ('presence', ['a', 'b'])])
+
+    def test_disconnect_closes_slow_client(self):
+        queue = self.new_queue(outbound.DISCONNECT, maxsize=2)
+        queue.put(_msg('bulkupdate', [1]))
+        queue.put(_msg('bulkupdate', [2]))
+        with self.assertRaises(outbound.QueueClosed):
+            queue.put(_msg('bulkupdate', [3]))
+        with self.assertRaises(outbound.QueueClosed):
+            queue.put(_msg('bulkupdate', [4]))
+        self.assertEqual(self.drain(queue), [])
+
+    def test_buffer_needs_a_writer(self):
+        with self.assertRaises(TypeError):
+            outbound.OutboundBuffer(1)
+
+    def test_message_type(self):
+        self.assertEqual(outbound.message_type(_msg('bulk_add', [])), 'bulk_add')
+        self.assertEqual(
+            outbound.message_type('{"data": 1, "type": "presence"}'), 'presence')
+        self.assertIsNone(outbound.message_type(b'\x00'))
@@ -0,0 +1,262 @@
+import csv
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from server import plugins
+
+CARDS = [
+    # name, type, subtype, mana, cost, text, set, rarity
+    ['Goblin King', 'Creature', 'Goblin', '1RR', '3',
+     'Other Goblin creatures get +1/+1 and have mountainwalk.', 'Tenth', 'R'],
+    ['Mogg Fanatic', 'Creature', 'Goblin', 'R', '1',
+     'Sacrifice Mogg Fanatic: It deals 1 damage to any target.', 'Tempest', 'C'],
+    ['Hobgoblin Bandit', 'Creature', 'Hobgoblin Rogue', '2R', '3',
+     'Haste. Whenever this deals combat damage, draw a card.', 'Test', 'U'],
+    ['Goblin Guide', 'Creature', 'Goblin Scout', 'R', '1', 'Haste',
+     'Zendikar', 'R'],
+    ['Lightning Bolt', 'Instant', '', 'R', '1',
+     'Lightning Bolt deals 3 damage to any target.', 'Alpha', 'C'],
+    ['Counterspell', 'Instant', '', 'UU', '2', 'Counter target spell.',
+     'Alpha', 'U'],
+    ['Boros Charm', 'Instant', '', 'RW', '2',
+     'Choose one: 4 damage to each opponent; or indestructible.', 'Gatecrash',
+     'U'],
+    ['Serra Angel', 'Creature', 'Angel', '3WW', '5', 'Flying, vigilance',
+     'Alpha', 'U'],
+    ['Llanowar Elves', 'Creature', 'Elf Druid', 'G', '1', '{T}: Add {G}.',
+     'Alpha', 'C'],
+    ['Mountain', 'Land', 'Mountain', '', '', '({T}: Add {R}.)', 'Alpha', 'C'],
+    ['Sol Ring', 'Artifact', '', '1', '1', '{T}: Add {C}{C}.', 'Alpha', 'U'],
+    ['Sliver Queen', 'Creature', 'Sliver', 'WUBRG', '5',
+     '{2}: Create a 1/1 colorless Sliver creature token.', 'Stronghold', 'R'],
+    ['Goblin Tinkerer', 'Creature', 'Goblin Artificer', '1R', '2',
+     'Destroy target artifact.', 'Unglued', 'C'],
+    ['Unpictured Goblin', 'Creature', 'Goblin', 'R', '1', '', 'Test', 'C'],
+]
+GOOD = ['Lightning Bolt', 'Goblin Guide', 'Serra Angel']
+UNLISTED = ['Mystery Card']
+
+# What the search returned for each query before it was indexed, most
+# relevant first. Cards without a cost never match a cost, where that search
+# failed on them instead.
+EXPECTED = {
+    'goblin': [
+        'Goblin Guide', 'Goblin King', 'Goblin Tinkerer', 'Mogg Fanatic',
+        'Hobgoblin Bandit'],
+    'gob': [
+        'Goblin Guide', 'Goblin King', 'Goblin Tinkerer', 'Hobgoblin Bandit',
+        'Mogg Fanatic'],
+    'oblin': [
+        'Goblin Guide', 'Goblin King', 'Goblin Tinkerer', 'Hobgoblin Bandit',
+        'Mogg Fanatic'],
+    'goblin red': [
+        'Goblin Guide', 'Goblin King', 'Goblin Tinkerer', 'Mogg Fanatic',
+        'Hobgoblin Bandit', 'Lightning Bolt', 'Mountain', 'Serra Angel',
+        'Boros Charm', 'Counterspell', 'Llanowar Elves', 'Sliver Queen'],
+    'red': [
+        'Goblin Guide', 'Lightning Bolt', 'Goblin King', 'Goblin Tinkerer',
+        'Hobgoblin Bandit', 'Mogg Fanatic', 'Mountain', 'Serra Angel',
+        'Boros Charm', 'Counterspell', 'Llanowar Elves', 'Sliver Queen'],
+    'red white': [
+        'Boros Charm', 'Sliver Queen', 'Goblin Guide', 'Lightning Bolt',
+        'Serra Angel', 'Goblin King', 'Goblin Tinkerer', 'Hobgoblin Bandit',
+        'Mogg Fanatic', 'Mountain'],
+    'blue': [
+        'Counterspell', 'Goblin Guide', 'Lightning Bolt', 'Serra Angel',
+        'Goblin King', 'Goblin Tinkerer', 'Hobgoblin Bandit', 'Llanowar Elves',
+        'Mogg Fanatic', 'Mountain', 'Sliver Queen'],
+    'dual': ['Boros Charm'],
+    'colorless': ['Mystery Card', 'Sol Ring'],
+    'haste': ['Goblin Guide', 'Hobgoblin Bandit'],
+    'damage target': [
+        'Lightning Bolt', 'Mogg Fanatic', 'Boros Charm', 'Counterspell',
+        'Goblin Tinkerer', 'Hobgoblin Bandit'],
+    '"any target"': ['Lightning Bolt', 'Mogg Fanatic'],
+    '"goblin scout"': ['Goblin Guide'],
+    'cost<=2': [
+        'Goblin Guide', 'Lightning Bolt', 'Boros Charm', 'Counterspell',
+        'Goblin Tinkerer', 'Llanowar Elves', 'Mogg Fanatic', 'Sol Ring'],
+    'cost>=3 goblin': [
+        'Goblin King', 'Hobgoblin Bandit', 'Serra Angel', 'Sliver Queen'],
+    '1-2 cmc red': [
+        'Goblin Guide', 'Lightning Bolt', 'Goblin Tinkerer', 'Mogg Fanatic',
+        'Boros Charm', 'Counterspell', 'Llanowar Elves', 'Sol Ring'],
+    '3 mana': ['Goblin King', 'Hobgoblin Bandit'],
+    'mana=5': ['Serra Angel', 'Sliver Queen'],
+    'lightning bolt': ['Lightning Bolt'],
+    'mystery card': ['Mystery Card', 'Hobgoblin Bandit'],
+    'creature': [
+        'Goblin Guide', 'Serra Angel', 'Goblin King', 'Goblin Tinkerer',
+        'Hobgoblin Bandit', 'Llanowar Elves', 'Mogg Fanatic', 'Sliver Queen'],
+    'elf': ['Llanowar Elves'],
+    '{t}': ['Llanowar Elves', 'Mountain', 'Sol Ring'],
+    'zzz': [],
+    'x': [],
+    'e g': [
+        'Goblin Guide', 'Serra Angel', 'Goblin King', 'Goblin Tinkerer',
+        'Hobgoblin Bandit', 'Mogg Fanatic', 'Lightning Bolt', 'Counterspell',
+        'Llanowar Elves', 'Sliver Queen', 'Sol Ring', 'Boros Charm',
+        'Mountain', 'Mystery Card'],
+    '"': [],
+    '""': [
+        'Goblin Guide', 'Lightning Bolt', 'Serra Angel', 'Boros Charm',
+        'Counterspell', 'Goblin King', 'Goblin Tinkerer', 'Hobgoblin Bandit',
+        'Llanowar Elves', 'Mogg Fanatic', 'Mountain', 'Mystery Card',
+        'Sliver Queen', 'Sol Ring'],
+    'mountain': ['Mountain', 'Goblin King'],
+    '1/1': ['Sliver Queen'],
+    'angel vigilance': ['Serra Angel'],
+}
+QUERIES = list(EXPECTED)
+
+
+class SubstringIndexTest(unittest.TestCase):
+    def test_finds_words_containing_substring(self):
+        index = plugins.SubstringIndex(
+            ['goblin', 'hobgoblin', 'goblins', 'global', 'lin'])
+        self.assertEqual(index.containing('goblin'),
+                         {'goblin', 'hobgoblin', 'goblins'})
+        self.assertEqual(index.containing('obli'),
+                         {'goblin', 'hobgoblin', 'goblins'})
+        self.assertEqual(index.containing('lin'),
+                         {'goblin', 'hobgoblin', 'goblins', 'lin'})
+        self.assertEqual(index.containing('gl'), {'global'})
+        self.assertEqual(index.containing('gobal'), set())
+        self.assertEqual(len(index.containing('')), 5)
+
+
+class LocalDBSearchTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp = tempfile.mkdtemp(prefix='kansas-plugins-')
+        catalog_file = os.path.join(cls.tmp, 'mtg_info.txt')
+        with open(catalog_file, 'w', newline='') as f:
+            csv.writer(f, escapechar='\\').writerows(CARDS)
+        classify_file = os.path.join(cls.tmp, 'classification.txt')
+        with open(classify_file, 'w') as f:
+            f.writelines('0 %s\n' % name for name in GOOD)
+        localdb = os.path.join(cls.tmp, 'localdb')
+        os.makedirs(localdb)
+        for name in [c[0] for c in CARDS if c[0] != 'Unpictured Goblin'] + UNLISTED:
+            open(os.path.join(localdb, name + '.jpg'), 'w').close()
+        # Ties are ranked in directory order, which is made the same anywhere.
+        listdir = os.listdir
+        sorted_listdir = mock.patch.object(
+            os, 'listdir', lambda path: sorted(listdir(path)))
+        with mock.patch('builtins.print'), sorted_listdir:
+            cls.catalog = plugins.CardCatalog(
+                catalog_file, classify_file, localdb)
+        cls.patches = [
+            mock.patch.object(plugins, 'Catalog', cls.catalog),
+            mock.patch.object(plugins, 'initCatalog'),
+            mock.patch.object(plugins.LocalDBPlugin, 'DB_PATH', localdb),
+        ]
+        for patch in cls.patches:
+            patch.start()
+        with sorted_listdir:
+            cls.plugin = plugins.LocalDBPlugin()
+
+    @classmethod
+    def tearDownClass(cls):
+        for patch in cls.patches:
+            patch.stop()
+        shutil.rmtree(cls.tmp)
+
+    def names(self, query, limit=None):
+        stream, _ = self.plugin.Fetch(query, False, limit)
+        return [entry['name'] for entry in stream]
+
+    def test_matches_unindexed_search_on_query_corpus(self):
+        for query in QUERIES:
+            for limit in (None, 1, 3, 5):
+                self.assertEqual(self.names(query, limit),
+                                 EXPECTED[query][:limit], (query, limit))
+
+    def test_top_results_stop_ranking_early(self):
+        calls = {}
+        for limit in (1, None):
+            with mock.patch.object(
+                    self.plugin, '_rank', wraps=self.plugin._rank) as rank:
+                self.names('goblin red', limit)
+            calls[limit] = rank.call_count
+        self.assertLess(calls[1], calls[None])
+
+    def test_partial_words_stop_ranking_early(self):
+        with mock.patch.object(
+                self.plugin, '_rank', wraps=self.plugin._rank) as rank:
+            self.names('oblin', 1)
+        self.assertEqual(rank.call_count, 1)
+
+    def test_explain_describes_plan_and_stages(self):
+        _, meta = self.plugin.Explain('cost<=2 goblin red', False, 5)
+        explain = meta['explain']
+        self.assertEqual(explain['plan'], {
+            'needle': ' goblin red',
+            'predicates': [['<=', 2]],
+            'terms': ['goblin'],
+            'facets': ['mana=red', 'mana=mono'],
+        })
+        self.assertGreaterEqual(explain['candidates'], explain['ranked'])
+        self.assertEqual(set(explain['timings_ms']),
+                         {'parse', 'candidates', 'rank', 'total'})
+        self.assertNotIn('explain', self.plugin.Fetch('goblin', False)[1])
+
+    def test_plans_are_cached(self):
+        self.assertIs(plugins.parseQuery('1-3 cmc elf'),
+                      plugins.parseQuery('1-3 cmc elf'))
+
+    def test_matches_unindexed_search_without_columns(self):
+        with mock.patch.object(self.catalog.index, 'columns', None):
+            for query in QUERIES:
+                self.assertEqual(self.names(query), EXPECTED[query], query)
+
+    @unittest.skipIf(plugins.numpy is None, "numpy is not installed")
+    def test_columns_filter_costs_like_buckets(self):
+        columns = self.catalog.columns
+        for predicates in ([('<=', 2)], [('>=', 1), ('<=', 3)], [('==', 5)],
+                           [('>', 100000)]):
+            with mock.patch.object(self.catalog.index, 'columns', None):
+                expected = self.catalog.index.costing(predicates)
+            self.assertEqual(columns.costing(predicates), expected)
+
+    @unittest.skipIf(plugins.numpy is None, "numpy is not installed")
+    def test_chooses_spells_passing_deck_filters(self):
+        taken = set()
+        with mock.patch.object(plugins.random, 'random', return_value=0.5):
+            picks = {self.catalog.chooseSpell('R', {'R'}, 1, 2, taken)
+                     for _ in range(2)}
+        self.assertEqual(picks, {'Lightning Bolt', 'Goblin Guide'})
+
+    @unittest.skipIf(plugins.numpy is None, "numpy is not installed")
+    def test_spell_filters_are_applied_once_per_pool(self):
+        columns = self.catalog.columns
+        with mock.patch.object(self.catalog, 'spellRows', {}), \
+                mock.patch.object(columns, 'spellMask',
+                                  wraps=columns.spellMask) as mask, \
+                mock.patch.object(plugins.random, 'random', return_value=0.5):
+            for _ in range(3):
+                self.catalog.chooseSpell('R', {'R', 'G'}, 1, 4, set())
+        self.assertEqual(mask.call_count, 1)
+
+    def test_substrings_match_inside_words(self):
+        self.assertIn('Hobgoblin Bandit', self.names('goblin'))
+        self.assertIn('Goblin King', self.names('obli'))
+
+    def test_expands_partial_theme_words(self):
+        self.assertEqual(self.catalog.expandToken('goblin'), 'goblin')
+        self.assertIn(self.catalog.expandToken('artif'),
+                      {'artifact', 'artificer'})
+        self.assertEqual(self.catalog.expandToken('zzz'), 'zzz')
+
+    def test_cost_predicates_skip_cards_without_cost(self):
+        names = self.names('cost<=2')
+        self.assertIn('Lightning Bolt', names)
+        self.assertNotIn('Mountain', names)
+        self.assertNotIn('Goblin King', names)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,51 @@
+import threading
+import unittest
+
+from server import ratelimit
+
+
+class TokenBucketTest(unittest.TestCase):
+    def test_admits_burst_then_refills(self):
+        bucket = ratelimit.TokenBucket(rate=2, burst=3)
+        now = bucket._last
+        self.assertEqual([bucket.take(now) for _ in range(3)], [0, 0, 0])
+        self.assertAlmostEqual(bucket.take(now), 0.5)
+        self.assertEqual(bucket.take(now + 0.5), 0)
+        self.assertGreater(bucket.take(now + 0.5), 0)
+
+
+class RateLimiterTest(unittest.TestCase):
+    def test_budgets_are_per_key_and_type(self):
+        limiter = ratelimit.RateLimiter({'query': (1, 2)})
+        limiter.check('a', 'query', now=0)
+        limiter.check('a', 'query', now=0)
+        with self.assertRaises(ratelimit.RetryLater) as cm:
+            limiter.check('a', 'query', now=0)
+        self.assertGreater(cm.exception.retry_after, 0)
+        limiter.check('b', 'query', now=0)
+        for _ in range(10):
+            limiter.check('a', 'bulkmove', now=0)
+        self.assertEqual(limiter.num_rejected, 1)
+
+
+class ConcurrencyLimitTest(unittest.TestCase):
+    def test_turns_away_callers_once_full(self):
+        limit = ratelimit.ConcurrencyLimit(1, 0.01, 'lookups')
+        inside = threading.Event()
+        leave = threading.Event()
+
+        def hold():
+            with limit:
+                inside.set()
+                leave.wait()
+
+        holder = threading.Thread(target=hold)
+        holder.start()
+        inside.wait()
+        with self.assertRaises(ratelimit.RetryLater):
+            with limit:
+                pass
+        leave.set()
+        holder.join()
+        with limit:
+            pass
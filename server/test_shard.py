@@ -0,0 +1,221 @@
+import asyncio
+import collections
+import glob
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from server import config
+from server import namespaces
+
+try:
+    from websockets.asyncio.client import connect
+    from server import shard
+except ImportError:
+    shard = None
+
+
+@unittest.skipIf(shard is None, "websockets is not installed")
+class ShardRingTest(unittest.TestCase):
+    def test_owner_is_stable_and_balanced(self):
+        ring = shard.ShardRing(4)
+        owners = collections.Counter(
+            ring.owner('scope', 'pokerdb', 'game%d' % i) for i in range(4000))
+        self.assertEqual(sorted(owners), [0, 1, 2, 3])
+        self.assertGreater(min(owners.values()), 500)
+        self.assertEqual(
+            shard.ShardRing(4).owner('scope', 'pokerdb', 'game1'),
+            ring.owner('scope', 'pokerdb', 'game1'))
+
+    def test_adding_a_worker_moves_few_games(self):
+        before, after = shard.ShardRing(4), shard.ShardRing(5)
+        keys = [('scope', 'pokerdb', 'game%d' % i) for i in range(4000)]
+        moved = sum(before.owner(*k) != after.owner(*k) for k in keys)
+        self.assertLess(moved, len(keys) * 0.35)
+
+    def test_frames_round_trip(self):
+        async def main():
+            reader = asyncio.StreamReader()
+            writer = collections.namedtuple('Writer', 'write')(reader.feed_data)
+            shard.write_frame(writer, '{"type": "ping"}')
+            shard.write_frame(writer, b'\x81\xa1t')
+            reader.feed_eof()
+            return [f async for f in shard._frames(reader)]
+
+        self.assertEqual(
+            asyncio.run(main()), ['{"type": "ping"}', b'\x81\xa1t'])
+
+
+def _close_dbs(path):
+    for db_path in [path] + glob.glob(os.path.join(path, 'shard-*')):
+        db = namespaces._databases.pop(db_path, None)
+        if db is not None:
+            db.Flush()
+            db.conn.close()
+        namespaces._meta.pop(db_path, None)
+
+
+@unittest.skipIf(shard is None, "websockets is not installed")
+class PlaceGamesTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp(prefix='kansas-shard-')
+
+    def tearDown(self):
+        _close_dbs(self.path)
+        shutil.rmtree(self.path)
+
+    def tables(self, path):
+        return (namespaces.Namespace(path, 'Games', version=2)
+                .Subspace('s::pokerdb'),
+                namespaces.Namespace(path, 'GameJournal', version=0)
+                .Subspace('s::pokerdb'))
+
+    def test_moves_games_to_their_owners_and_back(self):
+        games, journal = self.tables(self.path)
+        gameids = ['g%d' % i for i in range(6)]
+        for gameid in gameids:
+            games.Put(gameid, ({'board': {}}, 1000))
+            journal.Subspace(gameid).Put('%016d' % 1001, ('remove', [1]))
+
+        self.assertEqual(shard.place_games(self.path, 2), 6)
+        ring = shard.ShardRing(2)
+        for gameid in gameids:
+            owner = shard.game_db_path(
+                self.path, ring.owner('s', 'pokerdb', gameid), 2)
+            owner_games, owner_journal = self.tables(owner)
+            self.assertEqual(owner_games.Get(gameid), ({'board': {}}, 1000))
+            self.assertEqual(owner_journal.Subspace(gameid).List(),
+                             [('%016d' % 1001, ('remove', [1]))])
+        self.assertEqual(list(games.Keys()), [])
+        self.assertEqual(list(journal.Keys()), [])
+        self.assertEqual(shard.place_games(self.path, 2), 0)
+
+        self.assertEqual(shard.place_games(self.path, 1), 6)
+        self.assertEqual(list(games.Keys()), gameids)
+
+
+@unittest.skipIf(shard is None, "websockets is not installed")
+class SupervisorTest(unittest.TestCase):
+    SCOPE = '__test_shard__'
+
+    async def call(self, ws, reqtype, data, future_id):
+        await ws.send(json.dumps(
+            {'type': reqtype, 'data': data, 'future_id': future_id}))
+        return await self.reply(ws, future_id)
+
+    async def reply(self, ws, future_id):
+        while True:
+            msg = json.loads(await ws.recv())
+            if msg.get('future_id') == future_id:
+                return msg
+
+    def start(self):
+        path = tempfile.mkdtemp(prefix='kansas-shard-')
+        self.addCleanup(shutil.rmtree, path)
+        self.addCleanup(_close_dbs, path)
+        supervisor = shard.Supervisor(2, db_path=path)
+        supervisor.start_workers()
+        self.addCleanup(supervisor.stop_workers)
+        return supervisor
+
+    def test_malformed_requests_get_errors(self):
+        supervisor = self.start()
+
+        async def main():
+            async with supervisor.serve('127.0.0.1', 0) as server:
+                url = 'ws://127.0.0.1:%d/kansas' % (
+                    server.sockets[0].getsockname()[1])
+                async with connect(url, proxy=None) as ws:
+                    replies = [await self.call(ws, 'set_scope', ['x'], 1)]
+                    await self.call(ws, 'set_scope', {
+                        'scope': self.SCOPE, 'datasource': 'pokerdb'}, 2)
+                    replies.append(await self.call(ws, 'connect', {
+                        'uuid': 'u', 'user': 'bob', 'orient': 1}, 3))
+                    replies.append(await self.call(ws, 'connect', 'g1', 4))
+                    replies.append(await self.call(ws, 'connect', {
+                        'uuid': 'u', 'user': 'bob', 'orient': 1,
+                        'gameid': 'g1'}, 5))
+                    return replies
+
+        replies = asyncio.run(main())
+        self.assertEqual([r['type'] for r in replies],
+                         ['error', 'error', 'error', 'connect_resp'])
+
+    def test_replies_owed_are_relayed_after_moving_workers(self):
+        supervisor = self.start()
+        ring = supervisor.ring
+        gameid = next(
+            'g%d' % i for i in range(100)
+            if ring.owner(self.SCOPE, 'pokerdb', 'g%d' % i)
+            != ring.owner(self.SCOPE, 'pokerdb'))
+
+        async def main():
+            async with supervisor.serve('127.0.0.1', 0) as server:
+                url = 'ws://127.0.0.1:%d/kansas' % (
+                    server.sockets[0].getsockname()[1])
+                async with connect(url, proxy=None) as ws:
+                    await self.call(ws, 'set_scope', {
+                        'scope': self.SCOPE, 'datasource': 'pokerdb'}, 1)
+                    # Answered by the scope's worker after five seconds.
+                    await ws.send(json.dumps({
+                        'type': 'query', 'future_id': 2,
+                        'data': {'term': 'sleepsleepsleep',
+                                 'datasource': 'pokerdb'}}))
+                    connected = await self.call(ws, 'connect', {
+                        'uuid': 'u', 'user': 'bob', 'orient': 1,
+                        'gameid': gameid}, 3)
+                    queried = await asyncio.wait_for(
+                        self.reply(ws, 2), 30)
+                    await ws.send(json.dumps(
+                        {'type': 'end_game', 'data': gameid}))
+                    return connected, queried
+
+        connected, queried = asyncio.run(main())
+        self.assertEqual(connected['type'], 'connect_resp')
+        self.assertEqual(queried['type'], 'query_resp')
+
+    def test_games_are_served_by_their_owners(self):
+        supervisor = self.start()
+        path = supervisor.db_path
+        ring = supervisor.ring
+        gameids = ['g%d' % i for i in range(8)]
+
+        async def main():
+            async with supervisor.serve('127.0.0.1', 0) as server:
+                url = 'ws://127.0.0.1:%d/kansas' % (
+                    server.sockets[0].getsockname()[1])
+                for gameid in gameids:
+                    async with connect(url, proxy=None) as ws:
+                        await self.call(ws, 'set_scope', {
+                            'scope': self.SCOPE, 'datasource': 'pokerdb'}, 1)
+                        await self.call(ws, 'connect', {
+                            'uuid': gameid, 'user': 'bob', 'orient': 1,
+                            'gameid': gameid}, 2)
+                async with connect(url, proxy=None) as ws:
+                    await self.call(ws, 'set_scope', {
+                        'scope': self.SCOPE, 'datasource': 'pokerdb'}, 1)
+                    listed = await self.call(ws, 'list_games', None, 2)
+                    for game in listed['data']:
+                        await ws.send(json.dumps(
+                            {'type': 'end_game', 'data': game['gameid']}))
+                    # The games past the cap were ended by the listing.
+                    for i in range(50):
+                        left = await self.call(ws, 'list_games', None, 3 + i)
+                        if not left['data']:
+                            break
+                        await asyncio.sleep(0.1)
+                    return listed, left
+
+        listed, left = asyncio.run(main())
+        self.assertEqual(
+            len({ring.owner(self.SCOPE, 'pokerdb', g) for g in gameids}), 2)
+        # The scope keeps its most recently used games, across workers.
+        self.assertEqual(
+            [g['gameid'] for g in listed['data']],
+            gameids[::-1][:config.kMaxGamesPerScope])
+        self.assertEqual(left['data'], [])
+        for worker in range(2):
+            self.assertTrue(os.path.exists(os.path.join(
+                shard.game_db_path(path, worker, 2), 'kansas.sqlite3')))
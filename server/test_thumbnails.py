@@ -0,0 +1,80 @@
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+from unittest import mock
+
+from server import config
+from server import thumbnails
+
+
+class VariantPathsTest(unittest.TestCase):
+    def test_one_path_per_size_and_format(self):
+        with mock.patch.object(config, 'kThumbnailWebP', True):
+            variants = thumbnails.VariantPaths('cache/ab/abcd.jpg')
+        self.assertEqual(set(variants), set(config.kThumbnailSizes))
+        self.assertEqual(variants['small'], {
+            'jpg': 'cache/ab/abcd@92x131.jpg',
+            'webp': 'cache/ab/abcd@92x131.webp',
+        })
+
+    def test_generate_without_imaging_is_empty(self):
+        with mock.patch.object(thumbnails, 'haveImaging', False):
+            future = thumbnails.service.Generate('cache/ab/abcd.jpg')
+        self.assertEqual(future.result(), {})
+
+
+@unittest.skipIf(not thumbnails.haveImaging, "imaging is not installed")
+class GenerateTest(unittest.TestCase):
+    def setUp(self):
+        self.cache = tempfile.mkdtemp()
+        patcher = mock.patch.object(config, 'kCachePath', self.cache)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.large_path = os.path.join(self.cache, 'ab', 'abcd.jpg')
+        os.makedirs(os.path.dirname(self.large_path))
+        thumbnails.Image.new('RGB', (600, 840), 'red').save(self.large_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.cache)
+
+    def test_writes_each_size_and_format(self):
+        service = thumbnails.ThumbnailService(1)
+        with mock.patch.object(config, 'kThumbnailWebP', True):
+            variants = service.Generate(self.large_path).result()
+        service._executor.shutdown()
+        self.assertEqual(set(variants), set(config.kThumbnailSizes))
+        for name, size in config.kThumbnailSizes.items():
+            for fmt, pil_format in [('jpg', 'JPEG'), ('webp', 'WEBP')]:
+                path = variants[name][fmt]
+                with thumbnails.Image.open(path) as image:
+                    self.assertEqual((image.size, image.format),
+                                     (size, pil_format))
+                self.assertEqual(stat.S_IMODE(os.stat(path).st_mode),
+                                 thumbnails.kFileMode)
+
+    def test_replace_rewrites_existing_variants(self):
+        paths = thumbnails.VariantPaths(self.large_path)
+        thumbnails._generate(self.large_path, paths)
+        thumbnails.Image.new('RGB', (600, 840), 'blue').save(self.large_path)
+        thumbnails._generate(self.large_path, paths)
+        with thumbnails.Image.open(paths['small']['jpg']) as image:
+            self.assertGreater(image.getpixel((0, 0))[0], 200)
+        thumbnails._generate(self.large_path, paths, replace=True)
+        with thumbnails.Image.open(paths['small']['jpg']) as image:
+            self.assertGreater(image.getpixel((0, 0))[2], 200)
+
+    def test_falls_back_to_jpeg_when_webp_fails(self):
+        with mock.patch.object(config, 'kThumbnailWebP', True):
+            paths = thumbnails.VariantPaths(self.large_path)
+        with mock.patch.dict(thumbnails._FORMATS,
+                             webp=('NOSUCHFORMAT', {})), \
+                mock.patch('logging.warning'):
+            variants = thumbnails._generate(self.large_path, paths)
+        self.assertEqual(variants['small'], {'jpg': paths['small']['jpg']})
+        self.assertFalse(os.path.exists(paths['small']['webp']))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,136 @@
+# Generates resized variants of cached card images.
+
+from server import config
+
+import concurrent.futures
+import logging
+import multiprocessing
+import os
+import tempfile
+import threading
+
+try:
+    from PIL import Image
+    haveImaging = True
+except ImportError:
+    try:
+        import Image  # type: ignore
+        haveImaging = True
+    except ImportError:
+        logging.info("Failed to import imaging module.")
+        haveImaging = False
+
+if haveImaging:
+    # Image.ANTIALIAS was removed in Pillow 10.
+    _RESAMPLE = getattr(Image, 'LANCZOS', None) or Image.ANTIALIAS
+
+# Cached images and their thumbnails are served by another server, so they
+# get the usual file mode rather than mkstemp's private 0600.
+_umask = os.umask(0)
+os.umask(_umask)
+kFileMode = 0o666 & ~_umask
+
+_FORMATS = {
+    'jpg': ('JPEG', {'quality': 85, 'optimize': True}),
+    'webp': ('WEBP', {'quality': 80, 'method': 4}),
+}
+
+
+def Formats():
+    """Returns the file extensions generated for every size."""
+
+    if config.kThumbnailWebP:
+        return ['jpg', 'webp']
+    return ['jpg']
+
+
+def VariantPaths(large_path):
+    """Returns {size name: {format: path}} for the variants of large_path."""
+
+    # Imported here since imagecache opens the DB at import time, which
+    # process pool workers have no use for.
+    from server import imagecache
+
+    variants = {}
+    for name, size in config.kThumbnailSizes.items():
+        variants[name] = {}
+        for fmt in Formats():
+            variants[name][fmt] = imagecache.VariantPath(
+                large_path, '@%dx%d.%s' % (size[0], size[1], fmt))
+    return variants
+
+
+def _save_atomic(image, path, fmt):
+    pil_format, options = _FORMATS[fmt]
+    fd, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(path) or '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            image.save(f, format=pil_format, **options)
+            os.fchmod(f.fileno(), kFileMode)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def _generate(large_path, variants, replace=False):
+    """Writes every missing variant of large_path, or with replace set every
+    variant, each over its old copy. Runs in a worker process.
+
+    Returns the variants that exist. Only JPEG failures are fatal; a size
+    whose other formats cannot be written is served as JPEG alone."""
+
+    source = None
+    generated = {}
+    for name, paths in variants.items():
+        size = config.kThumbnailSizes[name]
+        resized = None
+        generated[name] = {}
+        for fmt, path in paths.items():
+            if replace or not os.path.exists(path):
+                if source is None:
+                    source = Image.open(large_path).convert('RGB')
+                if resized is None:
+                    resized = source.resize(size, _RESAMPLE)
+                try:
+                    _save_atomic(resized, path, fmt)
+                except Exception as e:
+                    if fmt == 'jpg':
+                        raise
+                    logging.warning("Failed to save %s: %s", path, e)
+                    continue
+            generated[name][fmt] = path
+    return generated
+
+
+class ThumbnailService(object):
+    """Resizes images in a process pool so the work runs outside the GIL."""
+
+    def __init__(self, max_workers):
+        self.max_workers = max_workers
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def Generate(self, large_path, replace=False):
+        """Returns a future for the variants of large_path, creating any that
+           are missing, or all of them if replace is set. The future holds {}
+           when imaging is unavailable."""
+
+        if not haveImaging:
+            future = concurrent.futures.Future()
+            future.set_result({})
+            return future
+        logging.info("Resize %s", large_path)
+        with self._lock:
+            if self._executor is None:
+                # Forking a threaded server can copy held locks into the
+                # worker, so workers start from a fresh interpreter.
+                self._executor = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=self.max_workers,
+                    mp_context=multiprocessing.get_context('spawn'))
+        return self._executor.submit(
+            _generate, large_path, VariantPaths(large_path), replace)
+
+
+service = ThumbnailService(config.kThumbnailWorkers)
@@ -1,11 +1,14 @@
 #!/usr/bin/env python3
 
 import argparse
+import asyncio
 import logging
 import os
 from types import SimpleNamespace
 
+from server import config
 from server import debugtrace
+from server import outbound
 
 
 kansas_wsh = None
@@ -26,28 +29,33 @@ class _CompatStream:
         self._request = SimpleNamespace(
             connection=SimpleNamespace(remote_addr=(conn.remote_address[0], conn.remote_address[1]))
         )
+        # Sends happen on the queue's writer thread, so a slow client never
+        # blocks the broadcasting thread.
+        self._outbound = outbound.OutboundQueue(
+            conn.send, conn.close,
+            config.kOutboundQueueSize, config.kOutboundPolicy)
 
     def send_message(self, message, binary=False):
         if binary:
-            self._conn.send(message if isinstance(message, bytes) else message.encode("utf-8"))
-        else:
-            if isinstance(message, bytes):
-                message = message.decode("utf-8", errors="ignore")
-            self._conn.send(message)
+            message = message if isinstance(message, bytes) else message.encode("utf-8")
+        elif isinstance(message, bytes):
+            message = message.decode("utf-8", errors="ignore")
+        self._outbound.put(message)
+
+    def set_resync(self, fn, lock):
+        self._outbound.set_resync(fn, lock)
 
     def receive_message(self):
         try:
-            msg = self._conn.recv()
-            if isinstance(msg, bytes):
-                return msg.decode("utf-8", errors="ignore")
-            return msg
+            # Binary frames are decoded by the codec layer in kansas_wsh.
+            return self._conn.recv()
         except Exception:
             # Match historical behavior in kansas_wsh.web_socket_transfer_data
             # where a falsy value signals disconnect.
             return None
 
     def close_connection(self, wait_response=False):
-        self._conn.close()
+        self._outbound.close()
 
 
 class _CompatRequest:
@@ -63,7 +71,10 @@ def _handler(conn):
 
     req = _CompatRequest(conn)
     kansas_wsh.web_socket_do_extra_handshake(req)
-    kansas_wsh.web_socket_transfer_data(req)
+    try:
+        kansas_wsh.web_socket_transfer_data(req)
+    finally:
+        req.ws_stream.close_connection()
 
 
 if __name__ == '__main__':
@@ -74,6 +85,17 @@ if __name__ == '__main__':
         action="store_true",
         help="Enable verbose server logging for debugging",
     )
+    parser.add_argument(
+        "--threaded",
+        action="store_true",
+        help="Serve each connection from its own thread instead of asyncio",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of worker processes to shard games across",
+    )
     args = parser.parse_args()
 
     loglevel = logging.DEBUG if args.debug else logging.INFO
@@ -87,14 +109,27 @@ if __name__ == '__main__':
         os.environ["KANSAS_TRACE_CALLS"] = "1"
     debugtrace.maybe_enable_from_env(debug_enabled=args.debug)
 
-    from server import kansas_wsh
-
     print(f"Test console at http://localhost:{args.port}/console.html")
-    with serve(_handler, "0.0.0.0", args.port):
-        print(f"WebSocket server listening on ws://localhost:{args.port}/kansas")
+    from server import shard
+    if args.workers > 1:
+        # Workers import kansas_wsh themselves; the supervisor holds no games.
         try:
-            while True:
-                import time
-                time.sleep(3600)
+            asyncio.run(shard.run(args.port, args.workers, debug=args.debug))
         except KeyboardInterrupt:
             pass
+        raise SystemExit(0)
+
+    shard.prepare_storage(config.kDBPath, 1)
+    from server import kansas_wsh
+
+    try:
+        if args.threaded:
+            with serve(_handler, "0.0.0.0", args.port,
+                       compression=config.kWireCompression) as server:
+                print(f"WebSocket server listening on ws://localhost:{args.port}/kansas")
+                server.serve_forever()
+        else:
+            from server import aio_server
+            asyncio.run(aio_server.run(args.port))
+    except KeyboardInterrupt:
+        pass